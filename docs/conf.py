@@ -325,7 +325,7 @@ fake_set_up()
 
 ds005_wf = wf_ds005_type({'func': 'fake data'}, {'ants_nthreads': 1,
                                                  'output_dir': 'x',
-                                                 'biggest_epi_file_size_gb': 1,
+                                                 'bold_geometry': [],
                                                  'skip_native': True})
 
 sub_wfs = {name.split('.')[0] for name in ds005_wf.list_node_names()} # get only first-level nodes/workflows
@@ -52,6 +52,7 @@ REQUIRES = [
     'nilearn',
     'sklearn',
     'nibabel',
+    'h5py',
     'pandas',
     'grabbit',
     'pybids>=0.0.1',
@@ -70,7 +71,8 @@ TESTS_REQUIRES = [
 EXTRA_REQUIRES = {
     'doc': ['sphinx'],
     'tests': TESTS_REQUIRES,
-    'duecredit': ['duecredit']
+    'duecredit': ['duecredit'],
+    'indexed_gzip': ['indexed_gzip']
 }
 
 # Enable a handle to install all extra dependencies at once
@@ -3,5 +3,5 @@
 # emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
 # vi: set ft=python sts=4 ts=4 sw=4 et:
 from fmriprep.interfaces.bids import ReadSidecarJSON, DerivativesDataSink, BIDSDataGrabber
-from fmriprep.interfaces.images import ImageDataSink
-from fmriprep.interfaces.utils import FormatHMCParam, IntraModalMerge
+from fmriprep.interfaces.images import ImageDataSink, SplitSeries
+from fmriprep.interfaces.utils import IntraModalMerge, MotionParameters
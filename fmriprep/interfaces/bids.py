@@ -21,6 +21,7 @@ from nipype.interfaces.base import (
 )
 
 from fmriprep.utils.misc import collect_bids_data, make_folder
+from fmriprep.utils.nifti import gzip_file, work_uncompressed
 
 LOGGER = logging.getLogger('interface')
 
@@ -31,6 +32,8 @@ class FileNotFoundError(IOError):
 class BIDSDataGrabberInputSpec(BaseInterfaceInputSpec):
     subject_data = traits.DictStrAny()
     subject_id = traits.Str()
+    anat_only = traits.Bool(False, usedefault=True,
+                            desc='do not require functional images')
 
 
 class BIDSDataGrabberOutputSpec(TraitedSpec):
@@ -60,7 +63,7 @@ class BIDSDataGrabber(BaseInterface):
                 self.inputs.subject_id))
 
         self._results['func'] = bids_dict['func']
-        if not bids_dict['func']:
+        if not bids_dict['func'] and not self.inputs.anat_only:
             raise FileNotFoundError('No functional images found for subject sub-{}'.format(
                 self.inputs.subject_id))
 
@@ -104,6 +107,10 @@ class DerivativesDataSink(BaseInterface):
     def _run_interface(self, runtime):
         fname, _ = _splitext(self.inputs.source_file)
         _, ext = _splitext(self.inputs.in_file[0])
+        # Intermediate images are uncompressed, derivatives are compressed
+        compress = ext == '.nii' and work_uncompressed()
+        if compress:
+            ext = '.nii.gz'
 
         m = re.search(
             '^(?P<subject_id>sub-[a-zA-Z0-9]+)(_(?P<ses_id>ses-[a-zA-Z0-9]+))?'
@@ -149,7 +156,10 @@ class DerivativesDataSink(BaseInterface):
             if isdefined(self.inputs.extra_values):
                 out_file = out_file.format(extra_value=self.inputs.extra_values[i])
             self._results['out_file'].append(out_file)
-            copy(self.inputs.in_file[i], out_file)
+            if compress:
+                gzip_file(self.inputs.in_file[i], out_file)
+            else:
+                copy(self.inputs.in_file[i], out_file)
 
         return runtime
 
@@ -0,0 +1,387 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Head motion correction, with its results kept in a persistent cache (see
+:mod:`fmriprep.utils.cache`), so that re-processing a subject reuses them
+regardless of the working directory, and run on chunks of volumes in
+parallel, to a reference estimated without registration
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os.path as op
+import shutil
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+import nibabel as nb
+
+from nipype.interfaces import fsl
+from nipype.interfaces.base import (
+    traits, isdefined, Undefined, TraitedSpec, BaseInterface, BaseInterfaceInputSpec,
+    File, Directory, OutputMultiPath)
+from nipype.interfaces.fsl.preprocess import MCFLIRTInputSpec
+
+from fmriprep.utils.cache import FileCache, cache_key
+from fmriprep.utils.misc import make_folder
+from fmriprep.utils.nifti import (
+    SeriesWriter, VolumeReader, concat_volumes, iter_volumes, save_nii, work_file)
+
+#: Inputs of MCFLIRT that do not change its results
+_UNHASHED_INPUTS = ('in_file', 'out_file', 'cache_dir', 'environ',
+                    'ignore_exception', 'terminal_output')
+#: Inputs of MCFLIRT naming images, which are hashed by their contents
+_FILE_INPUTS = ('ref_file', 'init')
+#: Volumes averaged into the reference of the head motion correction
+REFERENCE_VOLUMES = 10
+#: Voxels (about) of the downsampled volumes screened for the reference
+SCREEN_VOXELS = 32 ** 3
+#: Volumes (at most) screened for the reference, evenly spaced over the series
+SCREEN_CANDIDATES = 100
+
+
+def _image_ext(in_file):
+    if in_file.endswith('.nii.gz'):
+        return '.nii.gz'
+    return op.splitext(in_file)[1]
+
+
+def cached_outputs(outputs):
+    """
+    Files of the results of MCFLIRT, as ``(cache suffix, path)`` pairs. The
+    par file comes last, being the entry whose presence in the cache tells
+    the results are complete.
+    """
+    files = []
+    for name in ('out_file', 'mean_img', 'std_img', 'variance_img'):
+        if isdefined(outputs.get(name, Undefined)):
+            files.append(('.%s%s' % (name, _image_ext(outputs[name])), outputs[name]))
+    if isdefined(outputs.get('mat_file', Undefined)):
+        files += [('.MAT_%04d' % i, mat_file) for i, mat_file in enumerate(outputs['mat_file'])]
+    if isdefined(outputs.get('rms_files', Undefined)):
+        files += [(suffix, rms_file) for suffix, rms_file
+                  in zip(('.abs.rms', '.rel.rms'), outputs['rms_files'])]
+    if isdefined(outputs.get('par_file', Undefined)):
+        files.append(('.par', outputs['par_file']))
+    return files
+
+
+def retrieve_outputs(cache, key, files):
+    """
+    Retrieves the ``(cache suffix, path)`` files of a result from the cache
+    (see :func:`cached_outputs`). Returns ``False`` if it is not complete.
+    """
+    if not files or files[-1][0] != '.par' or not op.isfile(cache.path(key, '.par')):
+        return False
+    for suffix, out_file in files:
+        make_folder(op.dirname(out_file))
+        if not cache.get(key, out_file, suffix=suffix):
+            return False
+    return True
+
+
+def store_outputs(cache, key, files):
+    """Stores the ``(cache suffix, path)`` files of a result, the par file last"""
+    if files and files[-1][0] == '.par':
+        for suffix, out_file in files:
+            cache.put(key, out_file, suffix=suffix)
+
+
+class CachedMCFLIRTInputSpec(MCFLIRTInputSpec):
+    cache_dir = Directory(nohash=True, desc='persistent cache of the results')
+
+
+class CachedMCFLIRT(fsl.MCFLIRT):
+    """
+    MCFLIRT, whose results (the motion corrected series, the matrices, the
+    par file and the mean image) are kept in ``cache_dir`` (if given),
+    indexed by the contents of the input series, the parameters of MCFLIRT
+    and the version of FSL. Re-running on the same data (e.g., from a fresh
+    working directory, or with other downstream options) retrieves them
+    instead of running MCFLIRT. ``save_plots`` must be set for results to
+    be cached.
+    """
+    input_spec = CachedMCFLIRTInputSpec
+
+    def _cache_key(self):
+        inputs = self.inputs.get_traitsfree()
+        in_files = [self.inputs.in_file] + [
+            inputs[name] for name in _FILE_INPUTS if name in inputs]
+        parameters = sorted((name, value) for name, value in inputs.items()
+                            if name not in _UNHASHED_INPUTS + _FILE_INPUTS)
+        return cache_key(in_files, 'mcflirt', self.version, parameters)
+
+    def _run_interface(self, runtime):
+        if not isdefined(self.inputs.cache_dir):
+            return super(CachedMCFLIRT, self)._run_interface(runtime)
+
+        cache, key = FileCache(self.inputs.cache_dir), self._cache_key()
+        files = cached_outputs(self._list_outputs())
+        if retrieve_outputs(cache, key, files):
+            runtime.returncode = 0
+            return runtime
+
+        runtime = super(CachedMCFLIRT, self)._run_interface(runtime)
+        store_outputs(cache, key, files)
+        return runtime
+
+
+def _as_list(value):
+    return value if isinstance(value, list) else [value]
+
+
+def write_chunks(in_file, chunks, out_files):
+    """
+    Writes the ``(start, stop)`` chunks of volumes of a series to
+    ``out_files``, reading the series once
+    """
+    nii = nb.load(in_file)
+    header = nii.header.copy()
+    header.set_data_dtype(np.float32)
+    header.set_slope_inter(1., 0.)
+
+    ends = dict((start, (stop, out_file)) for (start, stop), out_file in zip(chunks, out_files))
+    writer, stop = None, None
+    try:
+        for i, volume in enumerate(iter_volumes(in_file)):
+            if i in ends:
+                stop, out_file = ends[i]
+                header.set_data_shape(nii.shape[:3] + (stop - i,))
+                writer = SeriesWriter(out_file, header)
+            if writer is not None:
+                writer.write(volume.astype(np.float32))
+                if i + 1 == stop:
+                    writer.close()
+                    writer = None
+    except BaseException:
+        if writer is not None:
+            writer.discard()
+        raise
+    return out_files
+
+
+def screen_volumes(in_file, nvols=REFERENCE_VOLUMES, index_dir=None,
+                   candidates=SCREEN_CANDIDATES):
+    """
+    Indices of the ``nvols`` volumes of a series that are the most alike,
+    as a proxy for the volumes with the least motion. Only ``candidates``
+    volumes, evenly spaced over the series, are read (with a
+    :class:`~fmriprep.utils.nifti.VolumeReader`, which reuses the gzip index
+    kept in ``index_dir``); each is downsampled to about
+    :data:`SCREEN_VOXELS` voxels and scored by its correlation with the
+    median volume. Volumes whose global signal is an outlier (e.g., those
+    before the steady state of the magnetization) are left out.
+    """
+    with VolumeReader(in_file, index_dir=index_dir) as reader:
+        indices = np.unique(np.round(np.linspace(
+            0, len(reader) - 1, min(max(candidates, nvols), len(reader)))).astype(int))
+        step = max(1, int(np.round((np.prod(reader.shape) / SCREEN_VOXELS) ** (1. / 3))))
+        series = np.array([reader[i][::step, ::step, ::step].ravel() for i in indices],
+                          dtype=np.float32)
+
+    signal = series.mean(axis=1)
+    deviation = np.abs(signal - np.median(signal))
+    outliers = deviation > 5 * max(np.median(deviation), 1e-3 * np.abs(np.median(signal)))
+
+    def _standardize(data):
+        data = data - data.mean(axis=-1, keepdims=True)
+        return data / np.maximum(np.linalg.norm(data, axis=-1, keepdims=True), 1e-12)
+
+    correlation = _standardize(series).dot(_standardize(np.median(series, axis=0)))
+    correlation[outliers] = -np.inf
+    return sorted(indices[np.argsort(-correlation, kind='mergesort')[:nvols]].tolist())
+
+
+def save_reference(in_file, out_file, volumes, index_dir=None):
+    """Writes the mean of some volumes of a series, reading only those"""
+    with VolumeReader(in_file, index_dir=index_dir) as reader:
+        total = np.zeros(reader.shape, dtype=np.float64)
+        for i in volumes:
+            total += reader[i]
+        header = reader.header.copy()
+        header.set_data_dtype(np.float32)
+        header.set_data_shape(reader.shape)
+        header.set_slope_inter(1., 0.)
+        nii = nb.Nifti1Image((total / len(volumes)).astype(np.float32), reader.affine, header)
+    return save_nii(nii, out_file)
+
+
+def save_mean(in_file, out_file):
+    """Writes the mean of the volumes of a series, reading it once"""
+    nii = nb.load(in_file)
+    total, nvols = np.zeros(nii.shape[:3], dtype=np.float64), 0
+    for volume in iter_volumes(in_file):
+        total += volume
+        nvols += 1
+    header = nii.header.copy()
+    header.set_data_dtype(np.float32)
+    header.set_data_shape(nii.shape[:3])
+    return save_nii(nb.Nifti1Image((total / nvols).astype(np.float32), nii.affine, header),
+                    out_file)
+
+
+class EstimateReferenceInputSpec(BaseInterfaceInputSpec):
+    in_file = File(exists=True, mandatory=True, desc='4D series')
+    nvols = traits.Int(REFERENCE_VOLUMES, usedefault=True,
+                       desc='number of volumes averaged into the reference')
+    index_dir = Directory(nohash=True, desc='folder keeping the gzip indices')
+    out_file = File('reference.nii.gz', usedefault=True, desc='output file name')
+
+
+class EstimateReferenceOutputSpec(TraitedSpec):
+    ref_file = File(exists=True, desc='reference image')
+    volumes = traits.List(traits.Int, desc='indices of the volumes averaged')
+
+
+class EstimateReference(BaseInterface):
+    """
+    Reference image for the head motion correction: the mean of the
+    volumes of the series that are the most alike (see
+    :func:`screen_volumes`). Unlike ``mcflirt -meanvol``, no registration
+    is needed to estimate it.
+    """
+    input_spec = EstimateReferenceInputSpec
+    output_spec = EstimateReferenceOutputSpec
+
+    def __init__(self, **inputs):
+        self._results = {}
+        super(EstimateReference, self).__init__(**inputs)
+
+    def _run_interface(self, runtime):
+        index_dir = None
+        if isdefined(self.inputs.index_dir):
+            index_dir = self.inputs.index_dir
+
+        volumes = screen_volumes(self.inputs.in_file, self.inputs.nvols, index_dir=index_dir)
+        self._results['volumes'] = volumes
+        self._results['ref_file'] = save_reference(
+            self.inputs.in_file, op.abspath(work_file(self.inputs.out_file)), volumes,
+            index_dir=index_dir)
+        return runtime
+
+    def _list_outputs(self):
+        return self._results
+
+
+class ParallelMCFLIRTInputSpec(BaseInterfaceInputSpec):
+    in_file = File(exists=True, mandatory=True, desc='4D series to correct')
+    ref_file = File(exists=True, desc='reference image (default: estimated as by '
+                                      ':class:`EstimateReference`)')
+    cost = traits.Enum('normcorr', 'mutualinfo', 'woods', 'corratio', 'leastsquares',
+                       usedefault=True, desc='cost function of MCFLIRT')
+    chunk_size = traits.Int(desc='volumes per chunk (default: as many chunks as '
+                                 'threads)')
+    num_threads = traits.Int(1, usedefault=True, nohash=True,
+                             desc='number of chunks registered in parallel')
+    cache_dir = Directory(nohash=True, desc='persistent cache of the results')
+    out_file = File('hmc.nii.gz', usedefault=True, desc='motion corrected series')
+
+
+class ParallelMCFLIRTOutputSpec(TraitedSpec):
+    out_file = File(exists=True, desc='motion corrected series')
+    mat_file = OutputMultiPath(File(exists=True), desc='FSL matrix of each volume')
+    par_file = File(exists=True, desc='motion parameters of each volume')
+    mean_img = File(exists=True, desc='mean of the motion corrected series')
+
+
+class ParallelMCFLIRT(BaseInterface):
+    """
+    Head motion correction by MCFLIRT, run on contiguous chunks of volumes
+    in parallel: all the chunks are registered to the same reference (if not
+    given, estimated as by :class:`EstimateReference`), and their matrices,
+    parameters and volumes are stitched into the outputs of a single MCFLIRT
+    run (``save_mats`` and ``save_plots``), with the mean of the corrected
+    series as ``mean_img``. Results are cached as by :class:`CachedMCFLIRT`,
+    on the chunks only if ``chunk_size`` is given: the default chunks depend
+    on ``num_threads``, which would otherwise invalidate the cache.
+    """
+    input_spec = ParallelMCFLIRTInputSpec
+    output_spec = ParallelMCFLIRTOutputSpec
+
+    def __init__(self, **inputs):
+        self._results = {}
+        super(ParallelMCFLIRT, self).__init__(**inputs)
+
+    def _run_interface(self, runtime):
+        nvols = (nb.load(self.inputs.in_file).shape + (1,))[3]
+        if nvols < 2:
+            raise ValueError('%s is not a series of volumes, head motion cannot be '
+                             'corrected' % self.inputs.in_file)
+        out_file = op.abspath(work_file(self.inputs.out_file))
+        base = out_file[:-len(_image_ext(out_file))]
+        self._results = {
+            'out_file': out_file,
+            'mat_file': [op.join(base + '.mat', 'MAT_%04d' % i) for i in range(nvols)],
+            'par_file': base + '.par',
+            'mean_img': base + '_mean' + _image_ext(out_file),
+        }
+        files = cached_outputs(self._results)
+
+        cache, key = None, None
+        if isdefined(self.inputs.cache_dir):
+            cache = FileCache(self.inputs.cache_dir)
+            in_files = [self.inputs.in_file]
+            if isdefined(self.inputs.ref_file):
+                in_files.append(self.inputs.ref_file)
+            chunk_size = self.inputs.chunk_size if isdefined(self.inputs.chunk_size) else None
+            key = cache_key(in_files, 'parallel-mcflirt', fsl.Info.version(),
+                            self.inputs.cost, chunk_size)
+            if retrieve_outputs(cache, key, files):
+                return runtime
+
+        self._correct(nvols)
+        if cache is not None:
+            store_outputs(cache, key, files)
+        return runtime
+
+    def _chunks(self, nvols):
+        """Contiguous ``(start, stop)`` chunks of at least two volumes"""
+        size = self.inputs.chunk_size
+        if not isdefined(size):
+            size = int(np.ceil(nvols / max(1, self.inputs.num_threads)))
+        size = max(2, size)
+        starts = list(range(0, nvols, size))
+        if len(starts) > 1 and nvols - starts[-1] < 2:
+            starts.pop()
+        return list(zip(starts, starts[1:] + [nvols]))
+
+    def _mcflirt(self, in_file, **inputs):
+        return fsl.MCFLIRT(in_file=in_file, cost=self.inputs.cost, save_mats=True,
+                           save_plots=True, **inputs).run().outputs
+
+    def _correct(self, nvols):
+        chunks = self._chunks(nvols)
+        chunk_files = write_chunks(self.inputs.in_file, chunks,
+                                   [op.abspath('chunk%03d.nii' % i) for i in range(len(chunks))])
+
+        ref_file = self.inputs.ref_file
+        if not isdefined(ref_file):
+            ref_file = save_reference(self.inputs.in_file, op.abspath('reference.nii'),
+                                      screen_volumes(self.inputs.in_file))
+
+        pool = ThreadPool(max(1, min(self.inputs.num_threads, len(chunks))))
+        try:
+            results = pool.map(lambda chunk_file: self._mcflirt(chunk_file, ref_file=ref_file),
+                               chunk_files)
+        finally:
+            pool.close()
+            pool.join()
+
+        concat_volumes([result.out_file for result in results], self._results['out_file'])
+        make_folder(op.dirname(self._results['mat_file'][0]))
+        for src, dst in zip([mat_file for result in results
+                             for mat_file in _as_list(result.mat_file)],
+                            self._results['mat_file']):
+            shutil.copyfile(src, dst)
+        # The lines of MCFLIRT are copied as they are, not to lose precision
+        with open(self._results['par_file'], 'w') as par_file:
+            for result in results:
+                with open(result.par_file) as chunk_par:
+                    par_file.writelines(line.rstrip('\n') + '\n' for line in chunk_par
+                                        if line.strip())
+        save_mean(self._results['out_file'], self._results['mean_img'])
+
+    def _list_outputs(self):
+        return self._results
+
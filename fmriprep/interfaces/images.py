@@ -7,11 +7,14 @@ from shutil import copy
 from nipype import logging
 from nipype.interfaces.base import (
     traits, isdefined, TraitedSpec, BaseInterface, BaseInterfaceInputSpec, 
-    File, InputMultiPath, OutputMultiPath, traits
+    File, Directory, InputMultiPath, OutputMultiPath, traits
 )
 
+import nibabel as nb
+
 from fmriprep.interfaces.bids import _splitext 
 from fmriprep.utils.misc import make_folder
+from fmriprep.utils.nifti import VolumeReader, save_nii, work_file
 
 class ImageDataSinkInputSpec(BaseInterfaceInputSpec):
     base_directory = traits.Directory(
@@ -86,3 +89,54 @@ class ImageDataSink(BaseInterface):
 
     def _list_outputs(self):
         return self._results
+
+
+class SplitSeriesInputSpec(BaseInterfaceInputSpec):
+    in_file = File(exists=True, mandatory=True, desc='input 4D image')
+    volumes = traits.List(traits.Int, desc='indices of the volumes to extract '
+                                           '(default: all)')
+    index_dir = Directory(nohash=True, desc='folder keeping the gzip indices')
+
+
+class SplitSeriesOutputSpec(TraitedSpec):
+    out_files = OutputMultiPath(File(exists=True), desc='3D volumes')
+
+
+class SplitSeries(BaseInterface):
+    """
+    Splits a 4D image into 3D volumes (as ``fslsplit``), or extracts some of
+    its volumes, reading only those from the input file (see
+    :class:`fmriprep.utils.nifti.VolumeReader`)
+    """
+    input_spec = SplitSeriesInputSpec
+    output_spec = SplitSeriesOutputSpec
+
+    def __init__(self, **inputs):
+        self._results = {}
+        super(SplitSeries, self).__init__(**inputs)
+
+    def _run_interface(self, runtime):
+        index_dir = None
+        if isdefined(self.inputs.index_dir):
+            index_dir = self.inputs.index_dir
+
+        with VolumeReader(self.inputs.in_file, index_dir=index_dir) as reader:
+            volumes = range(len(reader))
+            if isdefined(self.inputs.volumes):
+                volumes = self.inputs.volumes
+
+            header = reader.header.copy()
+            header.set_data_shape(reader.shape)
+            out_files = []
+            for i in volumes:
+                volume = reader[i]
+                header.set_data_dtype(volume.dtype)
+                out_files.append(save_nii(
+                    nb.Nifti1Image(volume, reader.affine, header),
+                    op.abspath(work_file('vol%04d.nii.gz' % i))))
+
+        self._results['out_files'] = out_files
+        return runtime
+
+    def _list_outputs(self):
+        return self._results
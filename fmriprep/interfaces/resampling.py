@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Resampling of whole BOLD series in a single process, and composition of
+the transforms shared by all their volumes
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os.path as op
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+import nibabel as nb
+from scipy import ndimage as ndi
+
+from nipype.interfaces.base import (
+    traits, isdefined, TraitedSpec, BaseInterface, BaseInterfaceInputSpec,
+    File, Directory, InputMultiPath)
+
+from fmriprep.utils.cache import FileCache, cache_key
+from fmriprep.utils.nifti import SeriesWriter, iter_volumes, work_file
+from fmriprep.utils.resources import BASE_MEMORY_GB
+from fmriprep.utils.transforms import (
+    DisplacementField, compose_field, grid_points,
+    map_points, read_transforms, read_volume_transforms)
+
+
+class ResampleToSpacesInputSpec(BaseInterfaceInputSpec):
+    in_file = File(exists=True, mandatory=True, desc='4D series to resample')
+    reference_images = InputMultiPath(File(exists=True), mandatory=True,
+                                      desc='image defining the grid of each output space')
+    transforms = traits.List(
+        traits.Either(File(exists=True), traits.List(File(exists=True))), mandatory=True,
+        desc='for each output space, the ITK/ANTs transforms shared by all the '
+             'volumes, in the order of antsApplyTransforms (an empty list for '
+             'the space of the volume transforms, e.g. the native space)')
+    volume_transforms = InputMultiPath(
+        File(exists=True),
+        desc='one ITK affine per volume (e.g., head motion), applied after '
+             '``transforms`` in the order of antsApplyTransforms, as one file '
+             'per volume or a single file listing them')
+    interpolation = traits.Enum('Linear', 'NearestNeighbor', 'BSpline', usedefault=True,
+                                desc='interpolation of the input volumes')
+    num_threads = traits.Int(1, usedefault=True, nohash=True,
+                             desc='number of volumes resampled in parallel')
+    memory_gb = traits.Float(nohash=True, desc='memory the resampling must fit in, '
+                                               'by tiles of the output if needed')
+    out_files = traits.List(traits.Str, desc='output file names (one per space)')
+
+
+class ResampleToSpacesOutputSpec(TraitedSpec):
+    # a list even for a single space, as split by the workflows
+    out_files = traits.List(File(exists=True), desc='resampled series (one per space)')
+
+
+class ResampleToSpaces(BaseInterface):
+    """
+    Resamples a 4D series onto several output spaces (e.g., native, T1w
+    and template), reading the series once. Each output is interpolated
+    once from the input volumes, through the transforms of its space (read
+    once, e.g. a nonlinear warp to the template) composed with the transform
+    of each volume. Equivalent to splitting the series and running
+    ``antsApplyTransforms`` on each volume for each space, but the series is
+    read and the outputs written once, and the warps are evaluated once for
+    all the volumes.
+    """
+    input_spec = ResampleToSpacesInputSpec
+    output_spec = ResampleToSpacesOutputSpec
+
+    def __init__(self, **inputs):
+        self._results = {}
+        super(ResampleToSpaces, self).__init__(**inputs)
+
+    def _run_interface(self, runtime):
+        nspaces = len(self.inputs.reference_images)
+        if len(self.inputs.transforms) != nspaces:
+            raise ValueError('%d lists of transforms were given for %d spaces' % (
+                len(self.inputs.transforms), nspaces))
+
+        out_files = ['resampled%d.nii.gz' % i for i in range(nspaces)]
+        if isdefined(self.inputs.out_files):
+            out_files = self.inputs.out_files
+        volume_xforms = None
+        if isdefined(self.inputs.volume_transforms):
+            volume_xforms = self.inputs.volume_transforms
+
+        spaces = []
+        for ref_file, transforms, out_file in zip(
+                self.inputs.reference_images, self.inputs.transforms, out_files):
+            if not isinstance(transforms, list):
+                transforms = [transforms]
+            ref_nii = nb.load(ref_file)
+            spaces.append((ref_nii, read_transforms(transforms),
+                           op.abspath(work_file(out_file))))
+        memory_gb = None
+        if isdefined(self.inputs.memory_gb):
+            memory_gb = self.inputs.memory_gb
+
+        self._results['out_files'] = resample_series(
+            self.inputs.in_file, spaces, volume_transforms=volume_xforms,
+            interpolation=self.inputs.interpolation, num_threads=self.inputs.num_threads,
+            memory_gb=memory_gb)
+        return runtime
+
+    def _list_outputs(self):
+        return self._results
+
+
+class ComposeTransformsInputSpec(BaseInterfaceInputSpec):
+    transforms = InputMultiPath(
+        File(exists=True), mandatory=True,
+        desc='ITK/ANTs transforms, in the order of antsApplyTransforms')
+    reference_image = File(exists=True, mandatory=True,
+                           desc='image defining the grid of the composed field')
+    cache_dir = Directory(nohash=True, desc='persistent cache of composed fields')
+    out_file = File('composed_field.nii.gz', usedefault=True, desc='output file name')
+
+
+class ComposeTransformsOutputSpec(TraitedSpec):
+    out_file = File(exists=True, desc='composed displacement field (ANTs format)')
+
+
+class ComposeTransforms(BaseInterface):
+    """
+    Composes a chain of transforms (e.g., a nonlinear warp to the template
+    and an affine) into a single displacement field on the reference grid,
+    usable by :class:`ResampleToSpaces` and ``antsApplyTransforms``.
+    Fields are kept in ``cache_dir`` (if given), indexed by the contents of
+    the transforms and the reference grid, and reused by later runs.
+    """
+    input_spec = ComposeTransformsInputSpec
+    output_spec = ComposeTransformsOutputSpec
+
+    def __init__(self, **inputs):
+        self._results = {}
+        super(ComposeTransforms, self).__init__(**inputs)
+
+    def _run_interface(self, runtime):
+        out_file = op.abspath(work_file(self.inputs.out_file))
+        suffix = '.nii.gz' if out_file.endswith('.gz') else '.nii'
+        ref_nii = nb.load(self.inputs.reference_image)
+
+        cache, key = None, None
+        if isdefined(self.inputs.cache_dir):
+            cache = FileCache(self.inputs.cache_dir)
+            # The grid is identified by its shape and affine, not the reference data
+            key = cache_key(self.inputs.transforms, ref_nii.shape[:3],
+                            np.round(ref_nii.affine, 4).tolist())
+
+        if cache is None or not cache.get(key, out_file, suffix=suffix):
+            compose_field(self.inputs.transforms, ref_nii.shape,
+                          ref_nii.affine).to_nifti(out_file)
+            if cache is not None:
+                cache.put(key, out_file, suffix=suffix)
+
+        self._results['out_file'] = out_file
+        return runtime
+
+    def _list_outputs(self):
+        return self._results
+
+
+#: Spline order of each interpolation
+INTERPOLATION_ORDERS = {'NearestNeighbor': 0, 'Linear': 1, 'BSpline': 3}
+
+#: Bytes per output voxel of a slab: its mapped points (float64) ...
+SLAB_POINT_BYTES = 24
+#: ... and, for each thread, their voxel coordinates (float64) and values (float32)
+SLAB_THREAD_BYTES = 28
+
+
+def slab_points(transforms, ref_nii, start=0, stop=None):
+    """
+    RAS points (Nx3) of slices ``start:stop`` (along the last axis) of the
+    grid of ``ref_nii``, mapped through the transforms shared by all the
+    volumes (see :func:`~fmriprep.utils.transforms.read_transforms`)
+    """
+    ref_shape = ref_nii.shape[:3]
+    stop = ref_shape[2] if stop is None else stop
+    shift = np.eye(4)
+    shift[2, 3] = start
+    points = grid_points(ref_shape[:2] + (stop - start,), ref_nii.affine.dot(shift))
+    if len(transforms) == 1 and isinstance(transforms[0], DisplacementField) and \
+            transforms[0].on_grid(ref_shape, ref_nii.affine):
+        # A precomposed field (see ComposeTransforms) needs no interpolation
+        return points + transforms[0].field[:, :, start:stop].reshape(-1, 3)
+    for transform in transforms:
+        points = map_points(transform, points)
+    return points
+
+
+def plan_tiles(grid_shapes, volume_bytes, nvols, num_threads=1, memory_gb=None,
+               fixed_bytes=0):
+    """
+    Splits the resampling of a series onto the grids ``grid_shapes`` to
+    fit in ``memory_gb``: returns the number of input volumes (of
+    ``volume_bytes`` each) read at a time, the number of slices (along the
+    last axis) resampled at a time on each grid, and whether the points of
+    the grids fit in memory together (and are computed once).
+    ``fixed_bytes`` is the memory taken by the transforms.
+    Without ``memory_gb``, whole grids are resampled ``num_threads``
+    volumes at a time.
+    """
+    num_threads = max(1, num_threads)
+    if memory_gb is None:
+        return min(num_threads, nvols), [shape[2] for shape in grid_shapes], True
+
+    budget = memory_gb * 1024.0 ** 3 - BASE_MEMORY_GB * 1024.0 ** 3 - fixed_bytes
+    # A quarter of the budget (or one volume per thread) holds the input
+    # volumes, as read and as float32
+    chunk = int(0.25 * budget // (2 * volume_bytes))
+    chunk = int(min(nvols, max(num_threads, chunk)))
+    budget -= 2 * chunk * volume_bytes
+
+    voxels = [float(np.prod(shape[:3])) for shape in grid_shapes]
+    thread_bytes = num_threads * SLAB_THREAD_BYTES * max(voxels)
+    if SLAB_POINT_BYTES * sum(voxels) + thread_bytes <= budget:
+        return chunk, [shape[2] for shape in grid_shapes], True
+
+    slabs = []
+    for shape in grid_shapes:
+        slice_bytes = shape[0] * shape[1] * (SLAB_POINT_BYTES + num_threads * SLAB_THREAD_BYTES)
+        slabs.append(int(min(shape[2], max(1, budget // slice_bytes))))
+    return chunk, slabs, False
+
+
+def _series_header(in_nii, ref_nii, nvols):
+    """Header of a float32 series on the grid of ``ref_nii``, keeping the TR of ``in_nii``"""
+    shape = tuple(ref_nii.shape[:3]) + ((nvols,) if nvols > 1 else ())
+    header = in_nii.header.copy()
+    header.set_data_dtype(np.float32)
+    header.set_data_shape(shape)
+    header.set_zooms(ref_nii.header.get_zooms()[:3] + in_nii.header.get_zooms()[3:len(shape)])
+    header.set_sform(ref_nii.affine, 1)
+    header.set_qform(ref_nii.affine, 1)
+    return header
+
+
+def resample_series(in_file, spaces, volume_transforms=None, interpolation='Linear',
+                    num_threads=1, memory_gb=None):
+    """
+    Resamples the volumes of ``in_file`` onto several output spaces, given as
+    ``(reference image, transforms, output file)`` tuples, where the points
+    of the reference grid are mapped through the transforms (see
+    :func:`slab_points`) and then through the ITK affine of each volume in
+    ``volume_transforms``. The series is read once, ``num_threads`` volumes
+    are resampled in parallel, and the outputs are written in place (see
+    :meth:`~fmriprep.utils.nifti.SeriesWriter.memmap`).
+
+    With ``memory_gb``, the volumes are read in chunks and the output grids
+    are resampled in slabs small enough to fit in that memory (see
+    :func:`plan_tiles`). Returns the output files.
+    """
+    in_nii = nb.load(in_file)
+    nvols = in_nii.shape[3] if len(in_nii.shape) > 3 else 1
+    volume_xforms = [np.eye(4)] * nvols
+    if volume_transforms is not None:
+        volume_xforms = read_volume_transforms(volume_transforms, nvols)
+
+    order = INTERPOLATION_ORDERS[interpolation]
+    ras2vox = np.linalg.inv(in_nii.affine)
+    num_threads = max(1, num_threads)
+    fixed_bytes = sum(transform.field.nbytes for _, transforms, _ in spaces
+                      for transform in transforms if isinstance(transform, DisplacementField))
+    chunk_size, slabs, keep_points = plan_tiles(
+        [ref_nii.shape[:3] for ref_nii, _, _ in spaces],
+        4 * int(np.prod(in_nii.shape[:3])), nvols, num_threads=num_threads,
+        memory_gb=memory_gb, fixed_bytes=fixed_bytes)
+
+    points_cache = {}
+
+    def _points(space, start, stop):
+        ref_nii, transforms, _ = spaces[space]
+        if (space, start) in points_cache:
+            return points_cache[space, start]
+        points = slab_points(transforms, ref_nii, start, stop)
+        if keep_points:
+            points_cache[space, start] = points
+        return points
+
+    writers = [SeriesWriter(out_file, _series_header(in_nii, ref_nii, nvols))
+               for ref_nii, _, out_file in spaces]
+    pool = ThreadPool(num_threads)
+    try:
+        outputs = [writer.memmap(tuple(ref_nii.shape[:3]) + (nvols,))
+                   for writer, (ref_nii, _, _) in zip(writers, spaces)]
+
+        def _resample_chunk(chunk):
+            for space, (ref_nii, _, _) in enumerate(spaces):
+                nslices = ref_nii.shape[2]
+                for start in range(0, nslices, slabs[space]):
+                    stop = min(nslices, start + slabs[space])
+                    points = _points(space, start, stop)
+
+                    def _resample(args):
+                        index, data = args
+                        vox = ras2vox.dot(volume_xforms[index])
+                        coords = vox[:3, :3].dot(points.T) + vox[:3, 3:]
+                        outputs[space][:, :, start:stop, index] = ndi.map_coordinates(
+                            data, coords, order=order, mode='constant', cval=0.0,
+                            prefilter=order > 1).reshape(ref_nii.shape[:2] + (stop - start,))
+
+                    pool.map(_resample, chunk)
+
+        chunk = []
+        for index, data in enumerate(iter_volumes(in_file)):
+            chunk.append((index, data.astype(np.float32)))
+            if len(chunk) == chunk_size or index == nvols - 1:
+                _resample_chunk(chunk)
+                chunk = []
+    except BaseException:
+        for writer in writers:
+            writer.discard()
+        raise
+    finally:
+        pool.close()
+        pool.join()
+    return [writer.close() for writer in writers]
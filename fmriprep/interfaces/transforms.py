@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Conversion, inversion and concatenation of affine transforms in-process,
+from the headers of the images (see :mod:`fmriprep.utils.transforms`),
+replacing ``c3d_affine_tool`` and ``convert_xfm``
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os.path as op
+
+import nibabel as nb
+
+from nipype.interfaces.base import (
+    traits, isdefined, TraitedSpec, BaseInterface, BaseInterfaceInputSpec,
+    File, InputMultiPath, OutputMultiPath)
+
+from fmriprep.utils.transforms import (
+    concat_fsl_affines, fsl_to_itk, invert_fsl_affine, read_fsl_matrices,
+    write_fsl_affine, write_itk_affines)
+
+
+class FSLToITKInputSpec(BaseInterfaceInputSpec):
+    transform_file = InputMultiPath(File(exists=True), mandatory=True,
+                                    desc='FSL matrices registering source to reference')
+    source_file = File(exists=True, mandatory=True, desc='image moved by the matrices')
+    reference_file = File(exists=True, mandatory=True,
+                          desc='image the source is registered to')
+    series = traits.Bool(False, usedefault=True,
+                         desc='write all the transforms to a single file (e.g., '
+                              'one per volume of a head motion correction)')
+
+
+class FSLToITKOutputSpec(TraitedSpec):
+    itk_transform = OutputMultiPath(File(exists=True), desc='ITK transform files')
+
+
+class FSLToITK(BaseInterface):
+    """
+    Converts FSL matrices into ITK affines (as ``c3d_affine_tool -fsl2ras
+    -oitk``), all at once. With ``series``, the affines are listed in a
+    single file, as read by the ``volume_transforms`` of
+    :class:`~fmriprep.interfaces.resampling.ResampleToSpaces`.
+    """
+    input_spec = FSLToITKInputSpec
+    output_spec = FSLToITKOutputSpec
+
+    def __init__(self, **inputs):
+        self._results = {}
+        super(FSLToITK, self).__init__(**inputs)
+
+    def _run_interface(self, runtime):
+        in_nii = nb.load(self.inputs.source_file)
+        ref_nii = nb.load(self.inputs.reference_file)
+        affines = [fsl_to_itk(matrix, in_nii, ref_nii)
+                   for matrix in read_fsl_matrices(self.inputs.transform_file)]
+
+        if self.inputs.series or len(affines) == 1:
+            out_files = [write_itk_affines(affines, op.abspath('affine.txt'))]
+        else:
+            out_files = [write_itk_affines([affine], op.abspath('affine%04d.txt' % i))
+                         for i, affine in enumerate(affines)]
+        self._results['itk_transform'] = out_files
+        return runtime
+
+    def _list_outputs(self):
+        return self._results
+
+
+class ConvertFSLMatrixInputSpec(BaseInterfaceInputSpec):
+    in_file = File(exists=True, mandatory=True, desc='FSL matrix')
+    in_file2 = File(exists=True, desc='FSL matrix applied after ``in_file``')
+    invert_xfm = traits.Bool(xor=['concat_xfm'], desc='invert ``in_file``')
+    concat_xfm = traits.Bool(xor=['invert_xfm'], requires=['in_file2'],
+                             desc='concatenate ``in_file`` and ``in_file2``')
+    out_file = File(desc='output matrix')
+
+
+class ConvertFSLMatrixOutputSpec(TraitedSpec):
+    out_file = File(exists=True, desc='output matrix')
+
+
+class ConvertFSLMatrix(BaseInterface):
+    """
+    Inverts or concatenates FSL matrices, as ``convert_xfm`` (see
+    :class:`nipype.interfaces.fsl.ConvertXFM`, whose inputs it mirrors)
+    """
+    input_spec = ConvertFSLMatrixInputSpec
+    output_spec = ConvertFSLMatrixOutputSpec
+
+    def __init__(self, **inputs):
+        self._results = {}
+        super(ConvertFSLMatrix, self).__init__(**inputs)
+
+    def _run_interface(self, runtime):
+        matrix = read_fsl_matrices([self.inputs.in_file])[0]
+        if isdefined(self.inputs.invert_xfm) and self.inputs.invert_xfm:
+            matrix = invert_fsl_affine(matrix)
+            suffix = '_inv'
+        elif isdefined(self.inputs.concat_xfm) and self.inputs.concat_xfm:
+            matrix = concat_fsl_affines(matrix, read_fsl_matrices([self.inputs.in_file2])[0])
+            suffix = '_' + op.splitext(op.basename(self.inputs.in_file2))[0]
+        else:
+            suffix = '_fix'
+
+        out_file = self.inputs.out_file
+        if not isdefined(out_file):
+            out_file = op.splitext(op.basename(self.inputs.in_file))[0] + suffix + '.mat'
+        self._results['out_file'] = write_fsl_affine(matrix, op.abspath(out_file))
+        return runtime
+
+    def _list_outputs(self):
+        return self._results
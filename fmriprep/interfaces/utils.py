@@ -57,31 +57,44 @@ class IntraModalMerge(BaseInterface):
         return self._results
 
 
-
-class FormatHMCParamInputSpec(BaseInterfaceInputSpec):
-    translations = traits.List(traits.Tuple(traits.Float, traits.Float, traits.Float),
-                               mandatory=True, desc='three translations in mm')
-    rot_angles = traits.List(traits.Tuple(traits.Float, traits.Float, traits.Float),
-                             mandatory=True, desc='three rotations in rad')
+class MotionParametersInputSpec(BaseInterfaceInputSpec):
+    mat_file = InputMultiPath(File(exists=True), mandatory=True,
+                              desc='FSL matrices of the head motion correction')
+    ref_file = File(exists=True, mandatory=True,
+                    desc='reference image of the matrices (e.g., the mean image)')
     fmt = traits.Enum('confounds', 'movpar_file', usedefault=True,
                       desc='type of resulting file')
 
 
-class FormatHMCParamOutputSpec(TraitedSpec):
+class MotionParametersOutputSpec(TraitedSpec):
     out_file = File(exists=True, desc='written file path')
 
-class FormatHMCParam(BaseInterface):
-    input_spec = FormatHMCParamInputSpec
-    output_spec = FormatHMCParamOutputSpec
+
+class MotionParameters(BaseInterface):
+    """
+    Translations and rotation angles of all the matrices of a head motion
+    correction, about the centre of the reference image (as computed by
+    ``avscale --allparams``, once per matrix), written as a TSV of confounds
+    (``fmt='confounds'``) or as a plain movement parameters file
+    (``fmt='movpar_file'``)
+    """
+    input_spec = MotionParametersInputSpec
+    output_spec = MotionParametersOutputSpec
 
     def __init__(self, **inputs):
         self._results = {}
-        super(FormatHMCParam, self).__init__(**inputs)
+        super(MotionParameters, self).__init__(**inputs)
 
     def _run_interface(self, runtime):
+        import nibabel as nb
+        from fmriprep.utils.transforms import (
+            decompose_fsl_affines, fsl_centre, read_fsl_matrices)
+
+        rot_angles, translations, _, _ = decompose_fsl_affines(
+            read_fsl_matrices(self.inputs.mat_file),
+            fsl_centre(nb.load(self.inputs.ref_file)))
         self._results['out_file'] = _tsv_format(
-            self.inputs.translations, self.inputs.rot_angles,
-            fmt=self.inputs.fmt)
+            translations, rot_angles, fmt=self.inputs.fmt)
         return runtime
 
     def _list_outputs(self):
@@ -106,23 +119,19 @@ def _tsv_format(translations, rot_angles, fmt='confounds'):
 
 
 def nii_concat(in_files):
-    from nibabel.funcs import concat_images
     import os
-    new_nii = concat_images(in_files, check_affines=False)
-
-    new_nii.to_filename("merged.nii.gz")
-
-    return os.path.abspath("merged.nii.gz")
+    from fmriprep.utils.nifti import concat_volumes, work_file
+    return concat_volumes(in_files, os.path.abspath(work_file("merged.nii.gz")))
 
 
 def reorient(in_file):
     import os
     import nibabel as nb
+    from fmriprep.utils.nifti import save_nii, work_file
 
     _, outfile = os.path.split(in_file)
     nii = nb.as_closest_canonical(nb.load(in_file))
-    nii.to_filename(outfile)
-    return os.path.abspath(outfile)
+    return save_nii(nii, os.path.abspath(work_file(outfile)))
 
 
 def prepare_roi_from_probtissue(in_file, epi_mask, epi_mask_erosion_mm=0,
@@ -130,6 +139,7 @@ def prepare_roi_from_probtissue(in_file, epi_mask, epi_mask_erosion_mm=0,
     import os
     import nibabel as nb
     import scipy.ndimage as nd
+    from fmriprep.utils.nifti import save_nii, work_file
 
     probability_map_nii = nb.load(in_file)
     probability_map_data = probability_map_nii.get_data()
@@ -143,8 +153,9 @@ def prepare_roi_from_probtissue(in_file, epi_mask, epi_mask_erosion_mm=0,
     if epi_mask_erosion_mm:
         epi_mask_data = nd.binary_erosion(epi_mask_data,
                                       iterations=int(epi_mask_erosion_mm/max(probability_map_nii.header.get_zooms()))).astype(int)
-        eroded_mask_file = os.path.abspath("erodd_mask.nii.gz")
-        nb.Nifti1Image(epi_mask_data, epi_mask_nii.affine, epi_mask_nii.header).to_filename(eroded_mask_file)
+        eroded_mask_file = os.path.abspath(work_file("erodd_mask.nii.gz"))
+        save_nii(nb.Nifti1Image(epi_mask_data, epi_mask_nii.affine, epi_mask_nii.header),
+                 eroded_mask_file)
     else:
         eroded_mask_file = epi_mask
     probability_map_data[epi_mask_data != 1] = 0
@@ -158,6 +169,5 @@ def prepare_roi_from_probtissue(in_file, epi_mask, epi_mask_erosion_mm=0,
 
     new_nii = nb.Nifti1Image(probability_map_data, probability_map_nii.affine,
                              probability_map_nii.header)
-    new_nii.to_filename("roi.nii.gz")
-    return os.path.abspath("roi.nii.gz"), eroded_mask_file
+    return save_nii(new_nii, os.path.abspath(work_file("roi.nii.gz"))), eroded_mask_file
 
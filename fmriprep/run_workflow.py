@@ -39,33 +39,79 @@ def main():
 
     # Other options
     g_input = parser.add_argument_group('fMRIprep specific arguments')
-    g_input.add_argument('-s', '--session-id', action='store', default='single_session')
-    g_input.add_argument('-r', '--run-id', action='store', default='single_run')
+    g_input.add_argument('-s', '--session-id', action='store', default=None,
+                         help='limit the functional analysis only to one session')
+    g_input.add_argument('-r', '--run-id', action='store', default=None,
+                         help='limit the functional analysis only to one run')
     g_input.add_argument('--task-id', help='limit the analysis only ot one task', action='store')
-    g_input.add_argument('-d', '--data-type', action='store', choices=['anat', 'func'])
+    g_input.add_argument('-d', '--data-type', action='store', choices=['anat', 'func'],
+                         help='process only the anatomical data, or only the functional '
+                              'data reusing the anatomical derivatives of a previous '
+                              '"--data-type anat" run')
     g_input.add_argument('--debug', action='store_true', default=False,
                          help='run debug version of workflow')
     g_input.add_argument('--nthreads', action='store', default=0,
                          type=int, help='number of threads')
     g_input.add_argument('--mem_mb', action='store', default=0,
                          type=int, help='try to limit requested memory to this number')
+    g_input.add_argument('--resample-mem-gb', action='store', type=float, default=None,
+                         help='memory budget of the resampling of each BOLD run, which '
+                              'works by tiles of the output to stay within it (default: '
+                              'the memory of a float32 copy of the run)')
     g_input.add_argument('--write-graph', action='store_true', default=False,
                          help='Write workflow graph.')
     g_input.add_argument('--use-plugin', action='store', default=None,
                          help='nipype plugin configuration file')
     g_input.add_argument('-w', '--work-dir', action='store',
                          default=op.join(os.getcwd(), 'work'))
+    g_input.add_argument('--cache-dir', action='store', default=None,
+                         help='persistent cache of derived files (e.g., composed '
+                              'transforms, head motion corrections) shared across '
+                              'runs (default: a cache folder in the working directory)')
+    g_input.add_argument('--gzip-level', action='store', type=int, default=None,
+                         choices=range(1, 10), metavar='{1..9}',
+                         help='compression level of the NIfTI files written by fmriprep '
+                              '(default: 6)')
+    g_input.add_argument('--work-uncompressed', action='store_true', default=False,
+                         help='write uncompressed NIfTI files in the working directory '
+                              '(only the derivatives are compressed)')
     g_input.add_argument('-t', '--workflow-type', default='auto', required=False,
                          action='store', choices=['auto', 'ds005', 'ds054'],
                          help='specify workflow type manually')
     g_input.add_argument('--skip-native', action='store_true',
                          default=False,
                          help="don't output timeseries in native space")
+    g_input.add_argument('--output-space', action='store', nargs='+', default=['MNI'],
+                         choices=['T1w', 'MNI'],
+                         help='spaces (besides the native space) the timeseries are '
+                              'resampled to, in a single pass (ds005-type workflows)')
+    g_input.add_argument('--shard-index', action='store', type=int, default=None,
+                         help='process only the subjects assigned to this shard (0-based) '
+                              'of an array job. Read from FMRIPREP_SHARD_INDEX, or from '
+                              'the SLURM/SGE array task ID if not given')
+    g_input.add_argument('--shard-count', action='store', type=int, default=None,
+                         help='number of shards the subjects are split into (see '
+                              '--shard-index)')
+    g_input.add_argument('--plan', action='store_true', default=False,
+                         help='build the workflow and report the resources it is '
+                              'estimated to need (CPU time, memory, disk), without '
+                              'running it')
+    g_input.add_argument('--resource-profiles', action='store', nargs='?', const='',
+                         default=None, metavar='DB',
+                         help='record the resources used by each node in DB (default: '
+                              'resource_profiles.sqlite in the log directory), and use '
+                              'those recorded in previous runs to schedule them. The '
+                              'peak memory of the nodes is polled by nipype\'s runtime '
+                              'profiler (with psutil), which slows the nodes down')
+    g_input.add_argument('--remove-intermediates', action='store_true', default=False,
+                         help='remove intermediate images from the working directory '
+                              'as soon as the nodes using them have finished (nodes '
+                              'whose images were removed are not re-run when resuming)')
 
     #  ANTs options
     g_ants = parser.add_argument_group('specific settings for ANTs registrations')
     g_ants.add_argument('--ants-nthreads', action='store', type=int, default=0,
-                        help='number of threads that will be set in ANTs processes')
+                        help='maximum number of threads of ANTs processes (at most --nthreads)')
     g_ants.add_argument('--skull-strip-ants', dest="skull_strip_ants",
                         action='store_true',
                         help='use ANTs-based skull-stripping (default, slow))')
@@ -74,6 +120,13 @@ def main():
                         help="don't use ANTs-based skull-stripping (use  AFNI instead, fast)")
     g_ants.set_defaults(skull_strip_ants=True)
 
+    #  Head motion correction options
+    g_hmc = parser.add_argument_group('specific settings for head motion correction')
+    g_hmc.add_argument('--hmc-nthreads', action='store', type=int, default=1,
+                       help='number of chunks of volumes of each BOLD run registered in '
+                            'parallel to a common reference (at most --nthreads). With '
+                            'the default (1), MCFLIRT runs on the whole BOLD run')
+
     opts = parser.parse_args()
     create_workflow(opts)
 
@@ -82,6 +135,11 @@ def create_workflow(opts):
     import logging
     from nipype import config as ncfg
     from fmriprep.utils import make_folder
+    from fmriprep.utils.cleanup import CollectedOutputs
+    from fmriprep.utils.multiproc import MultiProcPlugin
+    from fmriprep.utils.nifti import COMPRESSION_VARIABLE, UNCOMPRESSED_VARIABLE
+    from fmriprep.utils.resources import ResourceProfiles
+    from fmriprep.utils.sharding import shard_from_environ, shard_subjects, SubjectLocks
     from fmriprep.viz.reports import run_reports
     from fmriprep.workflows.base import base_workflow_enumerator
 
@@ -90,13 +148,19 @@ def create_workflow(opts):
         'write_graph': opts.write_graph,
         'nthreads': opts.nthreads,
         'mem_mb': opts.mem_mb,
+        'resample_mem_gb': opts.resample_mem_gb,
         'debug': opts.debug,
         'ants_nthreads': opts.ants_nthreads,
+        'hmc_nthreads': opts.hmc_nthreads,
         'skull_strip_ants': opts.skull_strip_ants,
         'output_dir': op.abspath(opts.output_dir),
         'work_dir': op.abspath(opts.work_dir),
+        'bids_index': op.join(op.abspath(opts.work_dir), 'bids_index.sqlite'),
+        'cache_dir': op.abspath(opts.cache_dir or op.join(opts.work_dir, 'cache')),
         'workflow_type': opts.workflow_type,
-        'skip_native': opts.skip_native
+        'data_type': opts.data_type,
+        'skip_native': opts.skip_native,
+        'output_spaces': opts.output_space
     }
 
     # set up logger
@@ -118,13 +182,49 @@ def create_workflow(opts):
 
     logger.addHandler(logging.FileHandler(op.join(log_dir, 'run_workflow')))
 
+    # Read by the NIfTI writers of all nodes (see fmriprep.utils.nifti)
+    if opts.gzip_level is not None:
+        os.environ[COMPRESSION_VARIABLE] = '%d' % opts.gzip_level
+    if opts.work_uncompressed:
+        os.environ[UNCOMPRESSED_VARIABLE] = '1'
+        # Default output type of the FSL interfaces
+        os.environ['FSLOUTPUTTYPE'] = 'NIFTI'
+
     # Set nipype config
     ncfg.update_config({
         'logging': {'log_directory': log_dir, 'log_to_file': True},
-        'execution': {'crashdump_dir': log_dir, 
-                      'remove_unnecessary_outputs': False}
+        'execution': {'crashdump_dir': log_dir,
+                      'remove_unnecessary_outputs': opts.remove_intermediates}
     })
 
+    # Images removed from the working directory are recorded in it, so that
+    # resumed runs do not attempt to read them
+    collected_outputs = None
+    if opts.remove_intermediates:
+        collected_outputs = CollectedOutputs(
+            op.join(settings['work_dir'], 'collected_outputs.sqlite'))
+
+    # With --resource-profiles, the resources used by each node are recorded
+    # (in the log directory by default), and reused in later runs to schedule
+    # the nodes
+    settings['resource_profiles'] = None
+    if opts.resource_profiles is not None:
+        settings['resource_profiles'] = ResourceProfiles(op.abspath(
+            opts.resource_profiles or op.join(log_dir, 'resource_profiles.sqlite')))
+        if hasattr(ncfg, 'enable_resource_monitor'):  # nipype >= 1.0
+            ncfg.enable_resource_monitor()
+        else:
+            ncfg.set('execution', 'profile_runtime', 'true')
+            from nipype.interfaces import base as nib
+            if not nib.runtime_profile:
+                # nipype 0.13 interfaces only read the option when imported
+                logger.warning('peak memory will not be profiled, unless profile_runtime '
+                               'is set in the [execution] section of nipype.cfg')
+        try:
+            import psutil  # pylint: disable=W0612
+        except ImportError:
+            logger.warning('psutil is not installed, peak memory will not be profiled')
+
     # nipype plugin configuration
     plugin_settings = {'plugin': 'Linear'}
     if opts.use_plugin is not None:
@@ -137,13 +237,22 @@ def create_workflow(opts):
             settings['nthreads'] = cpu_count()
 
         if settings['nthreads'] > 1:
-            plugin_settings['plugin'] = 'MultiProc'
-            plugin_settings['plugin_args'] = {'n_procs': settings['nthreads']}
+            plugin_args = {'n_procs': settings['nthreads'],
+                           'resource_profiles': settings['resource_profiles'],
+                           'collected_outputs': collected_outputs}
             if settings['mem_mb']:
-                plugin_settings['plugin_args']['memory_gb'] = settings['mem_mb']/1024
+                plugin_args['memory_gb'] = settings['mem_mb']/1024
+            plugin_settings['plugin'] = MultiProcPlugin(plugin_args=plugin_args)
 
-    if settings['ants_nthreads'] == 0:
-        settings['ants_nthreads'] = cpu_count()
+    if collected_outputs is not None and \
+            not isinstance(plugin_settings['plugin'], MultiProcPlugin):
+        logger.warning('Intermediate images are only removed by the MultiProc plugin')
+
+    # ANTs and HMC threads count against the total budget of threads
+    max_threads = settings['nthreads'] or cpu_count()
+    if settings['ants_nthreads'] == 0 or settings['ants_nthreads'] > max_threads:
+        settings['ants_nthreads'] = max_threads
+    settings['hmc_nthreads'] = max(1, min(settings['hmc_nthreads'], max_threads))
 
     # Determine subjects to be processed
     subject_list = opts.participant_label
@@ -152,17 +261,66 @@ def create_workflow(opts):
         subject_list = [op.basename(subdir)[4:] for subdir in glob.glob(
             op.join(settings['bids_root'], 'sub-*'))]
 
-    logger.info('Subject list: %s', ', '.join(subject_list))
+    # Keep only the subjects of this shard of an array job
+    shard_index, shard_count = opts.shard_index, opts.shard_count
+    if shard_index is None or shard_count is None:
+        env_index, env_count = shard_from_environ()
+        shard_index = shard_index if shard_index is not None else env_index
+        shard_count = shard_count if shard_count is not None else env_count
+    if shard_index is not None:
+        if shard_count is None:
+            raise RuntimeError('The number of shards must be set (--shard-count or '
+                               'FMRIPREP_SHARD_COUNT) to process shard %d' % shard_index)
+        subject_list = shard_subjects(settings['bids_root'], sorted(subject_list),
+                                      shard_index, shard_count,
+                                      index_file=settings['bids_index'])
+        logger.info('Shard %d of %d', shard_index, shard_count)
+
+    if opts.plan:
+        # Nothing is run, the subjects need not be locked
+        from fmriprep.utils.planning import plan_workflow, format_plan
+        from nipype.pipeline.plugins.multiproc import get_system_total_memory_gb
+        preproc_wf = base_workflow_enumerator(subject_list, task_id=opts.task_id,
+                                              settings=settings,
+                                              session_id=opts.session_id,
+                                              run_id=opts.run_id)
+        plan = plan_workflow(
+            preproc_wf, n_procs=settings['nthreads'] or cpu_count(),
+            memory_gb=settings['mem_mb'] / 1024 if settings['mem_mb'] else
+            get_system_total_memory_gb() * 0.9,
+            profiles=settings['resource_profiles'])
+        print(format_plan(plan))
+        return
+
+    # Jobs processing different parts of the same subjects do not exclude each other
+    lock_scope = '_'.join('%s-%s' % (entity, value) for entity, value in [
+        ('data', opts.data_type), ('ses', opts.session_id),
+        ('task', opts.task_id), ('run', opts.run_id)] if value)
+    with SubjectLocks(op.join(settings['work_dir'], 'locks'), scope=lock_scope) as locks:
+        locked = locks.acquire(subject_list)
+        for subject in sorted(set(subject_list) - set(locked)):
+            logger.warning('Skipping subject %s: it is being processed by another '
+                           'fmriprep process sharing the working directory (remove %s '
+                           'if that process is no longer running)', subject,
+                           locks.lock_file(subject) + '.lock')
+        subject_list = [subject for subject in subject_list if subject in locked]
+        if not subject_list:
+            logger.info('No subjects left to process')
+            return
+
+        logger.info('Subject list: %s', ', '.join(subject_list))
 
-    # Build main workflow and run
-    preproc_wf = base_workflow_enumerator(subject_list, task_id=opts.task_id,
-                                          settings=settings)
-    preproc_wf.base_dir = settings['work_dir']
-    preproc_wf.run(**plugin_settings)
+        # Build main workflow and run
+        preproc_wf = base_workflow_enumerator(subject_list, task_id=opts.task_id,
+                                              settings=settings,
+                                              session_id=opts.session_id,
+                                              run_id=opts.run_id)
+        preproc_wf.base_dir = settings['work_dir']
+        preproc_wf.run(**plugin_settings)
 
-    if opts.write_graph:
-        preproc_wf.write_graph(graph2use="colored", format='svg',
-                               simple_form=True)
+        if opts.write_graph:
+            preproc_wf.write_graph(graph2use="colored", format='svg',
+                                   simple_form=True)
 
     run_reports(settings['output_dir'])
 
@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Dataset-level index of a BIDS tree.
+
+Walking a dataset with ``BIDSLayout`` is expensive, and doing it once per
+participant made workflow construction scale quadratically with the number
+of subjects. The :class:`BIDSIndex` runs the layout queries fmriprep needs
+only once for the whole dataset, keeps the results in a SQLite file (e.g.
+under the working directory) and answers per-subject queries from memory.
+
+The index is invalidated whenever the modification time of any directory
+in the dataset changes (i.e., files were added, removed or renamed).
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+import os.path as op
+import hashlib
+import sqlite3
+import tempfile
+import threading
+
+from bids.grabbids import BIDSLayout
+
+BIDS_QUERIES = {
+    'fmap': {'modality': 'fmap', 'ext': 'nii'},
+    'epi': {'modality': 'func', 'type': 'bold', 'ext': 'nii'},
+    'sbref': {'modality': 'func', 'type': 'sbref', 'ext': 'nii'},
+    't1w': {'type': 'T1w', 'ext': 'nii'}
+}
+
+INDEX_ENTITIES = ['subject', 'session', 'run', 'task']
+
+#: Prefixes users may include in the labels they filter on (e.g. ``ses-01``)
+ENTITY_PREFIXES = {'subject': 'sub-', 'session': 'ses-', 'run': 'run-', 'task': 'task-'}
+
+_INDEX_CACHE = {}
+_INDEX_LOCK = threading.Lock()
+
+
+def get_bids_index(dataset, index_file=None):
+    """
+    Returns the :class:`BIDSIndex` of ``dataset``, reusing the one already
+    opened by this process if any
+    """
+    key = (op.abspath(dataset), index_file)
+    with _INDEX_LOCK:
+        if key not in _INDEX_CACHE:
+            _INDEX_CACHE[key] = BIDSIndex(dataset, index_file=index_file)
+        return _INDEX_CACHE[key]
+
+
+def _same_label(entity, label, query):
+    """
+    Checks whether the label of an indexed file matches the label queried,
+    which may include the entity prefix. Run numbers match regardless of
+    zero-padding (``run-01`` is run ``1``).
+    """
+    query = str(query)
+    if query.startswith(ENTITY_PREFIXES[entity]):
+        query = query[len(ENTITY_PREFIXES[entity]):]
+    if label is None:
+        return False
+    if entity == 'run' and label.isdigit() and query.isdigit():
+        return int(label) == int(query)
+    return label == query
+
+
+def _umask():
+    """Current umask of the process (which can only be read by setting it)"""
+    mask = os.umask(0)
+    os.umask(mask)
+    return mask
+
+
+def dataset_signature(dataset):
+    """
+    Computes a hash of the modification times of all the directories in
+    the dataset. Only directories are stat'ed, so this is much cheaper than
+    parsing the whole tree.
+    """
+    dataset = op.abspath(dataset)
+    sha = hashlib.sha1()
+    for root, dirs, _ in os.walk(dataset):
+        dirs.sort()
+        sha.update(('%s:%r\n' % (op.relpath(root, dataset),
+                                 os.stat(root).st_mtime)).encode('utf-8'))
+    return sha.hexdigest()
+
+
+class BIDSIndex(object):
+    """
+    Persistent index of the files returned by :data:`BIDS_QUERIES`.
+
+    If ``index_file`` is ``None``, the index only lives in memory.
+    """
+
+    def __init__(self, dataset, index_file=None):
+        self.dataset = op.abspath(dataset)
+        self.index_file = index_file
+        self.signature = dataset_signature(self.dataset)
+        self._records = None
+
+        if index_file is not None:
+            self._records = self._read(index_file, self.signature)
+
+        if self._records is None:
+            self._records = self._build()
+            if index_file is not None:
+                self._write(index_file)
+
+        self._by_subject = {}
+        for record in self._records:
+            self._by_subject.setdefault(record['subject'], []).append(record)
+
+    def get(self, query, subject, task=None, session=None, run=None):
+        """
+        Returns the sorted list of files matching ``query`` (one of the keys
+        of :data:`BIDS_QUERIES`) for a given subject, optionally restricted
+        to a task, session and/or run
+        """
+        subject = str(subject)
+        if subject.startswith('sub-'):
+            subject = subject[4:]
+
+        filters = {'task': task, 'session': session, 'run': run}
+        return sorted(
+            record['filename'] for record in self._by_subject.get(subject, [])
+            if record['query'] == query and all(
+                value is None or _same_label(entity, record[entity], value)
+                for entity, value in list(filters.items())))
+
+    def subjects(self):
+        """Returns the sorted list of subjects in the index"""
+        return sorted(subject for subject in self._by_subject if subject is not None)
+
+    def _build(self):
+        layout = BIDSLayout(self.dataset)
+        records = []
+        for query, query_args in list(BIDS_QUERIES.items()):
+            for bids_file in layout.get(**query_args):
+                record = {'query': query, 'filename': bids_file.filename}
+                for entity in INDEX_ENTITIES:
+                    value = getattr(bids_file, entity, None)
+                    record[entity] = str(value) if value is not None else None
+                records.append(record)
+        return records
+
+    @staticmethod
+    def _read(index_file, signature):
+        if not op.isfile(index_file):
+            return None
+
+        try:
+            conn = sqlite3.connect(index_file)
+            try:
+                row = conn.execute(
+                    "SELECT value FROM meta WHERE key = 'signature'").fetchone()
+                if row is None or row[0] != signature:
+                    return None
+                columns = ['query', 'filename'] + INDEX_ENTITIES
+                rows = conn.execute('SELECT %s FROM files' % ', '.join(columns)).fetchall()
+            finally:
+                conn.close()
+        except sqlite3.Error:
+            return None
+
+        return [dict(zip(columns, row)) for row in rows]
+
+    def _write(self, index_file):
+        # Write to a temporary file and move it into place so that concurrent
+        # fmriprep processes never read a half-written index. The temporary
+        # file is unique, even across hosts sharing the working directory
+        fd, tmp_file = tempfile.mkstemp(suffix='.tmp', prefix=op.basename(index_file) + '.',
+                                        dir=op.dirname(op.abspath(index_file)))
+        os.close(fd)
+        columns = ['query', 'filename'] + INDEX_ENTITIES
+        try:
+            conn = sqlite3.connect(tmp_file)
+            try:
+                conn.execute('CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)')
+                conn.execute('CREATE TABLE files (%s)' % ', '.join(
+                    '%s TEXT' % col for col in columns))
+                conn.execute('INSERT INTO meta VALUES (?, ?)', ('signature', self.signature))
+                conn.execute('INSERT INTO meta VALUES (?, ?)', ('dataset', self.dataset))
+                conn.executemany(
+                    'INSERT INTO files VALUES (%s)' % ', '.join(['?'] * len(columns)),
+                    [tuple(record[col] for col in columns) for record in self._records])
+                conn.commit()
+            finally:
+                conn.close()
+            # mkstemp creates the file readable by its owner only
+            os.chmod(tmp_file, 0o666 & ~_umask())
+            os.rename(tmp_file, index_file)
+        finally:
+            if op.exists(tmp_file):
+                os.remove(tmp_file)
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+A persistent cache of derived files (e.g., composed transforms), indexed by
+the contents of the files they were computed from. Unlike nipype's node
+caching, entries are reused across working directories and workflows.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import hashlib
+import os
+import os.path as op
+import shutil
+from tempfile import mkstemp
+
+from fmriprep.utils.misc import make_folder
+
+
+def file_hash(in_file, blocksize=1 << 20):
+    """SHA1 digest of the contents of a file"""
+    sha1 = hashlib.sha1()
+    with open(in_file, 'rb') as fobj:
+        for block in iter(lambda: fobj.read(blocksize), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def cache_key(in_files, *args):
+    """
+    Key of the result of a computation on ``in_files`` (in this order), with
+    parameters ``args``
+    """
+    sha1 = hashlib.sha1()
+    for in_file in in_files:
+        sha1.update(file_hash(in_file).encode())
+    for arg in args:
+        sha1.update(('%s' % (arg,)).encode())
+    return sha1.hexdigest()
+
+
+def _link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except (OSError, AttributeError):
+        shutil.copyfile(src, dst)
+
+
+class FileCache(object):
+    """
+    Files stored in ``cache_dir`` under their key. Entries are written
+    atomically, so the cache can be shared by concurrent processes.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def path(self, key, suffix=''):
+        """Location of an entry in the cache"""
+        return op.join(self.cache_dir, key[:2], key + suffix)
+
+    def get(self, key, out_file, suffix=''):
+        """
+        Retrieves an entry into ``out_file`` (hard-linked when possible).
+        Returns ``False`` if the entry does not exist.
+        """
+        cached = self.path(key, suffix)
+        if not op.isfile(cached):
+            return False
+        if op.lexists(out_file):
+            os.remove(out_file)
+        _link_or_copy(cached, out_file)
+        return True
+
+    def put(self, key, in_file, suffix=''):
+        """Stores a copy of ``in_file``"""
+        cached = self.path(key, suffix)
+        make_folder(op.dirname(cached))
+        fdesc, tmp_file = mkstemp(dir=op.dirname(cached), suffix='.tmp')
+        os.close(fdesc)
+        try:
+            shutil.copyfile(in_file, tmp_file)
+            os.rename(tmp_file, cached)
+        finally:
+            if op.exists(tmp_file):
+                os.remove(tmp_file)
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Removal of intermediate images from the working directory.
+
+When enabled (``--remove-intermediates``), the
+:class:`~fmriprep.utils.multiproc.MultiProcPlugin` deletes the images a node
+wrote to the working directory as soon as every node that uses them
+(directly, or through nodes passing the file names along) has finished.
+Result files (``result_*.pklz``), hashes and other small files are kept.
+
+The directories cleaned up are recorded in a :class:`CollectedOutputs`
+ledger, so that a later run on the same working directory does not try to
+read the images back: cleaned-up nodes and the nodes that consumed their
+outputs are considered finished.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+import os.path as op
+import sqlite3
+
+from builtins import str as string_types  # pylint: disable=W0622
+
+#: Extensions of the files removed from the working directory
+IMAGE_EXTENSIONS = ('.nii', '.nii.gz', '.mgz', '.h5')
+
+
+class CollectedOutputs(object):
+    """
+    Ledger of the node directories whose images were removed, kept in a
+    SQLite file (by default in the working directory)
+    """
+
+    def __init__(self, ledger_file):
+        self.ledger_file = ledger_file
+        conn = self._connect()
+        try:
+            conn.execute('CREATE TABLE IF NOT EXISTS collected (node_dir TEXT PRIMARY KEY)')
+            conn.commit()
+            self._node_dirs = set(
+                row[0] for row in conn.execute('SELECT node_dir FROM collected'))
+        finally:
+            conn.close()
+
+    def _connect(self):
+        # Shards of an array job may share the working directory
+        return sqlite3.connect(self.ledger_file, timeout=60)
+
+    def add(self, node_dir):
+        """Records that the images of ``node_dir`` were removed"""
+        node_dir = op.abspath(node_dir)
+        conn = self._connect()
+        try:
+            conn.execute('INSERT OR IGNORE INTO collected VALUES (?)', (node_dir,))
+            conn.commit()
+        finally:
+            conn.close()
+        self._node_dirs.add(node_dir)
+
+    def __contains__(self, node_dir):
+        return op.abspath(node_dir) in self._node_dirs
+
+
+def output_files(value):
+    """Returns the existing files among the (possibly nested) output ``value``"""
+    if isinstance(value, dict):
+        value = list(value.values())
+    if isinstance(value, (list, tuple)):
+        return [fname for item in value for fname in output_files(item)]
+    if isinstance(value, string_types) and op.isfile(value):
+        return [op.abspath(value)]
+    return []
+
+
+def image_files(node_dir):
+    """Returns the images in ``node_dir`` and its subdirectories (MapNode subnodes)"""
+    images = []
+    for root, _, files in os.walk(node_dir):
+        images += [op.join(root, fname) for fname in files
+                   if fname.endswith(IMAGE_EXTENSIONS)]
+    return images
@@ -1,13 +1,12 @@
 import copy
 from glob import glob
-import itertools
 import json
 import os
 from os import path as op
 from errno import EEXIST
 import re
 
-from bids.grabbids import BIDSLayout
+from fmriprep.utils.bids_index import get_bids_index
 
 INPUTS_SPEC = {'fieldmaps': [], 'func': [], 't1': [], 'sbref': []}
 
@@ -49,84 +48,79 @@ fieldmap_suffixes = {
 }
 
 
-def collect_bids_data(dataset, subject, task=None, session=None, run=None):
+def collect_bids_data(dataset, subject, task=None, session=None, run=None,
+                      index_file=None):
+    """
+    Collects the imaging data of one subject. Queries are answered by the
+    dataset-level :class:`~fmriprep.utils.bids_index.BIDSIndex`, which is
+    built only once per dataset (and cached in ``index_file`` if given).
+
+    BOLD runs are restricted to the given ``task``, ``session`` and ``run``.
+    SBRefs and fieldmaps are restricted to the ``session`` only, as they are
+    usually shared by several runs. T1w images are never restricted, the
+    anatomical reference is computed from all the sessions of the subject.
+    """
     subject = str(subject)
     if subject.startswith('sub-'):
         subject = subject[4:]
 
-    layout = BIDSLayout(dataset)
-
-    if session:
-        session_list = [session]
-    else:
-        session_list = layout.unique('session')
-        if session_list == []:
-            session_list = [None]
-
-    if run:
-        run_list = [run]
-    else:
-        run_list = layout.unique('run')
-        if run_list == []:
-            run_list = [None]
+    index = get_bids_index(dataset, index_file=index_file)
 
-    queries = {
-        'fmap': {'modality': 'fmap', 'ext': 'nii'},
-        'epi': {'modality': 'func', 'type': 'bold', 'ext': 'nii'},
-        'sbref': {'modality': 'func', 'type': 'sbref', 'ext': 'nii'},
-        't1w': {'type': 'T1w', 'ext': 'nii'}
-    }
+    imaging_data = copy.deepcopy(INPUTS_SPEC)
+    imaging_data['fmap'] = index.get('fmap', subject, session=session)
+    imaging_data['t1w'] = index.get('t1w', subject)
+    imaging_data['sbref'] = index.get('sbref', subject, session=session)
+    imaging_data['func'] = index.get('epi', subject, task=task, session=session, run=run)
 
-    if task:
-        queries['epi']['task'] = task
+    return imaging_data
 
-    #  Add a subject key pair to each query we make so that we only deal with
-    #  files related to this workflows specific subject. Could be made opt...
-    for key in queries.keys():
-        queries[key]['subject'] = subject
 
-    imaging_data = copy.deepcopy(INPUTS_SPEC)
-    fieldmap_files = [x.filename for x in layout.get(**queries['fmap'])]
-    imaging_data['fmap'] = fieldmap_files
-    t1_files = [x.filename for x in layout.get(**queries['t1w'])]
-    imaging_data['t1w'] = t1_files
-    sbref_files = [x.filename for x in layout.get(**queries['sbref'])]
-    imaging_data['sbref'] = sbref_files
-    epi_files = [x.filename for x in layout.get(**queries['epi'])]
-    imaging_data['func'] = epi_files
-
-    '''
-    loop_on = ['session', 'run', 'acquisition', 'task']
-    get_kwargs = {}
-
-    for key in loop_on:
-        unique_list = layout.unique(key)
-        if unique_list:
-            get_kwargs[key] = unique_list
-
-    query_kwargs = []
-    for key in get_kwargs:
-        query_kwargs.append([(key, x) for x in get_kwargs[key]])
-
-    query_kwargs = itertools.product(*query_kwargs)
-
-    for elem in query_kwargs:
-        epi_files = [x.filename for x
-                     in layout.get(**dict(dict(elem), **queries['epi']))]
-        if epi_files:
-            imaging_data['func'] += epi_files
-    '''
+#: Derivatives written by :func:`fmriprep.workflows.anatomical.t1w_preprocessing`
+#: (suffixes) that are reused by functional-only runs
+ANAT_DERIVATIVES = {
+    'bias_corrected_t1': ['preproc'],
+    't1_seg': ['dtissue'],
+    't1_mask': ['brainmask'],
+    't1_tpms': ['class-*_probtissue'],
+    't1_2_mni': ['space-MNI152NLin2009cAsym_preproc'],
+    't1_2_mni_forward_transform': ['target-MNI152NLin2009cAsym_affine',
+                                   'target-MNI152NLin2009cAsym_warp'],
+}
 
-    return imaging_data
 
+def collect_anat_derivatives(output_dir, t1w):
+    """
+    Finds the outputs of a previous anatomical run on the T1w images
+    ``t1w`` in ``output_dir``. Returns a dictionary with the fields of the
+    ``outputnode`` of :func:`~fmriprep.workflows.anatomical.t1w_preprocessing`.
+    """
+    source_file = fix_multi_T1w_source_name(t1w if len(t1w) > 1 else t1w[0])
+    fname = op.basename(source_file).split('.')[0]
+
+    # Same layout as DerivativesDataSink
+    entities = re.search('^(?P<subject_id>sub-[a-zA-Z0-9]+)(_(?P<ses_id>ses-[a-zA-Z0-9]+))?',
+                         fname).groupdict()
+    out_path = op.join(output_dir, 'derivatives', entities['subject_id'])
+    if entities['ses_id'] is not None:
+        out_path = op.join(out_path, entities['ses_id'])
+    base_fname = op.join(out_path, 'anat', fname)
+
+    derivatives = {}
+    for field, suffixes in list(ANAT_DERIVATIVES.items()):
+        files = []
+        for suffix in suffixes:
+            files += sorted(glob('{}_{}.*'.format(base_fname, suffix)) +
+                            glob('{}_{}[0-9][0-9][0-9][0-9].*'.format(base_fname, suffix)))
+        if not files:
+            raise RuntimeError(
+                'Anatomical derivatives ({}) not found in {}. Run fmriprep with '
+                '--data-type anat first.'.format(field, op.dirname(base_fname)))
+        if field in ('t1_tpms', 't1_2_mni_forward_transform'):
+            derivatives[field] = files
+        else:
+            derivatives[field] = files[0]
+    return derivatives
 
-def get_biggest_epi_file_size_gb(files):
-    max_size = 0
-    for file in files:
-        size = os.path.getsize(file)/(1024*1024*1024)
-        if size > max_size:
-            max_size = size
-    return max_size
 
 def fix_multi_T1w_source_name(in_files):
     import os
@@ -0,0 +1,504 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Execution plugin for fmriprep workflows
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+import os.path as op
+import resource
+import sys
+from copy import deepcopy
+from time import time
+from traceback import format_exception
+
+import numpy as np
+import scipy.sparse as ssp
+
+from nipype import config, logging
+from nipype.interfaces.base import Bunch, isdefined
+from nipype.pipeline.engine import MapNode
+from nipype.pipeline.plugins import multiproc
+from nipype.pipeline.plugins.base import report_crash
+from nipype.pipeline.plugins.multiproc import MultiProcPlugin as NipypeMultiProcPlugin
+from nipype.utils.misc import str2bool
+
+from fmriprep.utils.cleanup import image_files, output_files
+from fmriprep.utils.resources import (
+    EPI_MEMORY_MODEL, bottom_levels, estimate_node_memory_gb, estimate_duration,
+    geometry_key, inputs_geometry)
+
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
+
+LOGGER = logging.getLogger('workflow')
+
+#: Environment variables limiting the threads of OpenMP, ITK and BLAS
+THREAD_VARIABLES = ['OMP_NUM_THREADS', 'ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS',
+                    'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']
+
+
+def _cpu_time():
+    """CPU time used so far by this process and its finished children"""
+    return sum(usage.ru_utime + usage.ru_stime for usage in (
+        resource.getrusage(resource.RUSAGE_SELF),
+        resource.getrusage(resource.RUSAGE_CHILDREN)))
+
+
+def _results_cached(node, updatehash=False):
+    """
+    Whether running the node will only load the results of a previous run
+    from its working directory, by the same checks as ``Node.run``
+    """
+    if updatehash:
+        return True
+    if node.overwrite or (node.overwrite is None and node._interface.always_run):
+        return False
+    if node.config is None:
+        # As set by Node.run, the hash depends on the execution settings
+        node.config = deepcopy(config._sections)
+    try:
+        if hasattr(node, 'is_cached'):  # nipype >= 1.0
+            return all(node.is_cached())
+        return node.hash_exists()[0]
+    except Exception:  # pylint: disable=W0703
+        return False
+
+
+def min_threads(interface, max_threads):
+    """
+    Threads (at least) allotted to a job that can use up to ``max_threads``:
+    the ``min_threads`` attribute of its interface, if set by the workflow,
+    and otherwise half of its request, so that multi-threaded jobs (e.g.,
+    ANTs registrations) never run on a single thread
+    """
+    requested = getattr(interface, 'min_threads', None) or (max_threads + 1) // 2
+    return max(1, min(requested, max_threads))
+
+
+def _takes_memory_budget(node):
+    """Whether the interface of the node works within a memory budget (``memory_gb``)"""
+    return not isinstance(node, MapNode) and 'memory_gb' in node.inputs.trait_names() \
+        and node.inputs.trait('memory_gb').nohash
+
+
+def run_node(node, updatehash, taskid):
+    """
+    Runs the node with :func:`nipype.pipeline.plugins.multiproc.run_node`,
+    and adds the resources it used to the result dictionary (key ``profile``),
+    unless its results were found in its working directory.
+
+    The threads of the libraries and the command-line tools the node uses
+    are limited to the number of threads allotted to it by the plugin.
+    """
+    nthreads = max(1, node._interface.num_threads)
+    for variable in THREAD_VARIABLES:
+        os.environ[variable] = '%d' % nthreads
+    # Libraries already loaded by the worker ignore the environment
+    limits = None
+    if threadpool_limits is not None:
+        limits = threadpool_limits(limits=nthreads)
+
+    cached = _results_cached(node, updatehash)
+    start_cpu = _cpu_time()
+    start_wall = time()
+    try:
+        result = multiproc.run_node(node, updatehash, taskid)
+    finally:
+        if limits is not None:
+            limits.restore_original_limits()
+    wall_time = time() - start_wall
+    cpu_time = _cpu_time() - start_cpu
+
+    if result['traceback'] is None and not cached:
+        try:
+            runtime = result['result'].runtime
+            # Peak memory is only available if nipype's runtime profiler is on
+            mem_gb = getattr(runtime, 'mem_peak_gb', None)
+            if mem_gb is None:
+                mem_gb = getattr(runtime, 'runtime_memory_gb', None)
+            geometry = inputs_geometry(node.inputs.get())
+            result['profile'] = {
+                'node_dir': node.output_dir(),
+                'interface': node.interface.__class__.__name__,
+                'node': node.name,
+                'geometry': geometry_key(geometry) if geometry else None,
+                'mem_gb': mem_gb or None,
+                'cpu_time': cpu_time,
+                'wall_time': wall_time,
+            }
+        except Exception as exc:  # pylint: disable=W0703
+            LOGGER.debug('Could not profile node %s (%s)', node._id, exc)
+    return result
+
+
+class MultiProcPlugin(NipypeMultiProcPlugin):
+    """
+    nipype's MultiProc plugin, extended for fmriprep:
+
+      * The memory estimates of the nodes described in
+        :data:`~fmriprep.utils.resources.EPI_MEMORY_MODEL` are recomputed
+        from the images actually connected to them (i.e., for each BOLD run)
+        right before they are dispatched.
+      * If a :class:`~fmriprep.utils.resources.ResourceProfiles` store is
+        given (``plugin_args['resource_profiles']``), the resources used by
+        each node are recorded in it, and nodes that were profiled in
+        previous runs on inputs of the same geometry are scheduled with the
+        recorded memory and threads.
+      * Estimates never exceed the memory available to the plugin, so a
+        pessimistic estimate cannot stall the queue.
+      * Nodes that can use several threads (e.g. ANTs) share the processors
+        left free by the running nodes with the rest of the ready nodes, so
+        the total number of threads stays within ``n_procs``. Each gets at
+        least the minimum it requested (see :func:`min_threads`), and waits
+        for free processors otherwise. The allotment is fixed when the node
+        is dispatched, and is passed on to the ``num_threads`` input of the
+        node (if any) and to the threading environment variables of OpenMP,
+        ITK and BLAS.
+      * Ready nodes are dispatched by decreasing length of the longest path
+        (in estimated duration, see
+        :func:`~fmriprep.utils.resources.estimate_duration`) from them to
+        the end of the workflow, so that the critical path (e.g., the T1w to
+        MNI registration) starts as early as possible. Nodes that do not fit
+        in the free resources are skipped in favour of those that do.
+      * If a :class:`~fmriprep.utils.cleanup.CollectedOutputs` ledger is
+        given (``plugin_args['collected_outputs']``), the images of each node
+        are removed from the working directory once all the nodes using them
+        have finished. When resuming, nodes whose images were removed (and
+        the nodes that consumed them) are not run again, nor re-checked.
+
+    """
+
+    def __init__(self, plugin_args=None):
+        super(MultiProcPlugin, self).__init__(plugin_args=plugin_args)
+        # Maximum and minimum number of threads of each job, as requested by
+        # the workflow
+        self._max_threads = {}
+        self._min_threads = {}
+        # Critical path length (seconds) from each job to the end of the workflow
+        self._priority = []
+        self._profiles = None
+        # Removal of intermediate images
+        self._collected = None
+        self._parents = []
+        self._file_refs = {}
+        self._released = set()
+        self._skipped = set()
+        if plugin_args:
+            self._profiles = plugin_args.get('resource_profiles')
+            self._collected = plugin_args.get('collected_outputs')
+
+    def _submit_job(self, node, updatehash=False):
+        self._taskid += 1
+        if hasattr(node.inputs, 'terminal_output'):
+            if node.inputs.terminal_output == 'stream':
+                node.inputs.terminal_output = 'allatonce'
+
+        # Interfaces taking the number of threads as input (e.g. ANTs)
+        if not isinstance(node, MapNode) and 'num_threads' in node.inputs.trait_names() \
+                and node.inputs.trait('num_threads').nohash:
+            node.inputs.num_threads = node._interface.num_threads
+        # Interfaces working within a memory budget (e.g. ResampleToSpaces)
+        # fit in the memory reserved for them, unless given a budget
+        if _takes_memory_budget(node) and not isdefined(node.inputs.memory_gb):
+            node.inputs.memory_gb = node._interface.estimated_memory_gb
+
+        self._task_obj[self._taskid] = \
+            self.pool.apply_async(run_node,
+                                  (node, updatehash, self._taskid),
+                                  callback=self._async_callback)
+        return self._taskid
+
+    def _async_callback(self, args):
+        if self._profiles is not None and args.get('profile'):
+            try:
+                self._profiles.record(args['profile'])
+            except Exception as exc:  # pylint: disable=W0703
+                LOGGER.warning('Could not record resource profile (%s)', exc)
+        super(MultiProcPlugin, self)._async_callback(args)
+
+    def _generate_dependency_list(self, graph):
+        super(MultiProcPlugin, self)._generate_dependency_list(graph)
+
+        durations = {}
+        if self._profiles is not None:
+            try:
+                durations = self._profiles.durations()
+            except Exception as exc:  # pylint: disable=W0703
+                LOGGER.warning('Could not read the resource profiles (%s)', exc)
+
+        # Jobs are topologically sorted
+        self._priority = bottom_levels(
+            [estimate_duration(node, durations) for node in self.procs],
+            ssp.lil_matrix(self.refidx).rows)
+        # refidx is updated as jobs finish, keep the original dependencies
+        self._parents = ssp.lil_matrix(self.refidx.T).rows
+
+    def _submit_mapnode(self, jobid):
+        numprocs = len(self.procs)
+        submit = super(MultiProcPlugin, self)._submit_mapnode(jobid)
+        # Subnodes inherit the priority of their MapNode
+        self._priority += [self._priority[jobid]] * (len(self.procs) - numprocs)
+        return submit
+
+    def _task_finished_cb(self, jobid):
+        super(MultiProcPlugin, self)._task_finished_cb(jobid)
+        if self._collected is None or jobid in self.mapnodesubids:
+            return
+
+        # Files passed on by this job, which may be produced by other jobs
+        # (e.g. IdentityInterface or Merge nodes)
+        node = self.procs[jobid]
+        try:
+            outputs = node.result.outputs
+        except Exception:  # pylint: disable=W0703
+            outputs = None
+        if outputs is None:
+            return
+        values = outputs.dictcopy() if isinstance(outputs, Bunch) else outputs.get()
+        work_dir = op.abspath(node.base_dir)
+        for fname in output_files(values):
+            if fname.startswith(work_dir):
+                self._file_refs.setdefault(fname, set()).add(jobid)
+
+    def _remove_node_dirs(self):
+        super(MultiProcPlugin, self)._remove_node_dirs()
+        if self._collected is not None:
+            self._collect_outputs()
+
+    def _used_up(self, jobid):
+        """Whether a job and all its dependents have finished"""
+        return bool(self.proc_done[jobid]) and not self.proc_pending[jobid] and \
+            self.refidx[jobid, :].sum() == 0
+
+    def _collect_outputs(self):
+        """
+        Removes the images of the jobs whose dependents have all finished,
+        unless they were passed on by a job whose dependents have not
+        """
+        for jobid in range(self.refidx.shape[0]):
+            if jobid in self._released or jobid in self.mapnodesubids or \
+                    not self._used_up(jobid):
+                continue
+
+            outdir = self.procs[jobid].output_dir()
+            images = image_files(outdir)
+            if not all(self._used_up(ref) for fname in images
+                       for ref in self._file_refs.get(fname, [])):
+                continue
+
+            LOGGER.debug('Removing %d intermediate images of %s',
+                         len(images), self.procs[jobid]._id)
+            for fname in images:
+                try:
+                    os.remove(fname)
+                except OSError as exc:
+                    LOGGER.warning('Could not remove %s (%s)', fname, exc)
+            try:
+                self._collected.add(outdir)
+            except Exception as exc:  # pylint: disable=W0703
+                LOGGER.warning('Could not record the removal of %s (%s)', outdir, exc)
+            self._released.add(jobid)
+
+    def _was_collected(self, jobid):
+        """
+        Whether a job finished in a previous run and its images, or those of
+        one of its parents, were removed (or its parent was skipped)
+        """
+        node = self.procs[jobid]
+        outdir = node.output_dir()
+        if not op.isfile(op.join(outdir, 'result_%s.pklz' % node.name)):
+            return False
+        parents = self._parents[jobid] if jobid < len(self._parents) else []
+        return outdir in self._collected or any(
+            parent in self._skipped or self.procs[parent].output_dir() in self._collected
+            for parent in parents)
+
+    def _send_procs_to_workers(self, updatehash=False, graph=None):
+        """
+        Sends the ready jobs to the workers, by decreasing priority, while
+        there are enough memory and processors available
+        """
+        # Check available system resources by summing all threads and memory used
+        currently_running_jobids = np.flatnonzero(
+            (self.proc_pending == True) &  # pylint: disable=C0121
+            (self.depidx.sum(axis=0) == 0).__array__())
+        free_memory_gb = self.memory_gb - sum(
+            self.procs[jobid]._interface.estimated_memory_gb
+            for jobid in currently_running_jobids)
+        free_processors = self.processors - sum(
+            self.procs[jobid]._interface.num_threads
+            for jobid in currently_running_jobids)
+
+        # Check all jobs without dependency not run
+        jobids = np.flatnonzero((self.proc_done == False) &  # pylint: disable=C0121
+                                (self.depidx.sum(axis=0) == 0).__array__())
+        if self._collected is not None:
+            jobids = self._skip_collected(jobids)
+        for jobid in jobids:
+            if jobid not in self._max_threads:
+                self._estimate_resources(self.procs[jobid])
+                self._max_threads[jobid] = max(1, min(
+                    self.procs[jobid]._interface.num_threads, self.processors))
+                self._min_threads[jobid] = min_threads(
+                    self.procs[jobid]._interface, self._max_threads[jobid])
+        self._allot_threads(jobids)
+
+        # Jobs on the longest paths first, then the most resource consuming
+        jobids = sorted(jobids, key=lambda item: (
+            -self._priority[item],
+            -self.procs[item]._interface.estimated_memory_gb,
+            -self.procs[item]._interface.num_threads, item))
+
+        LOGGER.debug('Free memory (GB): %.2f, Free processors: %d',
+                     free_memory_gb, free_processors)
+
+        for jobid in jobids:
+            node = self.procs[jobid]
+            if node._interface.estimated_memory_gb > free_memory_gb or \
+                    node._interface.num_threads > free_processors:
+                continue
+
+            LOGGER.info('Executing: %s ID: %d (priority %.0fs)', node._id, jobid,
+                        self._priority[jobid])
+
+            if isinstance(node, MapNode):
+                try:
+                    num_subnodes = node.num_subnodes()
+                except Exception:  # pylint: disable=W0703
+                    report_crash(node, traceback=format_exception(*sys.exc_info()))
+                    self._clean_queue(jobid, graph)
+                    self.proc_pending[jobid] = False
+                    continue
+                if num_subnodes > 1:
+                    submit = self._submit_mapnode(jobid)
+                    if not submit:
+                        continue
+
+            # change job status in appropriate queues
+            self.proc_done[jobid] = True
+            self.proc_pending[jobid] = True
+
+            free_memory_gb -= node._interface.estimated_memory_gb
+            free_processors -= node._interface.num_threads
+
+            # Send job to task manager and add to pending tasks
+            if self._status_callback:
+                self._status_callback(node, 'start')
+
+            if str2bool(node.config['execution']['local_hash_check']):
+                LOGGER.debug('checking hash locally')
+                try:
+                    hash_exists, _, _, _ = node.hash_exists()
+                    if hash_exists and (node.overwrite is False or (
+                            node.overwrite is None and not node._interface.always_run)):
+                        self._task_finished_cb(jobid)
+                        self._remove_node_dirs()
+                        continue
+                except Exception:  # pylint: disable=W0703
+                    report_crash(node, traceback=format_exception(*sys.exc_info()))
+                    self._clean_queue(jobid, graph)
+                    self.proc_pending[jobid] = False
+                    continue
+
+            if node.run_without_submitting:
+                LOGGER.debug('Running node %s on master thread', node)
+                try:
+                    node.run()
+                except Exception:  # pylint: disable=W0703
+                    report_crash(node, traceback=format_exception(*sys.exc_info()))
+                self._task_finished_cb(jobid)
+                self._remove_node_dirs()
+            else:
+                LOGGER.debug('MultiProcPlugin submitting %s', str(jobid))
+                tid = self._submit_job(deepcopy(node), updatehash=updatehash)
+                if tid is None:
+                    self.proc_done[jobid] = False
+                    self.proc_pending[jobid] = False
+                else:
+                    self.pending_tasks.insert(0, (tid, jobid))
+
+    def _skip_collected(self, jobids):
+        """
+        Marks as finished the ready jobs whose inputs or outputs were removed
+        by a previous run, and returns the rest
+        """
+        remaining = []
+        for jobid in jobids:
+            if self._was_collected(jobid):
+                LOGGER.info('Skipping %s, its intermediate images were removed',
+                            self.procs[jobid]._id)
+                self.proc_done[jobid] = True
+                self.proc_pending[jobid] = True
+                self._task_finished_cb(jobid)
+                self._skipped.add(jobid)
+            else:
+                remaining.append(jobid)
+        return remaining
+
+    def _estimate_resources(self, node):
+        interface = node._interface
+
+        if node.name in EPI_MEMORY_MODEL or self._profiles is not None:
+            try:
+                # Pull the inputs from the results of upstream nodes
+                if not isinstance(node, MapNode):
+                    node._get_inputs()
+
+                # A memory budget given to the node is reserved as is
+                budgeted = _takes_memory_budget(node) and isdefined(node.inputs.memory_gb)
+                if node.name in EPI_MEMORY_MODEL and not budgeted:
+                    in_file = getattr(node.inputs, EPI_MEMORY_MODEL[node.name][0])
+                    if isdefined(in_file):
+                        interface.estimated_memory_gb = estimate_node_memory_gb(
+                            node.name, in_file)
+
+                if self._profiles is not None:
+                    geometry = inputs_geometry(node.inputs.get())
+                    mem_gb, threads = self._profiles.predict(
+                        interface.__class__.__name__, node.name,
+                        [geometry_key(geometry)] if geometry else None)
+                    if mem_gb is not None and not budgeted:
+                        interface.estimated_memory_gb = mem_gb
+                    if threads is not None and \
+                            'num_threads' not in node.inputs.trait_names():
+                        interface.num_threads = min(threads, self.processors)
+            except Exception as exc:  # pylint: disable=W0703
+                LOGGER.debug('Keeping the resource estimates of %s (%s)', node._id, exc)
+
+        if interface.estimated_memory_gb > self.memory_gb:
+            LOGGER.warning('Node %s is estimated to need %.2fGB, but only %.2fGB are '
+                           'available', node._id, interface.estimated_memory_gb,
+                           self.memory_gb)
+            interface.estimated_memory_gb = self.memory_gb
+
+    def _allot_threads(self, jobids):
+        """
+        Shares the free processors among the ready jobs: single-threaded
+        jobs get one each, the jobs that can use more threads get (at least)
+        the minimum they requested (see :func:`min_threads`), and the
+        processors left go to the jobs on the longest paths first, up to the
+        number they requested. Jobs whose minimum does not fit wait for
+        processors to be freed.
+        """
+        running = np.flatnonzero((self.proc_pending == True) &  # pylint: disable=C0121
+                                 (self.depidx.sum(axis=0) == 0).__array__())
+        free_processors = self.processors - sum(
+            self.procs[jobid]._interface.num_threads for jobid in running)
+
+        elastic = sorted([jobid for jobid in jobids if self._max_threads[jobid] > 1],
+                         key=lambda jobid: (-self._priority[jobid], jobid))
+        if not elastic:
+            return
+
+        spare = free_processors - (len(jobids) - len(elastic)) - sum(
+            self._min_threads[jobid] for jobid in elastic)
+        for jobid in elastic:
+            extra = max(0, min(self._max_threads[jobid] - self._min_threads[jobid], spare))
+            self.procs[jobid]._interface.num_threads = self._min_threads[jobid] + extra
+            spare -= extra
@@ -0,0 +1,383 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Reading and writing of NIfTI files with bounded memory, and block-parallel
+gzip compression.
+
+The compression level of the files written by fmriprep is read from the
+``FMRIPREP_GZIP_LEVEL`` environment variable (``--gzip-level``), and
+compression uses as many threads as allotted to the node running it
+(``OMP_NUM_THREADS``, see :func:`fmriprep.utils.multiproc.run_node`).
+
+Volumes of compressed series can be read in any order with
+:class:`VolumeReader`, which seeks through an index of the gzip stream
+(kept in a cache folder, if given) instead of decompressing the file from
+its start. The index requires the optional ``indexed_gzip`` package.
+
+With ``--work-uncompressed`` (``FMRIPREP_WORK_UNCOMPRESSED``), the images
+written in the working directory are plain ``.nii`` files (see
+:func:`work_file`), and only the derivatives are compressed.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import gzip
+import hashlib
+import os
+import os.path as op
+import struct
+import time
+import zlib
+from multiprocessing.pool import ThreadPool
+from tempfile import mkstemp
+
+import numpy as np
+import nibabel as nb
+from nibabel.openers import ImageOpener
+
+
+def _has_scaling(dataobj):
+    return dataobj.slope != 1.0 or dataobj.inter != 0.0
+
+
+def iter_volumes(in_file):
+    """
+    Yields the (scaled) 3D volumes of a NIfTI image one at a time, reading
+    the file sequentially (compressed files are decompressed only once)
+    """
+    nii = nb.load(in_file)
+    # The scaling and offset of the data are kept by the array proxy
+    dataobj = nii.dataobj
+    shape = tuple(dataobj.shape) + (1,)
+    dtype = nii.header.get_data_dtype()
+    nbytes = int(np.prod(shape[:3])) * dtype.itemsize
+
+    with ImageOpener(nii.file_map['image'].filename, 'rb') as fobj:
+        fobj.seek(int(dataobj.offset))
+        for _ in range(int(np.prod(shape[3:]))):
+            volume = np.frombuffer(fobj.read(nbytes), dtype=dtype).reshape(
+                shape[:3], order='F')
+            if _has_scaling(dataobj):
+                volume = volume * dataobj.slope + dataobj.inter
+            yield volume
+
+
+def _index_key(in_file):
+    """Key of the gzip index of a file, invalidated if the file changes"""
+    stat = os.stat(in_file)
+    return hashlib.sha1(('%s:%d:%d' % (op.realpath(in_file), stat.st_size,
+                                       int(stat.st_mtime))).encode()).hexdigest()
+
+
+def open_indexed(in_file, index_dir=None):
+    """
+    Opens a (possibly compressed) file for random access. The seek points of
+    compressed files are indexed, and the index is stored in (and reused
+    from) ``index_dir``, if given. Without ``indexed_gzip``, seeking
+    backwards decompresses the file from its start.
+    """
+    if not in_file.endswith('.gz'):
+        return open(in_file, 'rb')
+
+    try:
+        from indexed_gzip import IndexedGzipFile
+    except ImportError:
+        return gzip.open(in_file, 'rb')
+
+    gzfile = IndexedGzipFile(filename=in_file)
+    if index_dir is None:
+        return gzfile
+
+    from fmriprep.utils.cache import FileCache
+    from fmriprep.utils.misc import make_folder
+    cache, key = FileCache(index_dir), _index_key(in_file)
+    index_file = cache.path(key, '.gzidx')
+    if op.isfile(index_file):
+        gzfile.import_index(filename=index_file)
+        return gzfile
+
+    gzfile.build_full_index()
+    make_folder(op.dirname(index_file))
+    fdesc, tmp_file = mkstemp(dir=op.dirname(index_file), suffix='.tmp')
+    os.close(fdesc)
+    try:
+        gzfile.export_index(filename=tmp_file)
+        cache.put(key, tmp_file, '.gzidx')
+    finally:
+        os.remove(tmp_file)
+    return gzfile
+
+
+class VolumeReader(object):
+    """
+    Random access to the (scaled) 3D volumes of a NIfTI image: ``reader[k]``
+    reads volume ``k`` only. Compressed files are opened with
+    :func:`open_indexed`.
+    """
+
+    def __init__(self, in_file, index_dir=None):
+        nii = nb.load(in_file)
+        # The scaling and offset of the data are kept by the array proxy
+        self._dataobj = nii.dataobj
+        shape = tuple(nii.shape) + (1,)
+        self.affine = nii.affine
+        self.header = nii.header
+        self.shape = shape[:3]
+        self.dtype = nii.header.get_data_dtype()
+        self.nvols = int(np.prod(shape[3:]))
+        self._nbytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        self._fobj = open_indexed(nii.file_map['image'].filename, index_dir)
+
+    def __len__(self):
+        return self.nvols
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.nvols
+        if not 0 <= index < self.nvols:
+            raise IndexError('volume %d out of range (%d volumes)' % (index, self.nvols))
+        self._fobj.seek(int(self._dataobj.offset) + index * self._nbytes)
+        volume = np.frombuffer(self._fobj.read(self._nbytes), dtype=self.dtype).reshape(
+            self.shape, order='F')
+        if _has_scaling(self._dataobj):
+            volume = volume * self._dataobj.slope + self._dataobj.inter
+        return volume
+
+    def close(self):
+        """Closes the image file"""
+        self._fobj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+#: Environment variable holding the gzip compression level
+COMPRESSION_VARIABLE = 'FMRIPREP_GZIP_LEVEL'
+
+#: Default gzip compression level (as nibabel's)
+DEFAULT_COMPRESSION = 6
+
+#: Size of the blocks compressed independently by each thread
+GZIP_BLOCKSIZE = 1 << 21
+
+
+#: Environment variable set when intermediate images are not compressed
+UNCOMPRESSED_VARIABLE = 'FMRIPREP_WORK_UNCOMPRESSED'
+
+
+def work_uncompressed():
+    """Whether the images in the working directory are written uncompressed"""
+    return os.getenv(UNCOMPRESSED_VARIABLE, '0') not in ('', '0')
+
+
+def work_file(fname):
+    """
+    Name of an intermediate image: ``fname`` (e.g., ``merged.nii.gz``), with
+    the ``.gz`` extension removed when working uncompressed
+    """
+    if work_uncompressed() and fname.endswith('.nii.gz'):
+        return fname[:-3]
+    return fname
+
+
+def compression_level():
+    """gzip compression level of the files written by fmriprep"""
+    return int(os.getenv(COMPRESSION_VARIABLE, DEFAULT_COMPRESSION))
+
+
+def compression_threads():
+    """Number of threads compressing files (those allotted to the node)"""
+    try:
+        return max(1, int(os.getenv('OMP_NUM_THREADS', 1)))
+    except ValueError:
+        return 1
+
+
+def _deflate(args):
+    block, level, last = args
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    # A full flush ends each block on a byte boundary, so blocks can be
+    # concatenated into a single deflate stream
+    return compressor.compress(block) + compressor.flush(
+        zlib.Z_FINISH if last else zlib.Z_FULL_FLUSH)
+
+
+def _read_blocks(fobj, blocksize):
+    """Yields the blocks of a file, and whether each is the last one"""
+    block = fobj.read(blocksize)
+    while True:
+        next_block = fobj.read(blocksize)
+        yield block, not next_block
+        if not next_block:
+            return
+        block = next_block
+
+
+def gzip_file(in_file, out_file, compresslevel=None, num_threads=None,
+              blocksize=GZIP_BLOCKSIZE):
+    """
+    Compresses ``in_file`` into ``out_file``, splitting it into blocks that
+    are compressed in parallel (as ``pigz``). The output is a standard,
+    single-member gzip file.
+    """
+    if compresslevel is None:
+        compresslevel = compression_level()
+    if num_threads is None:
+        num_threads = compression_threads()
+
+    pool = ThreadPool(num_threads) if num_threads > 1 else None
+    mapper = pool.map if pool is not None else map
+    crc, size = 0, 0
+    try:
+        with open(in_file, 'rb') as src, open(out_file, 'wb') as dst:
+            # Header: magic, deflate, no flags, mtime, no extra flags, unknown OS
+            dst.write(b'\x1f\x8b\x08\x00' + struct.pack('<I', int(time.time())) +
+                      b'\x00\xff')
+            batch = []
+            for block, last in _read_blocks(src, blocksize):
+                batch.append((block, compresslevel, last))
+                if not last and len(batch) < 2 * num_threads:
+                    continue
+                for (block, _, _), deflated in zip(batch, mapper(_deflate, batch)):
+                    crc = zlib.crc32(block, crc)
+                    size += len(block)
+                    dst.write(deflated)
+                batch = []
+            dst.write(struct.pack('<II', crc & 0xffffffff, size & 0xffffffff))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return out_file
+
+
+def save_nii(nii, out_file, compresslevel=None, num_threads=None):
+    """
+    Writes a NIfTI image. Compressed files (``.gz``) are first written
+    uncompressed, then compressed with :func:`gzip_file`.
+    """
+    if not out_file.endswith('.gz'):
+        nii.to_filename(out_file)
+        return out_file
+
+    fdesc, raw_file = mkstemp(dir=op.dirname(op.abspath(out_file)), suffix='.nii')
+    os.close(fdesc)
+    try:
+        nii.to_filename(raw_file)
+        gzip_file(raw_file, out_file, compresslevel=compresslevel, num_threads=num_threads)
+    finally:
+        os.remove(raw_file)
+    return out_file
+
+
+class SeriesWriter(object):
+    """
+    Writes a NIfTI series one volume at a time, given its complete
+    ``header`` (shape, data type, affine). The data are streamed to an
+    uncompressed file, compressed when the writer is closed if ``out_file``
+    ends with ``.gz``.
+    """
+
+    def __init__(self, out_file, header, compresslevel=None):
+        self.out_file = out_file
+        self.compresslevel = compresslevel
+        self.header = nb.Nifti1Header.from_header(header)
+        self.header['magic'] = self.header.single_magic
+        self.header.set_slope_inter(1.0, 0.0)
+        del self.header.extensions[:]
+        self.header['vox_offset'] = 0
+        self._dtype = self.header.get_data_dtype()
+
+        self._raw_file = out_file
+        if out_file.endswith('.gz'):
+            fdesc, self._raw_file = mkstemp(dir=op.dirname(op.abspath(out_file)),
+                                            suffix='.nii')
+            os.close(fdesc)
+        self._fobj = open(self._raw_file, 'wb')
+        self.header.write_to(self._fobj)
+        self._fobj.write(b'\x00' * (int(self.header['vox_offset']) - self._fobj.tell()))
+        self._memmap = None
+
+    def write(self, volume):
+        """Appends a volume (or a chunk of volumes, along the last axis)"""
+        self._fobj.write(np.asanyarray(volume).astype(self._dtype).tobytes(order='F'))
+
+    def memmap(self, shape):
+        """
+        Maps the data of the output to an array of ``shape`` (e.g., the
+        grid and the number of volumes), so that it can be written in any
+        order, e.g. by tiles
+        """
+        offset = int(self.header['vox_offset'])
+        self._fobj.truncate(offset + int(np.prod(shape)) * self._dtype.itemsize)
+        self._fobj.flush()
+        self._memmap = np.memmap(self._raw_file, dtype=self._dtype, mode='r+',
+                                 offset=offset, shape=tuple(shape), order='F')
+        return self._memmap
+
+    def close(self):
+        """Finishes the file (compressing it, if needed) and returns its name"""
+        if self._memmap is not None:
+            self._memmap.flush()
+            self._memmap = None
+        self._fobj.close()
+        if self._raw_file != self.out_file:
+            try:
+                gzip_file(self._raw_file, self.out_file, compresslevel=self.compresslevel)
+            finally:
+                os.remove(self._raw_file)
+        return self.out_file
+
+    def discard(self):
+        """Closes and removes the partial file"""
+        self._memmap = None
+        self._fobj.close()
+        if op.exists(self._raw_file):
+            os.remove(self._raw_file)
+
+
+def concat_volumes(in_files, out_file, compresslevel=None):
+    """
+    Concatenates 3D or 4D NIfTI images along the fourth dimension, as
+    :func:`nibabel.funcs.concat_images`, but streaming one volume at a time
+    to the output (see :class:`SeriesWriter`). Only the headers of the
+    inputs are loaded beforehand, so the peak memory is that of a single
+    volume.
+
+    The output has the affine and header of the first image. Its data type
+    is that of the inputs, or float32 if any of them is scaled.
+    """
+    images = [nb.load(in_file) for in_file in in_files]
+    shape = tuple(images[0].shape[:3])
+    nvols = 0
+    for in_file, nii in zip(in_files, images):
+        in_shape = tuple(nii.shape) + (1,)
+        if tuple(in_shape[:3]) != shape:
+            raise ValueError('%s has shape %s, expected %s' % (in_file, in_shape[:3], shape))
+        nvols += int(np.prod(in_shape[3:]))
+
+    if any(_has_scaling(nii.dataobj) for nii in images):
+        dtype = np.dtype(np.float32)
+    else:
+        dtype = np.result_type(*[nii.header.get_data_dtype() for nii in images])
+
+    first = images[0]
+    header = nb.Nifti1Header.from_header(first.header)
+    header.set_data_shape(shape + (nvols,))
+    header.set_data_dtype(dtype)
+    header.set_qform(first.affine, int(header['qform_code']) or 1)
+    header.set_sform(first.affine, int(header['sform_code']) or 1)
+
+    writer = SeriesWriter(out_file, header, compresslevel=compresslevel)
+    try:
+        for in_file in in_files:
+            for volume in iter_volumes(in_file):
+                writer.write(volume)
+    except BaseException:
+        writer.discard()
+        raise
+    return writer.close()
@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Capacity planning (``--plan``): estimates the resources a workflow will need
+without running it.
+
+The workflow is expanded as nipype would do before running it (iterables),
+and MapNodes into their subnodes (see :data:`MAPNODE_SIZES`). The expanded jobs are then scheduled on a simulated MultiProc
+plugin, using the same memory and duration estimates as
+:class:`~fmriprep.utils.multiproc.MultiProcPlugin`, to predict the peak
+memory in use and the makespan. Disk footprints are computed from the
+geometry of the inputs, with the models below.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import heapq
+from copy import deepcopy
+
+import networkx as nx
+import numpy as np
+
+from nipype.interfaces.base import Undefined, isdefined
+from nipype.pipeline.engine import MapNode
+from nipype.pipeline.engine.utils import generate_expanded_graph, _get_valid_pathstr
+
+from fmriprep.utils.nifti import work_uncompressed
+from fmriprep.utils.resources import (
+    EPI_MEMORY_MODEL, bottom_levels, estimate_duration,
+    image_geometry, model_memory_gb, resampled_geometry)
+
+#: Number of subnodes of the MapNodes of the workflow
+MAPNODE_SIZES = {
+    'tpms_mni_warp': 3,
+    'T1Registration': 3,
+}
+
+#: Images written to the working directory by the largest nodes: the space
+#: of the images (``bold``: a BOLD run, ``bold_t1``: a BOLD run resampled to
+#: the T1w grid, ``mni``: a BOLD run resampled to the template grid,
+#: ``mni_grid``: a single volume of that grid, ``t1``: the T1w image,
+#: ``template``: the template), the number of copies and the bytes per voxel
+WORK_DISK_MODEL = {
+    'EPI_hmc': ('bold', 1, 4),
+    # the three components of the composed displacement field
+    'ComposeTransforms': ('mni_grid', 3, 4),
+    'MergeT1s': ('t1', 1, 4),
+    'Reorient': ('t1', 1, 4),
+    'CorrectINU': ('t1', 1, 4),
+    'Segmentation': ('t1', 5, 4),
+    'T1_2_MNI_Registration': ('template', 5, 4),
+    'tpms_mni_warp': ('template', 3, 4),
+    'brain_mni_warp': ('template', 1, 4),
+}
+
+#: Images written to the output directory by the data sinks (see
+#: :data:`WORK_DISK_MODEL`)
+DERIVATIVES_DISK_MODEL = {
+    'DerivativesHMC': ('bold', 1, 4),
+    'DerivHMC_SBRef': ('bold', 1, 4),
+    'DerivUnwarp_EPUnwarp_EPI': ('bold', 1, 4),
+    'DerivativesHMCT1': ('bold_t1', 1, 4),
+    'DerivativesHMCMNI': ('mni', 1, 4),
+    'DerivT1_inu': ('t1', 1, 4),
+    'DerivT1_seg': ('t1', 1, 1),
+    'DerivT1_mask': ('t1', 1, 1),
+    'DerivT1_TPMs': ('t1', 3, 4),
+    'DerivT1w_MNI': ('template', 1, 4),
+    'DerivT1_Mask_MNI': ('template', 1, 1),
+    'DerivT1_TPMs_MNI': ('template', 3, 4),
+    'mni_warp': ('template', 3, 4),
+}
+
+#: Data sinks of the series resampled by the ResampleToSpaces nodes
+#: (``EPIapplyXFM`` and ``EPIToMNITransform``), each of which also leaves
+#: its series in the working directory
+RESAMPLED_SINKS = ['DerivativesHMC', 'DerivHMC_SBRef', 'DerivativesHMCT1',
+                   'DerivativesHMCMNI']
+
+#: Ratio of the size of gzipped images to their uncompressed size
+GZIP_RATIO = 0.5
+
+
+def expanded_graph(workflow):
+    """
+    The execution graph of ``workflow``, with iterables expanded, as
+    generated by :meth:`nipype.pipeline.engine.Workflow.run`
+    """
+    flatgraph = workflow._create_flat_graph()  # pylint: disable=W0212
+    return generate_expanded_graph(deepcopy(flatgraph))
+
+
+class _GeometryCache(object):
+    """Reads the geometry of each image only once"""
+
+    def __init__(self):
+        self._geometries = {}
+
+    def get(self, in_file):
+        if isinstance(in_file, (list, tuple)):
+            in_file = in_file[0]
+        if in_file not in self._geometries:
+            try:
+                self._geometries[in_file] = image_geometry(in_file)
+            except Exception:  # pylint: disable=W0703
+                self._geometries[in_file] = None
+        return self._geometries[in_file]
+
+
+def _node_context(node, sources, geometries, template):
+    """
+    Finds the geometries of the images a node works on: the BOLD run (if
+    the node belongs to the processing of one run), the same run resampled
+    to the T1w image and to the template, the T1w image and the template
+    """
+    context = {'bold': None, 'bold_t1': None, 'mni': None, 'mni_grid': None,
+               't1': None, 'template': None}
+    if template is not None:
+        context['template'] = geometries.get(template)
+
+    subject_data = None
+    for hierarchy, data in list(sources.items()):
+        if node._hierarchy.startswith(hierarchy):  # pylint: disable=W0212
+            subject_data = data
+            break
+    if subject_data is None:
+        return context
+
+    if subject_data.get('t1w'):
+        context['t1'] = geometries.get(subject_data['t1w'])
+
+    parameterization = ''.join(node.parameterization or [])
+    for bold in subject_data.get('func', []):
+        if _get_valid_pathstr(bold) in parameterization:
+            context['bold'] = geometries.get(bold)
+            break
+
+    if context['bold'] is not None:
+        context['mni'] = context['bold']
+        if template is not None:
+            context['mni'] = resampled_geometry(context['bold'], template)
+        context['mni_grid'] = dict(context['mni'], nvols=1)
+        if context['t1'] is not None:
+            t1w = subject_data['t1w']
+            context['bold_t1'] = resampled_geometry(
+                context['bold'], t1w[0] if isinstance(t1w, (list, tuple)) else t1w)
+    return context
+
+
+def _disk_gb(model, context, compressed=True):
+    """Size (GB) of the images described by ``model`` (see :data:`WORK_DISK_MODEL`)"""
+    space, copies, itemsize = model
+    geometry = context[space]
+    if geometry is None:
+        return 0.0
+    nvoxels = np.prod(geometry['shape'], dtype=np.float64) * geometry['nvols']
+    ratio = GZIP_RATIO if compressed else 1.0
+    return ratio * copies * itemsize * nvoxels / (1024.0 ** 3)
+
+
+def simulate_schedule(jobs, children, n_procs, memory_gb):
+    """
+    Simulates the scheduling of ``jobs`` (topologically sorted dictionaries
+    with ``duration``, ``threads`` and ``mem_gb``) as done by
+    :class:`~fmriprep.utils.multiproc.MultiProcPlugin`: ready jobs by
+    decreasing critical path, as long as they fit in the free resources.
+    Returns the makespan (seconds) and the peak memory in use (GB).
+    """
+    priority = bottom_levels([job['duration'] for job in jobs], children)
+    nparents = [0] * len(jobs)
+    for jobid in range(len(jobs)):
+        for child in children[jobid]:
+            nparents[child] += 1
+
+    ready = [jobid for jobid in range(len(jobs)) if nparents[jobid] == 0]
+    running = []
+    now = 0.0
+    free_procs, free_mem = n_procs, memory_gb
+    peak_mem = 0.0
+    while ready or running:
+        ready.sort(key=lambda jobid: -priority[jobid])
+        waiting = []
+        for jobid in ready:
+            threads = min(jobs[jobid]['threads'], n_procs)
+            mem_gb = min(jobs[jobid]['mem_gb'], memory_gb)
+            if threads <= free_procs and mem_gb <= free_mem:
+                free_procs -= threads
+                free_mem -= mem_gb
+                heapq.heappush(running, (now + jobs[jobid]['duration'], jobid, threads, mem_gb))
+            else:
+                waiting.append(jobid)
+        ready = waiting
+        peak_mem = max(peak_mem, memory_gb - free_mem)
+
+        now, jobid, threads, mem_gb = heapq.heappop(running)
+        free_procs += threads
+        free_mem += mem_gb
+        for child in children[jobid]:
+            nparents[child] -= 1
+            if nparents[child] == 0:
+                ready.append(child)
+
+    return now, peak_mem
+
+
+def plan_workflow(workflow, n_procs, memory_gb, profiles=None):
+    """
+    Estimates the resources needed to run ``workflow`` with ``n_procs``
+    processors and ``memory_gb`` of memory. Returns a dictionary with the
+    number of jobs (total and by node name), the CPU hours, the simulated
+    makespan (hours) and peak memory (GB), and the disk footprint (GB) of the
+    working and output directories.
+    """
+    durations, cpu_times = {}, {}
+    if profiles is not None:
+        durations = profiles.durations()
+        cpu_times = profiles.durations(column='cpu_time')
+
+    execgraph = expanded_graph(workflow)
+    nodes = list(nx.topological_sort(execgraph))
+
+    sources = {node._hierarchy: node.inputs.subject_data  # pylint: disable=W0212
+               for node in nodes if node.name == 'BIDSDatasource'}
+    template = None
+    for node in nodes:
+        if node.name == 'GenNewMNIReference':
+            template = node.inputs.fixed_image
+            break
+    geometries = _GeometryCache()
+
+    # Expand MapNodes into one job per subnode, followed by the MapNode itself
+    # (which collects the results of its subnodes)
+    jobs, children, node_inputs, node_outputs = [], [], {}, {}
+    job_counts = {}
+    work_gb, derivatives_gb = 0.0, 0.0
+    for node in nodes:
+        context = _node_context(node, sources, geometries, template)
+        interface = node._interface  # pylint: disable=W0212
+
+        mem_gb = interface.estimated_memory_gb
+        # Nodes given a memory budget (e.g. --resample-mem-gb) are reserved it
+        budgeted = isdefined(getattr(node.inputs, 'memory_gb', Undefined))
+        if node.name in EPI_MEMORY_MODEL and context['bold'] is not None and not budgeted:
+            _, copies, itemsize = EPI_MEMORY_MODEL[node.name]
+            mem_gb = model_memory_gb(context['bold'], copies, itemsize)
+
+        numjobs = 1
+        duration = estimate_duration(node, durations)
+        if isinstance(node, MapNode):
+            numjobs = MAPNODE_SIZES.get(node.name, 1)
+
+        key = (interface.__class__.__name__, node.name)
+        cpu_time = cpu_times.get(key, duration * interface.num_threads)
+
+        node_inputs[node] = list(range(len(jobs), len(jobs) + numjobs))
+        for _ in range(numjobs):
+            jobs.append({'duration': duration, 'threads': interface.num_threads,
+                         'mem_gb': mem_gb, 'cpu_time': cpu_time})
+            children.append([])
+        node_outputs[node] = node_inputs[node]
+        if numjobs > 1:
+            for jobid in node_inputs[node]:
+                children[jobid].append(len(jobs))
+            node_outputs[node] = [len(jobs)]
+            jobs.append({'duration': 0.0, 'threads': 0, 'mem_gb': 0.0, 'cpu_time': 0.0})
+            children.append([])
+        job_counts[node.name] = job_counts.get(node.name, 0) + numjobs
+
+        if node.name in WORK_DISK_MODEL:
+            work_gb += _disk_gb(WORK_DISK_MODEL[node.name], context,
+                                compressed=not work_uncompressed())
+        if node.name in RESAMPLED_SINKS:
+            work_gb += _disk_gb(DERIVATIVES_DISK_MODEL[node.name], context,
+                                compressed=not work_uncompressed())
+        if node.name in DERIVATIVES_DISK_MODEL:
+            derivatives_gb += _disk_gb(DERIVATIVES_DISK_MODEL[node.name], context)
+
+    for src, dst in execgraph.edges():
+        for jobid in node_outputs[src]:
+            children[jobid] += node_inputs[dst]
+
+    makespan, peak_memory_gb = simulate_schedule(jobs, children, n_procs, memory_gb)
+    return {
+        'nodes': len(nodes),
+        'jobs': sum(job_counts.values()),
+        'jobs_by_node': job_counts,
+        'cpu_hours': sum(job['cpu_time'] for job in jobs) / 3600.,
+        'makespan_hours': makespan / 3600.,
+        'peak_memory_gb': peak_memory_gb,
+        'work_dir_gb': work_gb,
+        'derivatives_gb': derivatives_gb,
+        'n_procs': n_procs,
+        'memory_gb': memory_gb,
+    }
+
+
+def format_plan(plan):
+    """Formats the results of :func:`plan_workflow` as a report"""
+    lines = [
+        'Execution plan (%d processors, %.1f GB of memory)' % (
+            plan['n_procs'], plan['memory_gb']),
+        '  Nodes: %d (%d jobs once MapNodes are expanded)' % (plan['nodes'], plan['jobs']),
+        '  Estimated CPU time: %.1f CPU-hours' % plan['cpu_hours'],
+        '  Estimated duration: %.1f hours' % plan['makespan_hours'],
+        '  Peak memory in use: %.1f GB' % plan['peak_memory_gb'],
+        '  Working directory: %.1f GB' % plan['work_dir_gb'],
+        '  Derivatives: %.1f GB' % plan['derivatives_gb'],
+        '  Largest expansions:',
+    ]
+    largest = sorted(list(plan['jobs_by_node'].items()), key=lambda item: (-item[1], item[0]))
+    lines += ['    %s: %d jobs' % item for item in largest[:10]]
+    return '\n'.join(lines)
@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Estimation of the resources required by the nodes of the workflow.
+
+Memory estimates are computed from the NIfTI headers (shape and data type)
+of the images each node loads, so they do not depend on how well the
+files compress on disk. Those estimates are superseded by the resources
+measured in previous runs, when available (see :class:`ResourceProfiles`).
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os.path as op
+import sqlite3
+
+from builtins import str as string_types  # pylint: disable=W0622
+import numpy as np
+import nibabel as nb
+
+#: Baseline memory (GB) of any node (interpreter, libraries, etc.)
+BASE_MEMORY_GB = 0.25
+
+#: Memory model of the nodes that load whole BOLD series. For each node
+#: name: the input holding the series, how many copies of it the node keeps
+#: in memory and the bytes per voxel of those copies.
+EPI_MEMORY_MODEL = {
+    # MCFLIRT keeps the input and the corrected series as float32
+    'EPI_hmc': ('in_file', 3, 4),
+    # nipype's compute_dvars works on several float32 copies
+    'ComputeDVARS': ('in_file', 4, 4),
+    # CompCor loads, masks and detrends the series in float64
+    'tCompCor': ('realigned_file', 3, 8),
+    'aCompCor': ('realigned_file', 3, 8),
+    # nilearn loads the series as float64
+    'SignalExtraction': ('in_file', 2, 8),
+    # resampling works by tiles within its memory (see ResampleToSpaces),
+    # which is sized to hold a float32 copy of the series
+    'EPIapplyXFM': ('in_file', 1, 4),
+    'EPIToMNITransform': ('in_file', 1, 4),
+}
+
+#: Typical wall time (seconds) of the longest nodes, used to find the
+#: critical path of the workflow when they have not been profiled yet
+NODE_DURATIONS = {
+    'T1_2_MNI_Registration': 3600.,
+    'Ants_T1_Brain_Extraction': 2400.,
+    'Segmentation': 600.,
+    'CorrectINU': 300.,
+    'EPI_hmc': 600.,
+    'flt_bbr': 300.,
+    'flt_bbr_init': 120.,
+    'tCompCor': 120.,
+    'aCompCor': 120.,
+    'ComputeDVARS': 120.,
+    'ComposeTransforms': 60.,
+    'EPIapplyXFM': 120.,
+    'EPIToMNITransform': 300.,
+}
+
+#: Wall time (seconds) assumed for any other node
+DEFAULT_NODE_DURATION = 10.
+
+
+def image_geometry(in_file):
+    """
+    Returns the shape (first three dimensions), number of volumes and voxel
+    size of an image, reading only its header.
+
+    If ``in_file`` is a list of files (e.g., 3D volumes to be merged), the
+    number of volumes is accumulated over the list.
+    """
+    if isinstance(in_file, (list, tuple)):
+        geometries = [image_geometry(fname) for fname in in_file]
+        geometry = dict(geometries[0])
+        geometry['nvols'] = sum(geom['nvols'] for geom in geometries)
+        return geometry
+
+    header = nb.load(in_file).header
+    shape = tuple(header.get_data_shape()) + (1, 1, 1, 1)
+    return {
+        'shape': tuple(int(dim) for dim in shape[:3]),
+        'nvols': int(np.prod(shape[3:])),
+        'zooms': tuple(float(zoom) for zoom in header.get_zooms()[:3]),
+    }
+
+
+def resampled_geometry(geometry, template):
+    """
+    Returns the geometry of ``geometry``'s series once resampled to the field
+    of view of ``template`` at the original voxel size (as in
+    :func:`fmriprep.workflows.epi._gen_reference`)
+    """
+    template_geom = image_geometry(template)
+    fov = np.array(template_geom['shape']) * np.array(template_geom['zooms'])
+    shape = np.ceil(fov / np.array(geometry['zooms'])).astype(int)
+    resampled = dict(geometry)
+    resampled['shape'] = tuple(int(dim) for dim in shape)
+    return resampled
+
+
+def model_memory_gb(geometry, copies, itemsize):
+    """Memory required to hold ``copies`` of a series of ``geometry``"""
+    nvoxels = np.prod(geometry['shape'], dtype=np.float64) * geometry['nvols']
+    return BASE_MEMORY_GB + copies * itemsize * nvoxels / (1024.0 ** 3)
+
+
+def estimate_memory_gb(geometries, node_name, template=None):
+    """
+    Estimates the memory (GB) node ``node_name`` needs to process any of the
+    BOLD runs described in ``geometries`` (see :func:`image_geometry`). If
+    ``template`` is given, the node works on the runs resampled to it.
+
+    Nodes that iterate over runs are deep-copied by nipype and share this
+    build-time value, so the largest run is used here. The
+    :class:`~fmriprep.utils.multiproc.MultiProcPlugin` refines it for each
+    run with :func:`estimate_node_memory_gb` before dispatching.
+    """
+    _, copies, itemsize = EPI_MEMORY_MODEL[node_name]
+    estimates = [BASE_MEMORY_GB]
+    for geometry in geometries:
+        if template is not None:
+            geometry = resampled_geometry(geometry, template)
+        estimates.append(model_memory_gb(geometry, copies, itemsize))
+    return max(estimates)
+
+
+def estimate_node_memory_gb(node_name, in_file):
+    """
+    Estimates the memory (GB) node ``node_name`` needs given the actual
+    file(s) connected to its series input
+    """
+    _, copies, itemsize = EPI_MEMORY_MODEL[node_name]
+    return model_memory_gb(image_geometry(in_file), copies, itemsize)
+
+
+def estimate_duration(node, durations=None):
+    """
+    Estimates the wall time (seconds) of a node, from the mean durations
+    recorded in previous runs (``durations``, see
+    :meth:`ResourceProfiles.durations`) or :data:`NODE_DURATIONS`
+    """
+    key = (node.interface.__class__.__name__, node.name)
+    if durations and key in durations:
+        return durations[key]
+    return NODE_DURATIONS.get(node.name, DEFAULT_NODE_DURATION)
+
+
+def bottom_levels(durations, children):
+    """
+    Length (seconds) of the longest path from each job to the end of the
+    workflow, including the job itself. Jobs must be topologically sorted,
+    ``children`` holds the indices of the dependents of each job.
+    """
+    levels = [0.0] * len(durations)
+    for jobid in reversed(range(len(durations))):
+        levels[jobid] = durations[jobid] + max(
+            [levels[child] for child in children[jobid]] or [0.0])
+    return levels
+
+
+def geometry_key(geometry):
+    """A string identifying a geometry, e.g. ``64x64x32x200``"""
+    return 'x'.join('%d' % dim for dim in geometry['shape'] + (geometry['nvols'],))
+
+
+def inputs_geometry(inputs):
+    """
+    Returns the geometry of the largest NIfTI file among the values of the
+    ``inputs`` dictionary, or ``None`` if there are no images
+    """
+    def _images(value):
+        if isinstance(value, (list, tuple)):
+            return [fname for item in value for fname in _images(item)]
+        if isinstance(value, string_types) and value.endswith(('.nii', '.nii.gz')) \
+                and op.isfile(value):
+            return [value]
+        return []
+
+    geometries = []
+    for value in list(inputs.values()):
+        for fname in _images(value):
+            try:
+                geometries.append(image_geometry(fname))
+            except Exception:  # pylint: disable=W0703
+                continue
+
+    if not geometries:
+        return None
+    return max(geometries, key=lambda geom: np.prod(geom['shape']) * geom['nvols'])
+
+
+class ResourceProfiles(object):
+    """
+    Store of the resources (peak memory, CPU and wall time) used by the
+    nodes of previous runs, kept in a SQLite file (by default in the log
+    directory). Profiles are keyed by interface type, node name and the
+    geometry of the largest image the node received.
+    """
+
+    #: Safety margin applied to the recorded peak memory
+    memory_margin = 1.2
+
+    def __init__(self, profiles_file):
+        self.profiles_file = profiles_file
+        conn = self._connect()
+        try:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS profiles (node_dir TEXT PRIMARY KEY, '
+                'interface TEXT, node TEXT, geometry TEXT, mem_gb REAL, '
+                'cpu_time REAL, wall_time REAL)')
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _connect(self):
+        # A new connection per call: the store is written from the thread
+        # collecting MultiProc results and may be shared by several processes
+        return sqlite3.connect(self.profiles_file, timeout=60)
+
+    def record(self, profile):
+        """Stores the profile of one node run (a dictionary)"""
+        conn = self._connect()
+        try:
+            conn.execute('INSERT OR REPLACE INTO profiles VALUES (?, ?, ?, ?, ?, ?, ?)', (
+                profile['node_dir'], profile['interface'], profile['node'],
+                profile['geometry'], profile['mem_gb'], profile['cpu_time'],
+                profile['wall_time']))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def durations(self, column='wall_time'):
+        """
+        Returns the mean wall time (or CPU time, if ``column`` is
+        ``'cpu_time'``) of each profiled node, as a dictionary indexed by
+        ``(interface, node)``
+        """
+        if column not in ('wall_time', 'cpu_time'):
+            raise ValueError('Unknown profile column "%s"' % column)
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                'SELECT interface, node, AVG(%s) FROM profiles '
+                'GROUP BY interface, node' % column).fetchall()
+        finally:
+            conn.close()
+        return {(row[0], row[1]): row[2] for row in rows if row[2] is not None}
+
+    def predict(self, interface, node, geometries=None):
+        """
+        Predicts the memory (GB) and number of threads of a node. Profiles
+        recorded with one of ``geometries`` are preferred; otherwise all
+        the profiles of the node are considered.
+        Returns ``(None, None)`` if the node was never profiled.
+        """
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                'SELECT geometry, mem_gb, cpu_time, wall_time FROM profiles '
+                'WHERE interface = ? AND node = ?', (interface, node)).fetchall()
+        finally:
+            conn.close()
+
+        if geometries:
+            matching = [row for row in rows if row[0] in geometries]
+            rows = matching or rows
+
+        if not rows:
+            return None, None
+
+        mem_gb = [row[1] for row in rows if row[1] is not None]
+        mem_gb = max(mem_gb) * self.memory_margin if mem_gb else None
+        threads = [row[2] / row[3] for row in rows if row[3]]
+        threads = max(1, int(np.ceil(np.mean(threads)))) if threads else None
+        return mem_gb, threads
+
+
+def apply_resource_profiles(workflow, profiles, geometries=None, max_threads=None):
+    """
+    Sets ``estimated_memory_gb`` and ``num_threads`` of all the nodes in
+    ``workflow`` that were profiled in previous runs. The number of threads
+    of interfaces that take it as an input (e.g. ANTs) is left untouched.
+    """
+    if geometries is not None:
+        geometries = [geometry_key(geometry) for geometry in geometries]
+
+    for name in workflow.list_node_names():
+        node = workflow.get_node(name)
+        mem_gb, threads = profiles.predict(
+            node.interface.__class__.__name__, node.name, geometries)
+
+        if mem_gb is not None:
+            node.interface.estimated_memory_gb = max(mem_gb, BASE_MEMORY_GB)
+        if threads is not None and 'num_threads' not in node.inputs.trait_names():
+            if max_threads:
+                threads = min(threads, max_threads)
+            node.interface.num_threads = threads
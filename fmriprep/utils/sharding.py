@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Splitting of the participants of a dataset among the jobs of an array
+(shards), so that each job of e.g. a SLURM or SGE array processes its own
+subset of subjects.
+
+Subjects are assigned to shards deterministically, balancing the estimated
+cost of each subject (the size of its BOLD runs) rather than their number.
+Lock files in the working directory ensure that two shards sharing it
+never process the same subject.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+import os.path as op
+
+from lockfile import LockFile, LockError
+import numpy as np
+
+from fmriprep.utils.bids_index import get_bids_index
+from fmriprep.utils.misc import make_folder
+from fmriprep.utils.resources import image_geometry
+
+#: Cost of processing the anatomical data of a subject, in BOLD voxels
+#: (about one run of 64x64x32 voxels and 200 volumes)
+ANAT_COST = 64 * 64 * 32 * 200
+
+
+def _int_or_none(value):
+    if value in (None, '', 'undefined'):
+        return None
+    return int(value)
+
+
+def shard_from_environ(environ=None):
+    """
+    Reads the shard index (0-based) and count from the environment:
+    ``FMRIPREP_SHARD_INDEX`` and ``FMRIPREP_SHARD_COUNT``, or the variables
+    set by SLURM and SGE job arrays. Returns ``(None, None)`` if none is set,
+    and a count of ``None`` if the scheduler does not provide it.
+    """
+    if environ is None:
+        environ = os.environ
+
+    if _int_or_none(environ.get('FMRIPREP_SHARD_INDEX')) is not None:
+        return (int(environ['FMRIPREP_SHARD_INDEX']),
+                _int_or_none(environ.get('FMRIPREP_SHARD_COUNT')))
+
+    if _int_or_none(environ.get('SLURM_ARRAY_TASK_ID')) is not None:
+        first = _int_or_none(environ.get('SLURM_ARRAY_TASK_MIN')) or 0
+        step = _int_or_none(environ.get('SLURM_ARRAY_TASK_STEP')) or 1
+        return ((int(environ['SLURM_ARRAY_TASK_ID']) - first) // step,
+                _int_or_none(environ.get('SLURM_ARRAY_TASK_COUNT')))
+
+    if _int_or_none(environ.get('SGE_TASK_ID')) is not None:
+        first = _int_or_none(environ.get('SGE_TASK_FIRST')) or 1
+        step = _int_or_none(environ.get('SGE_TASK_STEPSIZE')) or 1
+        last = _int_or_none(environ.get('SGE_TASK_LAST'))
+        count = (last - first) // step + 1 if last is not None else None
+        return (int(environ['SGE_TASK_ID']) - first) // step, count
+
+    return None, None
+
+
+def subject_cost(dataset, subject, index_file=None):
+    """
+    Estimates the cost of processing a subject: a fixed cost for the
+    anatomical workflow plus the number of voxels (times volumes) of all
+    its BOLD runs, read from the NIfTI headers
+    """
+    cost = ANAT_COST
+    for bold in get_bids_index(dataset, index_file=index_file).get('epi', subject):
+        try:
+            geometry = image_geometry(bold)
+        except Exception:  # pylint: disable=W0703
+            # Unreadable headers will make the workflow fail anyways
+            continue
+        cost += int(np.prod(geometry['shape'])) * geometry['nvols']
+    return cost
+
+
+def assign_shards(costs, shard_count):
+    """
+    Splits the subjects in ``costs`` (a dictionary of subject: cost) into
+    ``shard_count`` lists of similar total cost, assigning the most costly
+    subjects first to the least loaded shard. Ties are broken by subject
+    label and shard index, so that all the jobs of the array compute the
+    same assignment.
+    """
+    shards = [[] for _ in range(shard_count)]
+    loads = [0] * shard_count
+    for subject in sorted(costs, key=lambda subj: (-costs[subj], subj)):
+        shard = min(range(shard_count), key=lambda idx: (loads[idx], idx))
+        shards[shard].append(subject)
+        loads[shard] += costs[subject]
+    return [sorted(shard) for shard in shards]
+
+
+def shard_subjects(dataset, subject_list, shard_index, shard_count, index_file=None):
+    """Returns the subjects of ``subject_list`` assigned to shard ``shard_index``"""
+    if not 0 <= shard_index < shard_count:
+        raise ValueError('Shard index %d is out of range for %d shards' % (
+            shard_index, shard_count))
+
+    costs = {subject: subject_cost(dataset, subject, index_file=index_file)
+             for subject in subject_list}
+    return assign_shards(costs, shard_count)[shard_index]
+
+
+class SubjectLocks(object):
+    """
+    Lock files (one per subject) in ``lock_dir``. Subjects locked by another
+    process are skipped. Use as a context manager to release the locks.
+
+    Jobs processing disjoint parts of a subject (e.g. different runs) lock
+    it with different ``scope`` labels.
+    """
+
+    def __init__(self, lock_dir, scope=None):
+        self.lock_dir = lock_dir
+        self.scope = scope
+        self._locks = []
+
+    def lock_file(self, subject):
+        """Path of the lock file of a subject"""
+        fname = 'sub-%s' % subject
+        if self.scope:
+            fname += '_' + self.scope
+        return op.join(self.lock_dir, fname)
+
+    def acquire(self, subject_list):
+        """Locks the subjects in ``subject_list`` and returns those that could be locked"""
+        make_folder(self.lock_dir)
+        locked = []
+        for subject in subject_list:
+            lock = LockFile(self.lock_file(subject))
+            try:
+                lock.acquire(timeout=0)
+            except LockError:
+                continue
+            self._locks.append(lock)
+            locked.append(subject)
+        return locked
+
+    def release(self):
+        """Releases all the locks held"""
+        while self._locks:
+            lock = self._locks.pop()
+            if lock.i_am_locking():
+                lock.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
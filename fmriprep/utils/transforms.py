@@ -0,0 +1,418 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Reading of ITK/ANTs transform files, and mapping of points through them.
+
+All the transforms are returned in the RAS world coordinates used by
+nibabel. As in ITK, they map points of the fixed (reference) space onto
+the moving image, i.e., they are the transforms used to resample the
+moving image onto the reference grid.
+
+FSL (FLIRT) matrices map the opposite way, between the scaled voxel
+coordinates of the images (see :func:`fsl_scaling`). They are converted to
+and from ITK affines using only the headers of the images, as
+``c3d_affine_tool`` and ``convert_xfm`` do.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import numpy as np
+import nibabel as nb
+from scipy import ndimage as ndi
+
+from fmriprep.utils.nifti import save_nii
+
+#: Flips between the LPS coordinates of ITK and RAS coordinates
+LPS = np.diag([-1., -1., 1., 1.])
+#: First bytes of the ITK transform files in text format
+ITK_TEXT_MAGIC = b'#Insight Transform File'
+
+
+def itk_affine(parameters, fixed_parameters):
+    """
+    RAS affine (4x4) of an ITK ``MatrixOffsetTransformBase`` (e.g.,
+    ``AffineTransform``), given its parameters (the 3x3 matrix and the
+    translation) and fixed parameters (the center of rotation), in LPS
+    """
+    parameters = np.asarray(parameters, dtype=np.float64)
+    center = np.asarray(fixed_parameters, dtype=np.float64)[:3]
+    matrix = parameters[:9].reshape(3, 3)
+    affine = np.eye(4)
+    affine[:3, :3] = matrix
+    affine[:3, 3] = parameters[9:12] + center - matrix.dot(center)
+    return LPS.dot(affine).dot(LPS)
+
+
+class DisplacementField(object):
+    """
+    A dense displacement field: ``field`` holds the RAS displacement (mm)
+    of each voxel of a grid with voxel-to-RAS ``affine``. Displacements are
+    linearly interpolated, and are zero outside the grid.
+    """
+
+    def __init__(self, field, affine):
+        self.field = np.asarray(field, dtype=np.float32)
+        self.affine = np.asarray(affine, dtype=np.float64)
+
+    @classmethod
+    def from_itk(cls, parameters, fixed_parameters):
+        """Builds the field of an ITK ``DisplacementFieldTransform``"""
+        fixed_parameters = np.asarray(fixed_parameters, dtype=np.float64)
+        size = fixed_parameters[:3].astype(int)
+        origin = fixed_parameters[3:6]
+        spacing = fixed_parameters[6:9]
+        direction = fixed_parameters[9:18].reshape(3, 3)
+
+        # ITK images are stored with x varying fastest
+        field = np.asarray(parameters, dtype=np.float32).reshape(
+            tuple(size[::-1]) + (3,)).transpose(2, 1, 0, 3)
+        field = field * LPS.diagonal()[:3].astype(np.float32)
+
+        affine = np.eye(4)
+        affine[:3, :3] = direction.dot(np.diag(spacing))
+        affine[:3, 3] = origin
+        return cls(field, LPS.dot(affine))
+
+    @classmethod
+    def from_nifti(cls, in_file):
+        """Reads a displacement field in the NIfTI format of ANTs"""
+        nii = nb.load(in_file)
+        field = np.asanyarray(nii.dataobj).reshape(nii.shape[:3] + (3,))
+        return cls(field * LPS.diagonal()[:3].astype(np.float32), nii.affine)
+
+    def to_nifti(self, out_file):
+        """
+        Writes the field in the NIfTI format of ANTs (LPS displacements,
+        5D vector image), readable by ``antsApplyTransforms``
+        """
+        field = self.field * LPS.diagonal()[:3].astype(np.float32)
+        nii = nb.Nifti1Image(field.reshape(field.shape[:3] + (1, 3)), self.affine)
+        nii.header.set_intent('vector', (), '')
+        nii.header.set_xyzt_units('mm')
+        return save_nii(nii, out_file)
+
+    def on_grid(self, shape, affine):
+        """Whether the field is defined on the grid of ``shape`` and ``affine``"""
+        return tuple(self.field.shape[:3]) == tuple(shape[:3]) and \
+            np.allclose(self.affine, affine, atol=1e-4)
+
+    def map_points(self, points):
+        """Maps the RAS ``points`` (an Nx3 array)"""
+        ras2vox = np.linalg.inv(self.affine)
+        coords = ras2vox[:3, :3].dot(points.T) + ras2vox[:3, 3:]
+        displacement = np.column_stack([
+            ndi.map_coordinates(self.field[..., axis], coords, order=1,
+                                mode='constant', cval=0.0)
+            for axis in range(3)])
+        return points + displacement
+
+
+def map_points(transform, points):
+    """Maps the RAS ``points`` (Nx3) through one transform (an affine or a field)"""
+    if isinstance(transform, DisplacementField):
+        return transform.map_points(points)
+    return points.dot(transform[:3, :3].T) + transform[:3, 3]
+
+
+def itk_parameters(affine):
+    """
+    Parameters (the 3x3 matrix and the translation, in LPS) of the ITK
+    ``MatrixOffsetTransformBase`` of a RAS affine, with a null center
+    (the inverse of :func:`itk_affine`)
+    """
+    affine = LPS.dot(affine).dot(LPS)
+    return np.hstack((affine[:3, :3].ravel(), affine[:3, 3]))
+
+
+def write_itk_affines(affines, out_file):
+    """
+    Writes RAS affines as an ITK text transform file, in the format of
+    ``c3d_affine_tool -oitk``. With several affines, the file lists them in
+    order (e.g., one per volume, see :func:`read_volume_transforms`).
+    """
+    with open(out_file, 'w') as tfm_file:
+        tfm_file.write('#Insight Transform File V1.0\n')
+        for i, affine in enumerate(affines):
+            tfm_file.write('#Transform %d\n' % i)
+            tfm_file.write('Transform: MatrixOffsetTransformBase_double_3_3\n')
+            tfm_file.write('Parameters: %s\n' % ' '.join(
+                '%.12g' % value for value in itk_parameters(affine)))
+            tfm_file.write('FixedParameters: 0 0 0\n')
+    return out_file
+
+
+def _itk_transform(kind, parameters, fixed_parameters):
+    kind = kind.split('_')[0]
+    if kind in ('AffineTransform', 'MatrixOffsetTransformBase'):
+        return itk_affine(parameters, fixed_parameters)
+    if kind == 'DisplacementFieldTransform':
+        return DisplacementField.from_itk(parameters, fixed_parameters)
+    raise NotImplementedError('ITK transform type "%s" is not supported' % kind)
+
+
+def _read_itk_text(in_file):
+    transforms = []
+    kind, parameters = None, None
+    with open(in_file) as tfm_file:
+        for line in tfm_file:
+            if line.startswith('Transform:'):
+                kind = line.split(':', 1)[1].strip()
+            elif line.startswith('Parameters:'):
+                parameters = [float(value) for value in line.split(':', 1)[1].split()]
+            elif line.startswith('FixedParameters:'):
+                fixed = [float(value) for value in line.split(':', 1)[1].split()]
+                if not kind.startswith('CompositeTransform'):
+                    transforms.append(_itk_transform(kind, parameters, fixed))
+    return transforms
+
+
+def _read_itk_mat(in_file):
+    from scipy.io import loadmat
+
+    matfile = loadmat(in_file)
+    return [_itk_transform(kind, matfile[kind].ravel(), matfile['fixed'].ravel())
+            for kind in sorted(matfile)
+            if not kind.startswith('__') and kind != 'fixed']
+
+
+def _is_itk_text(in_file):
+    with open(in_file, 'rb') as tfm_file:
+        return tfm_file.read(len(ITK_TEXT_MAGIC)) == ITK_TEXT_MAGIC
+
+
+def _read_itk_hdf5(in_file):
+    import h5py
+
+    transforms = []
+    with h5py.File(in_file, 'r') as h5file:
+        group = h5file['TransformGroup']
+        for key in sorted(group, key=int):
+            kind = group[key]['TransformType'][0]
+            if not isinstance(kind, str):
+                kind = kind.decode()
+            if kind.startswith('CompositeTransform'):
+                continue
+            transforms.append(_itk_transform(
+                kind, group[key]['TransformParameters'][()],
+                group[key]['TransformFixedParameters'][()]))
+    return transforms
+
+
+def read_itk_transforms(in_file):
+    """
+    Reads an ITK transform file, in text, binary MATLAB (e.g., the
+    ``0GenericAffine.mat`` of ``antsRegistration``) or HDF5 format (e.g., the
+    composite transforms written by ANTs), or a displacement field in NIfTI
+    format.
+    Returns the list of transforms in the order they map points, i.e., the
+    last transform of a composite transform comes first.
+    """
+    if in_file.endswith(('.nii', '.nii.gz')):
+        return [DisplacementField.from_nifti(in_file)]
+    if in_file.endswith(('.h5', '.hdf5')):
+        transforms = _read_itk_hdf5(in_file)
+    elif in_file.endswith('.mat') and not _is_itk_text(in_file):
+        transforms = _read_itk_mat(in_file)
+    else:
+        transforms = _read_itk_text(in_file)
+    if not transforms:
+        raise ValueError('No ITK transform was found in %s' % in_file)
+    return transforms[::-1]
+
+
+def read_transforms(transform_files):
+    """
+    Reads a list of transform files, given in the order of
+    ``antsApplyTransforms``, into the list of transforms in the order they
+    map points of the reference space (the first file first)
+    """
+    return [transform for in_file in transform_files
+            for transform in read_itk_transforms(in_file)]
+
+
+def read_volume_transforms(transform_files, nvols):
+    """
+    Reads the ITK affines of the volumes of a series (e.g., head motion),
+    given either as one file per volume, or as a single file listing one
+    affine per volume (see :func:`write_itk_affines`)
+    """
+    if len(transform_files) == 1 and nvols > 1:
+        affines = _read_itk_text(transform_files[0])
+    else:
+        affines = [compose_affines([in_file]) for in_file in transform_files]
+    if len(affines) != nvols:
+        raise ValueError('%d volume transforms were given for %d volumes' % (
+            len(affines), nvols))
+    return affines
+
+
+def compose_points(transform_files, points):
+    """
+    Maps the RAS ``points`` (Nx3) of the reference space through a list of
+    transform files (see :func:`read_transforms`)
+    """
+    for transform in read_transforms(transform_files):
+        points = map_points(transform, points)
+    return points
+
+
+def compose_field(transform_files, shape, affine):
+    """
+    Composes a list of transform files (see :func:`read_transforms`) into a
+    single displacement field on the grid of ``shape`` and ``affine``
+    """
+    points = grid_points(shape, affine)
+    field = compose_points(transform_files, points) - points
+    return DisplacementField(field.reshape(tuple(shape[:3]) + (3,)), affine)
+
+
+def grid_points(shape, affine):
+    """RAS coordinates (Nx3) of the voxels of a grid, in C order"""
+    ijk = np.indices(shape[:3], dtype=np.float32).reshape(3, -1).T
+    return ijk.dot(affine[:3, :3].T) + affine[:3, 3]
+
+
+def compose_affines(transform_files):
+    """
+    Composes a list of transform files holding only affines (in the order of
+    ``antsApplyTransforms``) into one RAS affine mapping points
+    """
+    affine = np.eye(4)
+    for in_file in transform_files:
+        for transform in read_itk_transforms(in_file):
+            if isinstance(transform, DisplacementField):
+                raise ValueError('%s is not an affine transform' % in_file)
+            affine = transform.dot(affine)
+    return affine
+
+
+def fsl_scaling(nii):
+    """
+    Affine from the voxel coordinates of an image to FSL's scaled voxel
+    coordinates (mm), where the first axis is flipped if the voxel-to-world
+    matrix has a positive determinant
+    """
+    scaling = np.diag(list(nii.header.get_zooms()[:3]) + [1.])
+    if np.linalg.det(nii.affine[:3, :3]) > 0:
+        flip = np.eye(4)
+        flip[0, 0] = -1
+        flip[0, 3] = nii.shape[0] - 1
+        scaling = scaling.dot(flip)
+    return scaling
+
+
+def fsl_voxel_map(matrix, in_nii, ref_nii):
+    """
+    Affine mapping the voxel coordinates of ``ref_nii`` onto those of
+    ``in_nii``, given the FSL matrix that registers ``in_nii`` to
+    ``ref_nii``
+    """
+    return np.linalg.inv(fsl_scaling(in_nii)).dot(
+        np.linalg.inv(matrix)).dot(fsl_scaling(ref_nii))
+
+
+def read_fsl_matrices(mat_files):
+    """Reads FSL matrices (e.g., those of MCFLIRT) into an Nx4x4 array"""
+    return np.array([np.loadtxt(mat_file, ndmin=2) for mat_file in mat_files])
+
+
+def fsl_centre(nii):
+    """Centre of an image, in FSL's scaled voxel coordinates (as ``avscale``)"""
+    zooms = np.array(nii.header.get_zooms()[:3], dtype=np.float64)
+    return 0.5 * (np.array(nii.shape[:3]) - 1.) * zooms
+
+
+def decompose_fsl_affines(matrices, centre=(0., 0., 0.)):
+    """
+    Decomposes FSL matrices (an Nx4x4 array) as ``avscale`` does: returns the
+    rotation angles about x, y and z (rad, with the rotation matrix being
+    Rx.Ry.Rz), the translations of ``centre`` (mm), the scales and the skews
+    (xy, xz, yz), each an Nx3 array
+    """
+    matrices = np.asarray(matrices, dtype=np.float64)
+    centre = np.asarray(centre, dtype=np.float64)
+    aff3 = matrices[:, :3, :3]
+    x, y, z = aff3[:, :, 0], aff3[:, :, 1], aff3[:, :, 2]
+
+    def _dot(vec1, vec2):
+        return np.einsum('ij,ij->i', vec1, vec2)
+
+    # Gram-Schmidt on the columns, as decompose_aff of FSL's miscmaths
+    sx = np.sqrt(_dot(x, x))
+    sy = np.sqrt(_dot(y, y) - _dot(x, y) ** 2 / sx ** 2)
+    a = _dot(x, y) / (sx * sy)
+    x0 = x / sx[:, None]
+    y0 = y / sy[:, None] - a[:, None] * x0
+    sz = np.sqrt(_dot(z, z) - _dot(x0, z) ** 2 - _dot(y0, z) ** 2)
+    b = _dot(x0, z) / sz
+    c = _dot(y0, z) / sz
+
+    skews = np.zeros_like(aff3)
+    skews[:, [0, 1, 2], [0, 1, 2]] = 1.
+    skews[:, 0, 1], skews[:, 0, 2], skews[:, 1, 2] = a, b, c
+    scales = np.column_stack((sx, sy, sz))
+    rotations = np.matmul(aff3 / scales[:, None, :], np.linalg.inv(skews))
+
+    translations = aff3.dot(centre) + matrices[:, :3, 3] - centre
+
+    # Euler angles (rotmat2euler of FSL's miscmaths)
+    cos_y = np.sqrt(rotations[:, 0, 0] ** 2 + rotations[:, 0, 1] ** 2)
+    gimbal = cos_y < 1e-4
+    safe_cos_y = np.where(gimbal, 1., cos_y)
+    angles = np.column_stack((
+        np.where(gimbal,
+                 np.arctan2(-rotations[:, 2, 1], rotations[:, 1, 1]),
+                 np.arctan2(rotations[:, 1, 2] / safe_cos_y,
+                            rotations[:, 2, 2] / safe_cos_y)),
+        np.arctan2(-rotations[:, 0, 2], np.where(gimbal, 0., cos_y)),
+        np.where(gimbal, 0.,
+                 np.arctan2(rotations[:, 0, 1] / safe_cos_y,
+                            rotations[:, 0, 0] / safe_cos_y)),
+    ))
+    return angles, translations, scales, np.column_stack((a, b, c))
+
+
+def invert_fsl_affine(matrix):
+    """Inverse of an FSL matrix (as ``convert_xfm -inverse``)"""
+    return np.linalg.inv(matrix)
+
+
+def concat_fsl_affines(first, second):
+    """
+    FSL matrix applying ``first`` and then ``second`` (as
+    ``convert_xfm -omat out -concat second first``)
+    """
+    return np.asarray(second).dot(first)
+
+
+def fsl_to_ras(matrix, in_nii, ref_nii):
+    """
+    RAS affine mapping the world coordinates of ``in_nii`` onto those of
+    ``ref_nii``, given the FSL matrix that registers ``in_nii`` to
+    ``ref_nii`` (as ``c3d_affine_tool -fsl2ras``)
+    """
+    return np.linalg.inv(fsl_to_itk(matrix, in_nii, ref_nii))
+
+
+def fsl_to_itk(matrix, in_nii, ref_nii):
+    """
+    ITK affine (in RAS, mapping points of ``ref_nii`` onto ``in_nii``) that
+    resamples ``in_nii`` onto ``ref_nii``, given the FSL matrix registering
+    them (as ``c3d_affine_tool -fsl2ras -oitk``)
+    """
+    return in_nii.affine.dot(fsl_voxel_map(matrix, in_nii, ref_nii)).dot(
+        np.linalg.inv(ref_nii.affine))
+
+
+def itk_to_fsl(affine, in_nii, ref_nii):
+    """The FSL matrix registering ``in_nii`` to ``ref_nii``, given its ITK affine"""
+    voxel_map = np.linalg.inv(in_nii.affine).dot(affine).dot(ref_nii.affine)
+    return fsl_scaling(ref_nii).dot(np.linalg.inv(voxel_map)).dot(
+        np.linalg.inv(fsl_scaling(in_nii)))
+
+
+def write_fsl_affine(matrix, out_file):
+    """Writes an FSL matrix, in the format of FLIRT"""
+    np.savetxt(out_file, matrix, fmt='%.12g', delimiter='  ')
+    return out_file
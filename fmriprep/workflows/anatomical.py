@@ -166,6 +166,12 @@ def t1w_preprocessing(name='t1w_preprocessing', settings=None):
                             suffix='brainmask'),
         name='DerivT1_mask'
     )
+    ds_t1_tpms = pe.Node(
+        DerivativesDataSink(base_directory=settings['output_dir'],
+                            suffix='class-{extra_value}_probtissue'),
+        name='DerivT1_TPMs'
+    )
+    ds_t1_tpms.inputs.extra_values = ['CSF', 'GM', 'WM']
     ds_t1_mni = pe.Node(
         DerivativesDataSink(base_directory=settings['output_dir'],
                             suffix='space-MNI152NLin2009cAsym_preproc'),
@@ -215,6 +221,7 @@ def t1w_preprocessing(name='t1w_preprocessing', settings=None):
         (inputnode, ds_t1_bias, [(('t1w', fix_multi_T1w_source_name), 'source_file')]),
         (inputnode, ds_t1_seg, [(('t1w', fix_multi_T1w_source_name), 'source_file')]),
         (inputnode, ds_mask, [(('t1w', fix_multi_T1w_source_name), 'source_file')]),
+        (inputnode, ds_t1_tpms, [(('t1w', fix_multi_T1w_source_name), 'source_file')]),
         (inputnode, ds_t1_mni, [(('t1w', fix_multi_T1w_source_name), 'source_file')]),
         (inputnode, ds_t1_mni_aff, [(('t1w', fix_multi_T1w_source_name), 'source_file')]),
         (inputnode, ds_bmask_mni, [(('t1w', fix_multi_T1w_source_name), 'source_file')]),
@@ -222,6 +229,7 @@ def t1w_preprocessing(name='t1w_preprocessing', settings=None):
         (inu_n4, ds_t1_bias, [('output_image', 'in_file')]),
         (t1_seg, ds_t1_seg, [('tissue_class_map', 'in_file')]),
         (asw, ds_mask, [('outputnode.out_mask', 'in_file')]),
+        (t1_seg, ds_t1_tpms, [('probability_maps', 'in_file')]),
         (t1_2_mni, ds_t1_mni, [('warped_image', 'in_file')]),
         (bmask_mni, ds_bmask_mni, [('output_image', 'in_file')]),
         (tpms_mni, ds_tpms_mni, [('output_image', 'in_file')])
@@ -230,6 +238,35 @@ def t1w_preprocessing(name='t1w_preprocessing', settings=None):
     return workflow
 
 
+def t1w_derivatives(derivatives, name='t1w_preprocessing'):
+    """
+    Replaces :func:`t1w_preprocessing` in functional-only runs: feeds the
+    anatomical derivatives of a previous run (as found by
+    :func:`fmriprep.utils.misc.collect_anat_derivatives`) to a workflow with
+    the same inputs and outputs.
+    """
+    workflow = pe.Workflow(name=name)
+
+    inputnode = pe.Node(niu.IdentityInterface(fields=['t1w']), name='inputnode')
+    outputnode = pe.Node(niu.IdentityInterface(
+        fields=['t1_seg', 't1_tpms', 'bias_corrected_t1', 't1_brain', 't1_mask',
+                't1_2_mni', 't1_2_mni_forward_transform',
+                't1_2_mni_reverse_transform']), name='outputnode')
+    for field, value in list(derivatives.items()):
+        setattr(outputnode.inputs, field, value)
+
+    # The skull-stripped T1w is not written out, but it is cheap to recompute
+    t1_brain = pe.Node(fsl.ApplyMask(in_file=derivatives['bias_corrected_t1'],
+                                     mask_file=derivatives['t1_mask']),
+                       name='T1_Brain')
+
+    workflow.connect([
+        (t1_brain, outputnode, [('out_file', 't1_brain')])
+    ])
+    workflow.add_nodes([inputnode])
+    return workflow
+
+
 def skullstrip_ants(name='ANTsBrainExtraction', settings=None):
     from niworkflows.data import get_ants_oasis_template_ras
     if settings is None:
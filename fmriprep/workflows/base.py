@@ -7,49 +7,165 @@ Created on Wed Dec  2 17:35:40 2015
 
 @author: craigmoodie
 """
+from functools import partial
+from multiprocessing import Pool
+from time import time
+
+from nipype import logging
 from nipype.pipeline import engine as pe
-from nipype.interfaces import fsl
 
 from fmriprep.interfaces import BIDSDataGrabber
-from fmriprep.utils.misc import collect_bids_data, get_biggest_epi_file_size_gb
+from fmriprep.interfaces.transforms import ConvertFSLMatrix
+from fmriprep.utils.bids_index import get_bids_index
+from fmriprep.utils.misc import collect_bids_data, collect_anat_derivatives
+from fmriprep.utils.resources import image_geometry, apply_resource_profiles
 from fmriprep.workflows import confounds
 
-from fmriprep.workflows.anatomical import t1w_preprocessing
+from fmriprep.workflows.anatomical import t1w_preprocessing, t1w_derivatives
 from fmriprep.workflows.sbref import sbref_preprocess
 from fmriprep.workflows.fieldmap import phase_diff_and_magnitudes
 from fmriprep.workflows.epi import (
     epi_unwarp, epi_hmc, epi_sbref_registration,
     ref_epi_t1_registration, epi_mni_transformation)
 
+LOGGER = logging.getLogger('workflow')
+
+
+def base_workflow_enumerator(subject_list, task_id, settings, session_id=None,
+                             run_id=None):
+    """
+    Builds one sub-workflow per subject, in the order of ``subject_list``.
+
+    The data of the subjects (BIDS queries and NIfTI headers) are collected
+    concurrently, in a pool of up to ``settings['nthreads']`` processes.
+    The nipype graphs are then built in this process, as they would
+    otherwise have to be pickled back from the workers.
 
-def base_workflow_enumerator(subject_list, task_id, settings):
+    If ``task_id``, ``session_id`` or ``run_id`` are given, only the
+    matching BOLD runs are processed.
+    """
     workflow = pe.Workflow(name='workflow_enumerator')
-    generated_list = []
-    for subject in subject_list:
-        generated_workflow = base_workflow_generator(subject, task_id=task_id,
-                                                     settings=settings)
+
+    start = time()
+    collect = partial(collect_subject_data, settings['bids_root'], task_id=task_id,
+                      session_id=session_id, run_id=run_id,
+                      index_file=settings.get('bids_index'),
+                      data_type=settings.get('data_type'))
+    nprocs = max(1, min(settings.get('nthreads') or 1, len(subject_list)))
+    if nprocs > 1 and settings.get('bids_index'):
+        # Index the dataset once, the workers read it from the index file
+        get_bids_index(settings['bids_root'], index_file=settings['bids_index'])
+        pool = Pool(processes=nprocs)
+        try:
+            collected = pool.map(collect, subject_list)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        nprocs = 1
+        collected = [collect(subject) for subject in subject_list]
+    LOGGER.info('Data of %d subjects collected in %.2fs (%d processes)',
+                len(subject_list), time() - start, nprocs)
+
+    for subject_id, (subject_data, bold_geometry, elapsed) in zip(subject_list, collected):
+        start = time()
+        # Each subject gets its own copy, as the generator adds per-subject keys
+        generated_workflow = base_workflow_generator(
+            subject_id, task_id=task_id, settings=dict(settings), session_id=session_id,
+            run_id=run_id, subject_data=subject_data, bold_geometry=bold_geometry)
+        LOGGER.info('Workflow for subject %s built in %.2fs (data collected in %.2fs)',
+                    subject_id, time() - start, elapsed)
         if generated_workflow:
-            generated_list.append(generated_workflow)
-    workflow.add_nodes(generated_list)
+            workflow.add_nodes([generated_workflow])
 
     return workflow
 
 
-def base_workflow_generator(subject_id, task_id, settings):
-    subject_data = collect_bids_data(settings['bids_root'], subject_id, task_id)
+def collect_subject_data(bids_root, subject_id, task_id=None, session_id=None,
+                         run_id=None, index_file=None, data_type=None):
+    """
+    Collects the imaging data of a subject and the geometry of its BOLD
+    runs (read from their headers), i.e. all the I/O needed to build its
+    workflow. Returns the data, the geometries and the time it took.
+    """
+    start = time()
+    subject_data = collect_bids_data(bids_root, subject_id, task_id, session=session_id,
+                                     run=run_id, index_file=index_file)
+    if data_type == 'anat':
+        subject_data['func'] = []
+    bold_geometry = [image_geometry(bold) for bold in subject_data['func']]
+    return subject_data, bold_geometry, time() - start
+
 
-    settings["biggest_epi_file_size_gb"] = get_biggest_epi_file_size_gb(subject_data['func'])
+def base_workflow_generator(subject_id, task_id, settings, session_id=None, run_id=None,
+                            subject_data=None, bold_geometry=None):
+    """
+    Builds the workflow of one subject. Depending on ``settings['data_type']``
+    the workflow processes both the anatomical and functional data (``None``),
+    only the anatomical data (``'anat'``) or only the functional data, using
+    the anatomical derivatives of a previous run (``'func'``).
+
+    ``subject_data`` and ``bold_geometry`` are collected (as by
+    :func:`collect_subject_data`) if not given.
+    """
+    if subject_data is None or bold_geometry is None:
+        subject_data, bold_geometry, _ = collect_subject_data(
+            settings['bids_root'], subject_id, task_id, session_id=session_id,
+            run_id=run_id, index_file=settings['bids_index'],
+            data_type=settings.get('data_type'))
+    settings['bold_geometry'] = bold_geometry
 
     if subject_data['t1w'] == []:
         raise Exception("No T1w images found for participant %s. All workflows require T1w images."%subject_id)
 
-    if (subject_data['sbref'] != [] and settings['workflow_type'] == "auto") or settings['workflow_type'] == "ds054":
-        return wf_ds054_type(subject_data, settings, name=subject_id)
+    if settings.get('data_type') == 'anat':
+        workflow = wf_anat_type(subject_data, settings, name=subject_id)
+    elif (subject_data['sbref'] != [] and settings['workflow_type'] == "auto") or settings['workflow_type'] == "ds054":
+        workflow = wf_ds054_type(subject_data, settings, name=subject_id)
     elif (subject_data['sbref'] == [] and settings['workflow_type'] == "auto") or settings['workflow_type'] == "ds005":
-        return wf_ds005_type(subject_data, settings, name=subject_id)
+        workflow = wf_ds005_type(subject_data, settings, name=subject_id)
     else:
         raise Exception("Could not figure out what kind of workflow to run for this dataset.")
 
+    # Use the resources recorded in previous runs, if any
+    if settings.get('resource_profiles') is not None:
+        apply_resource_profiles(workflow, settings['resource_profiles'],
+                                geometries=settings['bold_geometry'],
+                                max_threads=settings['nthreads'])
+
+    return workflow
+
+
+def wf_anat_type(subject_data, settings, name='fMRI_prep'):
+    """
+    The anatomical workflow alone, for anatomical-only runs
+    (``--data-type anat``). Its derivatives are picked up by later
+    functional-only runs (``--data-type func``).
+    """
+    workflow = pe.Workflow(name=name)
+
+    bidssrc = pe.Node(BIDSDataGrabber(subject_data=subject_data, anat_only=True),
+                      name='BIDSDatasource')
+
+    # Preprocessing of T1w (includes registration to MNI)
+    t1w_pre = t1w_preprocessing(settings=settings)
+
+    workflow.connect([
+        (bidssrc, t1w_pre, [('t1w', 'inputnode.t1w')])
+    ])
+    return workflow
+
+
+def _t1w_workflow(subject_data, settings):
+    """
+    The workflow providing the anatomical reference: either the anatomical
+    preprocessing workflow or, in functional-only runs (``--data-type func``),
+    the derivatives of a previous anatomical run
+    """
+    if settings.get('data_type') == 'func':
+        return t1w_derivatives(collect_anat_derivatives(
+            settings['output_dir'], subject_data['t1w']))
+    return t1w_preprocessing(settings=settings)
 
 
 def wf_ds054_type(subject_data, settings, name='fMRI_prep'):
@@ -76,7 +192,7 @@ def wf_ds054_type(subject_data, settings, name='fMRI_prep'):
     bidssrc = pe.Node(BIDSDataGrabber(subject_data=subject_data), name='BIDSDatasource')
 
     # Preprocessing of T1w (includes registration to MNI)
-    t1w_pre = t1w_preprocessing(settings=settings)
+    t1w_pre = _t1w_workflow(subject_data, settings)
 
     # Estimate fieldmap
     fmap_est = phase_diff_and_magnitudes(settings)
@@ -104,7 +220,7 @@ def wf_ds054_type(subject_data, settings, name='fMRI_prep'):
     confounds_wf.get_node('inputnode').inputs.t1_transform_flags = [False, True]
 
     # create list of transforms to resample t1 -> sbref -> epi
-    t1_to_epi_transforms = pe.Node(fsl.ConvertXFM(concat_xfm=True), name='T1ToEPITransforms')
+    t1_to_epi_transforms = pe.Node(ConvertFSLMatrix(concat_xfm=True), name='T1ToEPITransforms')
 
     workflow.connect([
         (bidssrc, t1w_pre, [('t1w', 'inputnode.t1w')]),
@@ -126,7 +242,8 @@ def wf_ds054_type(subject_data, settings, name='fMRI_prep'):
                                 ('outputnode.sbref_unwarped_mask', 'inputnode.sbref_mask')]),
         (hmcwf, epi2sbref, [('outputnode.epi_mask', 'inputnode.epi_mask'),
                             ('outputnode.epi_mean', 'inputnode.epi_mean'),
-                            ('outputnode.epi_hmc', 'inputnode.epi'),
+                            ('outputnode.xforms', 'inputnode.hmc_xforms'),
+                            ('inputnode.epi', 'inputnode.epi'),
                             ('inputnode.epi', 'inputnode.epi_name_source')]),
         (hmcwf, epiunwarp_wf, [('inputnode.epi', 'inputnode.epi')]),
         (fmap_est, epiunwarp_wf, [('outputnode.fmap', 'inputnode.fmap'),
@@ -175,7 +292,7 @@ def wf_ds005_type(subject_data, settings, name='fMRI_prep'):
                       name='BIDSDatasource')
 
     # Preprocessing of T1w (includes registration to MNI)
-    t1w_pre = t1w_preprocessing(settings=settings)
+    t1w_pre = _t1w_workflow(subject_data, settings)
 
     # HMC on the EPI
     hmcwf = epi_hmc(settings=settings)
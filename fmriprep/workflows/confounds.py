@@ -10,6 +10,7 @@ from niworkflows.interfaces.masks import ACompCorRPT, TCompCorRPT
 from fmriprep import interfaces
 from fmriprep.interfaces.bids import DerivativesDataSink
 from fmriprep.interfaces.utils import prepare_roi_from_probtissue
+from fmriprep.utils.resources import estimate_memory_gb
 
 def discover_wf(settings, name="ConfoundDiscoverer"):
     ''' All input fields are required.
@@ -39,19 +40,17 @@ def discover_wf(settings, name="ConfoundDiscoverer"):
     # DVARS
     dvars = pe.Node(confounds.ComputeDVARS(save_all=True, remove_zerovariance=True),
                     name="ComputeDVARS")
-    dvars.interface.estimated_memory_gb = settings[
-                                              "biggest_epi_file_size_gb"] * 3
+    dvars.interface.estimated_memory_gb = estimate_memory_gb(
+        settings['bold_geometry'], 'ComputeDVARS')
     # Frame displacement
     frame_displace = pe.Node(confounds.FramewiseDisplacement(), name="FramewiseDisplacement")
-    frame_displace.interface.estimated_memory_gb = settings[
-                                              "biggest_epi_file_size_gb"] * 3
     # CompCor
     tcompcor = pe.Node(TCompCorRPT(components_file='tcompcor.tsv',
                                    generate_report=True,
                                    percentile_threshold=.05),
                        name="tCompCor")
-    tcompcor.interface.estimated_memory_gb = settings[
-                                              "biggest_epi_file_size_gb"] * 3
+    tcompcor.interface.estimated_memory_gb = estimate_memory_gb(
+        settings['bold_geometry'], 'tCompCor')
 
     CSF_roi = pe.Node(utility.Function(input_names=['in_file', 'epi_mask',
                                                     'erosion_mm',
@@ -74,6 +73,7 @@ def discover_wf(settings, name="ConfoundDiscoverer"):
     def concat_rois_func(in_WM, in_mask, ref_header):
         import os
         import nibabel as nb
+        from fmriprep.utils.nifti import save_nii, work_file
 
         WM_nii = nb.load(in_WM)
         mask_nii = nb.load(in_mask)
@@ -86,8 +86,7 @@ def discover_wf(settings, name="ConfoundDiscoverer"):
         concat_nii = nb.Nifti1Image(concat_nii.get_data(),
                                     nb.load(ref_header).affine,
                                     nb.load(ref_header).header)
-        concat_nii.to_filename("concat.nii.gz")
-        return os.path.abspath("concat.nii.gz")
+        return save_nii(concat_nii, os.path.abspath(work_file("concat.nii.gz")))
 
     concat_rois = pe.Node(utility.Function(input_names=['in_WM', 'in_mask',
                                                         'ref_header'],
@@ -99,13 +98,14 @@ def discover_wf(settings, name="ConfoundDiscoverer"):
     signals = pe.Node(nilearn.SignalExtraction(detrend=True,
                                                class_labels=["WhiteMatter", "GlobalSignal"]),
                       name="SignalExtraction")
-    signals.interface.estimated_memory_gb = settings[
-                                              "biggest_epi_file_size_gb"] * 3
+    signals.interface.estimated_memory_gb = estimate_memory_gb(
+        settings['bold_geometry'], 'SignalExtraction')
 
     def combine_rois(in_CSF, in_WM, ref_header):
         import os
         import numpy as np
         import nibabel as nb
+        from fmriprep.utils.nifti import save_nii, work_file
 
         CSF_nii = nb.load(in_CSF)
         CSF_data = CSF_nii.get_data()
@@ -122,8 +122,7 @@ def discover_wf(settings, name="ConfoundDiscoverer"):
         # qform_code between the two files that prevent aCompCor to work
         new_nii = nb.Nifti1Image(combined, nb.load(ref_header).affine,
                                  nb.load(ref_header).header)
-        new_nii.to_filename("logical_or.nii.gz")
-        return os.path.abspath("logical_or.nii.gz")
+        return save_nii(new_nii, os.path.abspath(work_file("logical_or.nii.gz")))
 
     combine_rois = pe.Node(utility.Function(input_names=['in_CSF', 'in_WM',
                                                          'ref_header'],
@@ -134,8 +133,8 @@ def discover_wf(settings, name="ConfoundDiscoverer"):
     acompcor = pe.Node(ACompCorRPT(components_file='acompcor.tsv',
                                    generate_report=True),
                        name="aCompCor")
-    acompcor.interface.estimated_memory_gb = settings[
-                                              "biggest_epi_file_size_gb"] * 3
+    acompcor.interface.estimated_memory_gb = estimate_memory_gb(
+        settings['bold_geometry'], 'aCompCor')
 
     ds_report_a = pe.Node(
         DerivativesDataSink(base_directory=settings['output_dir'],
@@ -13,7 +13,6 @@ import os.path as op
 
 from nipype.pipeline import engine as pe
 from nipype.interfaces import ants
-from nipype.interfaces import c3
 from nipype.interfaces import fsl
 from nipype.interfaces import io as nio
 from nipype.interfaces import utility as niu
@@ -21,9 +20,13 @@ from niworkflows.interfaces.masks import ComputeEPIMask, BETRPT
 from niworkflows.interfaces.registration import FLIRTRPT
 from niworkflows.data import get_mni_icbm152_nlin_asym_09c
 
-from fmriprep.interfaces import DerivativesDataSink, FormatHMCParam
-from fmriprep.interfaces.utils import nii_concat
+from fmriprep.interfaces import DerivativesDataSink, MotionParameters
+from fmriprep.interfaces.hmc import CachedMCFLIRT, EstimateReference, ParallelMCFLIRT
+from fmriprep.interfaces.resampling import ComposeTransforms, ResampleToSpaces
+from fmriprep.interfaces.transforms import ConvertFSLMatrix, FSLToITK
 from fmriprep.utils.misc import fix_multi_T1w_source_name, _first
+from fmriprep.utils.nifti import work_file
+from fmriprep.utils.resources import estimate_memory_gb
 from fmriprep.workflows.fieldmap import sdc_unwarp
 from fmriprep.viz import stripped_brain_overlay
 from fmriprep.workflows.sbref import _extract_wm
@@ -41,17 +44,31 @@ def epi_hmc(name='EPI_HMC', settings=None):
         fields=['xforms', 'epi_hmc', 'epi_mask', 'epi_mean', 'movpar_file',
                 'motion_confounds_file']), name='outputnode')
 
-    # Head motion correction (hmc)
-    hmc = pe.Node(fsl.MCFLIRT(
-        save_mats=True, save_plots=True, mean_vol=True), name='EPI_hmc')
-    hmc.interface.estimated_memory_gb = settings["biggest_epi_file_size_gb"] * 3
-
-    hcm2itk = pe.MapNode(c3.C3dAffineTool(fsl2ras=True, itk_transform=True),
-                         iterfield=['transform_file'], name='hcm2itk')
-
-    avscale = pe.MapNode(fsl.utils.AvScale(all_param=True), name='AvScale',
-                         iterfield=['mat_file'])
-    avs_format = pe.Node(FormatHMCParam(), name='AVScale_Format')
+    # Reference of the hmc, averaging the volumes that are the most alike
+    hmc_ref = pe.Node(EstimateReference(), name='EPI_hmc_reference')
+
+    # Head motion correction (hmc), by chunks of volumes in parallel if
+    # hmc_nthreads is set
+    hmc_nthreads = settings.get('hmc_nthreads') or 1
+    if hmc_nthreads > 1:
+        hmc = pe.Node(ParallelMCFLIRT(num_threads=hmc_nthreads), name='EPI_hmc')
+        hmc.interface.num_threads = hmc_nthreads
+        mean = hmc
+    else:
+        hmc = pe.Node(CachedMCFLIRT(save_mats=True, save_plots=True), name='EPI_hmc')
+        mean = pe.Node(fsl.MeanImage(dimension='T'), name='EPI_hmc_mean')
+        workflow.connect([(hmc, mean, [('out_file', 'in_file')])])
+    mean_field = 'mean_img' if mean is hmc else 'out_file'
+    if settings.get('cache_dir'):
+        hmc.inputs.cache_dir = settings['cache_dir']
+        hmc_ref.inputs.index_dir = settings['cache_dir']
+    hmc.interface.estimated_memory_gb = estimate_memory_gb(
+        settings['bold_geometry'], 'EPI_hmc')
+
+    # All the HMC matrices, converted to a single ITK file (one per volume)
+    hcm2itk = pe.Node(FSLToITK(series=True), name='hcm2itk')
+
+    motion_params = pe.Node(MotionParameters(), name='MotionParameters')
 
     inu = pe.Node(ants.N4BiasFieldCorrection(dimension=3), name='EPImeanBias')
 
@@ -60,21 +77,21 @@ def epi_hmc(name='EPI_HMC', settings=None):
                              name='skullstrip_epi')
 
     workflow.connect([
+        (inputnode, hmc_ref, [('epi', 'in_file')]),
         (inputnode, hmc, [('epi', 'in_file')]),
-        (hmc, hcm2itk, [('mat_file', 'transform_file'),
-                        ('mean_img', 'source_file'),
-                        ('mean_img', 'reference_file')]),
+        (hmc_ref, hmc, [('ref_file', 'ref_file')]),
+        (hmc, hcm2itk, [('mat_file', 'transform_file')]),
+        (mean, hcm2itk, [(mean_field, 'source_file'),
+                         (mean_field, 'reference_file')]),
         (hcm2itk, outputnode, [('itk_transform', 'xforms')]),
         (hmc, outputnode, [('out_file', 'epi_hmc'),
-                           ('par_file', 'movpar_file'),
-                           ('mean_img', 'epi_mean')]),
-        (hmc, avscale, [('mat_file', 'mat_file')]),
-        (avscale, avs_format, [('translations', 'translations'),
-                               ('rot_angles', 'rot_angles')]),
-        (hmc, inu, [('mean_img', 'input_image')]),
+                           ('par_file', 'movpar_file')]),
+        (mean, outputnode, [(mean_field, 'epi_mean')]),
+        (hmc, motion_params, [('mat_file', 'mat_file')]),
+        (mean, inu, [(mean_field, 'input_image')]),
         (inu, skullstrip_epi, [('output_image', 'in_file')]),
-        (hmc, avscale, [('mean_img', 'ref_file')]),
-        (avs_format, outputnode, [('out_file', 'motion_confounds_file')]),
+        (mean, motion_params, [(mean_field, 'ref_file')]),
+        (motion_params, outputnode, [('out_file', 'motion_confounds_file')]),
         (skullstrip_epi, outputnode, [('mask_file', 'epi_mask')]),
     ])
 
@@ -97,18 +114,6 @@ def epi_hmc(name='EPI_HMC', settings=None):
         (skullstrip_epi, ds_report, [('out_report', 'in_file')])
     ])
 
-    if not settings["skip_native"]:
-        # Write corrected file in the designated output dir
-        ds_hmc = pe.Node(
-            DerivativesDataSink(base_directory=settings['output_dir'],
-                                suffix='preproc'),
-            name='DerivativesHMC'
-        )
-        workflow.connect([
-            (inputnode, ds_hmc, [('epi', 'source_file')]),
-            (hmc, ds_hmc, [('out_file', 'in_file')])
-        ])
-
     return workflow
 
 
@@ -152,14 +157,12 @@ def ref_epi_t1_registration(reportlet_suffix, inv_ds_suffix, name='ref_epi_t1_re
                                       'etc/flirtsch/bbr.sch')
 
     # make equivalent warp fields
-    invt_bbr = pe.Node(fsl.ConvertXFM(invert_xfm=True), name='Flirt_BBR_Inv')
+    invt_bbr = pe.Node(ConvertFSLMatrix(invert_xfm=True), name='Flirt_BBR_Inv')
 
-    #  EPI to T1 transform matrix is from fsl, using c3 tools to convert to
-    #  something ANTs will like.
-    fsl2itk_fwd = pe.Node(c3.C3dAffineTool(fsl2ras=True, itk_transform=True),
-                          name='fsl2itk_fwd')
-    fsl2itk_inv = pe.Node(c3.C3dAffineTool(fsl2ras=True, itk_transform=True),
-                          name='fsl2itk_inv')
+    #  EPI to T1 transform matrix is from fsl, converted to something ANTs
+    #  will like.
+    fsl2itk_fwd = pe.Node(FSLToITK(), name='fsl2itk_fwd')
+    fsl2itk_inv = pe.Node(FSLToITK(), name='fsl2itk_inv')
 
     # Write registrated file in the designated output dir
     ds_tfm_fwd = pe.Node(
@@ -213,11 +216,16 @@ def ref_epi_t1_registration(reportlet_suffix, inv_ds_suffix, name='ref_epi_t1_re
 
 
 def epi_sbref_registration(settings, name='EPI_SBrefRegistration'):
+    """
+    Registers the EPI mean to the SBRef, and resamples the EPI series onto
+    the SBRef (and the native space, unless ``skip_native``) in a single
+    pass, composing the registration with the head motion transforms.
+    """
     workflow = pe.Workflow(name=name)
     inputnode = pe.Node(
         niu.IdentityInterface(fields=['epi', 'epi_name_source', 'sbref',
                                       'epi_mean', 'epi_mask',
-                                      'sbref_mask']),
+                                      'sbref_mask', 'hmc_xforms']),
         name='inputnode'
     )
     outputnode = pe.Node(niu.IdentityInterface(
@@ -225,46 +233,53 @@ def epi_sbref_registration(settings, name='EPI_SBrefRegistration'):
 
     epi_sbref = pe.Node(FLIRTRPT(generate_report=True, dof=6,
                                  out_matrix_file='init.mat',
-                                 out_file='init.nii.gz'),
+                                 out_file=work_file('init.nii.gz')),
                         name='EPI2SBRefRegistration')
     # make equivalent inv
-    sbref_epi = pe.Node(fsl.ConvertXFM(invert_xfm=True), name="SBRefEPI")
+    sbref_epi = pe.Node(ConvertFSLMatrix(invert_xfm=True), name="SBRefEPI")
+
+    # The registration, converted to ITK to be composed with the HMC transforms
+    fsl2itk = pe.Node(FSLToITK(), name='EPI2SBRefITK')
 
-    epi_split = pe.Node(fsl.Split(dimension='t'), name='EPIsplit')
-    epi_xfm = pe.MapNode(fsl.preprocess.ApplyXFM(), name='EPIapplyXFM',
-                         iterfield=['in_file'])
-    epi_merge = pe.Node(niu.Function(input_names=["in_files"],
-                                     output_names=["merged_file"],
-                                     function=nii_concat), name='EPImergeback')
+    # All the volumes are resampled onto all the spaces at once
+    epi_xfm = pe.Node(ResampleToSpaces(), name='EPIapplyXFM')
+    _set_resampling_resources(epi_xfm, settings)
 
     ds_sbref = pe.Node(
         DerivativesDataSink(base_directory=settings['output_dir'],
-                            suffix='preproc'), name='DerivHMC_SBRef')
+                            suffix='space-SBRef_preproc'), name='DerivHMC_SBRef')
 
     ds_report = pe.Node(
         DerivativesDataSink(base_directory=settings['output_dir'],
                             suffix='epi_sbref', out_path_base='reports'), 
         name="DS_Report")
 
+    spaces = [('SBRef', (inputnode, 'sbref'), (fsl2itk, 'itk_transform'), ds_sbref)]
+    if not settings.get('skip_native'):
+        ds_native = pe.Node(
+            DerivativesDataSink(base_directory=settings['output_dir'], suffix='preproc'),
+            name='DerivativesHMC')
+        spaces.append(('native', (inputnode, 'epi_mean'), [], ds_native))
+    split_outputs = _connect_spaces(workflow, epi_xfm, spaces,
+                                    (inputnode, 'epi_name_source'))
+
     workflow.connect([
-        (inputnode, epi_split, [('epi', 'in_file')]),
         (inputnode, epi_sbref, [('sbref', 'reference'),
                                 ('sbref_mask', 'ref_weight'),]),
-        (inputnode, epi_xfm, [('sbref', 'reference')]),
         (inputnode, epi_sbref, [('epi_mean', 'in_file'),
                                 ('epi_mask', 'in_weight')]),
+        (inputnode, fsl2itk, [('epi_mean', 'source_file'),
+                              ('sbref', 'reference_file')]),
+        (epi_sbref, fsl2itk, [('out_matrix_file', 'transform_file')]),
 
-        (epi_split, epi_xfm, [('out_files', 'in_file')]),
-        (epi_sbref, epi_xfm, [('out_matrix_file', 'in_matrix_file')]),
-        (epi_xfm, epi_merge, [('out_file', 'in_files')]),
+        (inputnode, epi_xfm, [('epi', 'in_file'),
+                              ('hmc_xforms', 'volume_transforms')]),
         (epi_sbref, outputnode, [('out_matrix_file', 'out_mat')]),
-        (epi_merge, outputnode, [('merged_file', 'epi_registered')]),
+        (split_outputs, outputnode, [('out1', 'epi_registered')]),
 
         (epi_sbref, sbref_epi, [('out_matrix_file', 'in_file')]),
         (sbref_epi, outputnode, [('out_file', 'out_mat_inv')]),
 
-        (epi_merge, ds_sbref, [('merged_file', 'in_file')]),
-        (inputnode, ds_sbref, [('epi_name_source', 'source_file')]),
         (inputnode, ds_report, [('epi_name_source', 'source_file')]),
         (epi_sbref, ds_report, [('out_report', 'in_file')])
     ])
@@ -273,6 +288,12 @@ def epi_sbref_registration(settings, name='EPI_SBrefRegistration'):
 
 
 def epi_mni_transformation(name='EPIMNITransformation', settings=None):
+    """
+    Resamples the EPI series onto the output spaces (native, unless
+    ``skip_native``, and those in ``output_spaces``: ``T1w`` and ``MNI``)
+    in a single pass, with one interpolation per space. Also maps the EPI
+    mask to MNI space.
+    """
     workflow = pe.Workflow(name=name)
     inputnode = pe.Node(
         niu.IdentityInterface(fields=[
@@ -285,75 +306,147 @@ def epi_mni_transformation(name='EPIMNITransformation', settings=None):
         ]),
         name='inputnode'
     )
+    output_spaces = settings.get('output_spaces', ['MNI'])
 
     def _aslist(in_value):
         if isinstance(in_value, list):
             return in_value
         return [in_value]
 
-    gen_ref = pe.Node(niu.Function(
-        input_names=['fixed_image', 'moving_image'], output_names=['out_file'],
-        function=_gen_reference), name='GenNewMNIReference')
-    gen_ref.inputs.fixed_image = op.join(get_mni_icbm152_nlin_asym_09c(),
-                                         '1mm_T1.nii.gz')
-
-    split = pe.Node(fsl.Split(dimension='t'), name='SplitEPI')
-    split.interface.estimated_memory_gb = settings["biggest_epi_file_size_gb"] * 3
-
-    merge_transforms = pe.MapNode(niu.Merge(3),
-                                  iterfield=['in3'], name='MergeTransforms')
-    epi_to_mni_transform = pe.MapNode(
-        ants.ApplyTransforms(), iterfield=['input_image', 'transforms'],
-        name='EPIToMNITransform')
-    epi_to_mni_transform.terminal_output = 'file'
-    merge = pe.Node(niu.Function(input_names=["in_files"],
-                                 output_names=["merged_file"],
-                                 function=nii_concat), name='MergeEPI')
-    merge.interface.estimated_memory_gb = settings[
-                                              "biggest_epi_file_size_gb"] * 3
-
-    mask_merge_tfms = pe.Node(niu.Merge(2), name='MaskMergeTfms')
-    mask_mni_tfm = pe.Node(
-        ants.ApplyTransforms(interpolation='NearestNeighbor'),
-        name='MaskToMNI'
-    )
+    # Each output space: its reference grid, the transforms shared by all the
+    # volumes (from the EPI mean) and its data sink
+    spaces = []
+    if not settings.get('skip_native'):
+        ds_native = pe.Node(
+            DerivativesDataSink(base_directory=settings['output_dir'], suffix='preproc'),
+            name='DerivativesHMC')
+        spaces.append(('native', (inputnode, 'epi_mask'), [], ds_native))
+
+    if 'T1w' in output_spaces:
+        gen_t1_ref = pe.Node(niu.Function(
+            input_names=['fixed_image', 'moving_image', 'cache_dir'], output_names=['out_file'],
+            function=_gen_reference), name='GenT1wReference')
+        if settings.get('cache_dir'):
+            gen_t1_ref.inputs.cache_dir = settings['cache_dir']
+        ds_t1 = pe.Node(
+            DerivativesDataSink(base_directory=settings['output_dir'],
+                                suffix='space-T1w_preproc'),
+            name='DerivativesHMCT1')
+        workflow.connect([
+            (inputnode, gen_t1_ref, [('t1', 'fixed_image'),
+                                     ('epi_mask', 'moving_image')])
+        ])
+        spaces.append(('T1w', (gen_t1_ref, 'out_file'), (inputnode, 'itk_epi_to_t1'), ds_t1))
+
+    if 'MNI' in output_spaces:
+        gen_ref = pe.Node(niu.Function(
+            input_names=['fixed_image', 'moving_image', 'cache_dir'], output_names=['out_file'],
+            function=_gen_reference), name='GenNewMNIReference')
+        gen_ref.inputs.fixed_image = op.join(get_mni_icbm152_nlin_asym_09c(),
+                                             '1mm_T1.nii.gz')
+        if settings.get('cache_dir'):
+            gen_ref.inputs.cache_dir = settings['cache_dir']
+
+        merge_transforms = pe.Node(niu.Merge(2), name='MergeTransforms')
+
+        # The EPI to MNI transforms, composed into one displacement field on the
+        # output grid. Only the head-motion affines change across volumes.
+        compose_transforms = pe.Node(ComposeTransforms(), name='ComposeTransforms')
+        if settings.get('cache_dir'):
+            compose_transforms.inputs.cache_dir = settings['cache_dir']
+
+        mask_mni_tfm = pe.Node(
+            ants.ApplyTransforms(interpolation='NearestNeighbor'),
+            name='MaskToMNI'
+        )
 
-    # Write corrected file in the designated output dir
-    ds_mni = pe.Node(
-        DerivativesDataSink(base_directory=settings['output_dir'],
-                            suffix='space-MNI152NLin2009cAsym_preproc'),
-        name='DerivativesHMCMNI'
-    )
-    ds_mni_mask = pe.Node(
-        DerivativesDataSink(base_directory=settings['output_dir'],
-                            suffix='space-MNI152NLin2009cAsym_brainmask'),
-        name='DerivativesHMCMNImask'
-    )
+        # Write corrected file in the designated output dir
+        ds_mni = pe.Node(
+            DerivativesDataSink(base_directory=settings['output_dir'],
+                                suffix='space-MNI152NLin2009cAsym_preproc'),
+            name='DerivativesHMCMNI'
+        )
+        ds_mni_mask = pe.Node(
+            DerivativesDataSink(base_directory=settings['output_dir'],
+                                suffix='space-MNI152NLin2009cAsym_brainmask'),
+            name='DerivativesHMCMNImask'
+        )
 
-    workflow.connect([
-        (inputnode, ds_mni, [('epi', 'source_file')]),
-        (inputnode, ds_mni_mask, [('epi', 'source_file')]),
-        (inputnode, gen_ref, [('epi_mask', 'moving_image')]),
-        (inputnode, merge_transforms, [('t1_2_mni_forward_transform', 'in1'),
-                                       (('itk_epi_to_t1', _aslist), 'in2'),
-                                       ('hmc_xforms', 'in3')]),
-        (inputnode, mask_merge_tfms, [('t1_2_mni_forward_transform', 'in1'),
-                                      (('itk_epi_to_t1', _aslist), 'in2')]),
-        (inputnode, split, [('epi', 'in_file')]),
-        (split, epi_to_mni_transform, [('out_files', 'input_image')]),
-        (merge_transforms, epi_to_mni_transform, [('out', 'transforms')]),
-        (gen_ref, epi_to_mni_transform, [('out_file', 'reference_image')]),
-        (epi_to_mni_transform, merge, [('output_image', 'in_files')]),
-        (merge, ds_mni, [('merged_file', 'in_file')]),
-        (mask_merge_tfms, mask_mni_tfm, [('out', 'transforms')]),
-        (gen_ref, mask_mni_tfm, [('out_file', 'reference_image')]),
-        (inputnode, mask_mni_tfm, [('epi_mask', 'input_image')]),
-        (mask_mni_tfm, ds_mni_mask, [('output_image', 'in_file')])
-    ])
+        workflow.connect([
+            (inputnode, ds_mni_mask, [('epi', 'source_file')]),
+            (inputnode, gen_ref, [('epi_mask', 'moving_image')]),
+            (inputnode, merge_transforms, [('t1_2_mni_forward_transform', 'in1'),
+                                           (('itk_epi_to_t1', _aslist), 'in2')]),
+            (merge_transforms, compose_transforms, [('out', 'transforms')]),
+            (gen_ref, compose_transforms, [('out_file', 'reference_image')]),
+            (compose_transforms, mask_mni_tfm, [('out_file', 'transforms')]),
+            (gen_ref, mask_mni_tfm, [('out_file', 'reference_image')]),
+            (inputnode, mask_mni_tfm, [('epi_mask', 'input_image')]),
+            (mask_mni_tfm, ds_mni_mask, [('output_image', 'in_file')])
+        ])
+        spaces.append(('MNI', (gen_ref, 'out_file'), (compose_transforms, 'out_file'), ds_mni))
+
+    if spaces:
+        # Resample all the volumes onto all the spaces at once
+        epi_to_mni_transform = pe.Node(ResampleToSpaces(), name='EPIToMNITransform')
+        _set_resampling_resources(epi_to_mni_transform, settings)
+        workflow.connect([
+            (inputnode, epi_to_mni_transform, [('epi', 'in_file'),
+                                               ('hmc_xforms', 'volume_transforms')])
+        ])
+        _connect_spaces(workflow, epi_to_mni_transform, spaces, (inputnode, 'epi'))
 
     return workflow
 
 
+def _set_resampling_resources(resample, settings):
+    """
+    Threads and memory of a :class:`ResampleToSpaces` node, which resamples
+    by tiles to fit in the memory the scheduler reserves for it: the given
+    budget (``resample_mem_gb``), or as estimated for each BOLD run (see
+    :data:`~fmriprep.utils.resources.EPI_MEMORY_MODEL`).
+    """
+    resample.interface.num_threads = settings.get('nthreads') or 1
+    if settings.get('resample_mem_gb'):
+        resample.inputs.memory_gb = settings['resample_mem_gb']
+        resample.interface.estimated_memory_gb = settings['resample_mem_gb']
+    else:
+        resample.interface.estimated_memory_gb = estimate_memory_gb(
+            settings['bold_geometry'], resample.name)
+
+
+def _connect_spaces(workflow, resample, spaces, name_source):
+    """
+    Connects the output spaces of a :class:`ResampleToSpaces` node. Each
+    space is a ``(name, reference, transforms, sink)`` tuple, where
+    ``reference`` and ``transforms`` are ``(node, output)`` pairs (or a list
+    of transform files, for ``transforms``).
+    """
+    merge_refs = pe.Node(niu.Merge(len(spaces)), name='MergeSpaceReferences')
+    merge_xfms = pe.Node(niu.Merge(len(spaces), no_flatten=True),
+                         name='MergeSpaceTransforms')
+    split_outputs = pe.Node(niu.Split(splits=[1] * len(spaces), squeeze=True),
+                            name='SplitSpaces')
+    resample.inputs.out_files = ['%s.nii.gz' % space[0] for space in spaces]
+
+    workflow.connect([
+        (merge_refs, resample, [('out', 'reference_images')]),
+        (merge_xfms, resample, [('out', 'transforms')]),
+        (resample, split_outputs, [('out_files', 'inlist')])
+    ])
+    for index, (_, reference, transforms, sink) in enumerate(spaces, 1):
+        workflow.connect(reference[0], reference[1], merge_refs, 'in%d' % index)
+        if isinstance(transforms, list):
+            setattr(merge_xfms.inputs, 'in%d' % index, transforms)
+        else:
+            workflow.connect(transforms[0], transforms[1], merge_xfms, 'in%d' % index)
+        workflow.connect([
+            (name_source[0], sink, [(name_source[1], 'source_file')]),
+            (split_outputs, sink, [('out%d' % index, 'in_file')])
+        ])
+    return split_outputs
+
+
 # pylint: disable=R0914
 def epi_unwarp(name='EPIUnwarpWorkflow', settings=None):
     """ A workflow to correct EPI images """
@@ -368,7 +461,7 @@ def epi_unwarp(name='EPIUnwarpWorkflow', settings=None):
         name='outputnode'
     )
 
-    unwarp = sdc_unwarp()
+    unwarp = sdc_unwarp(settings=settings)
     unwarp.inputs.inputnode.hmc_movpar = ''
 
     # Compute outputs
@@ -406,23 +499,37 @@ def epi_unwarp(name='EPIUnwarpWorkflow', settings=None):
     return workflow
 
 
-def _gen_reference(fixed_image, moving_image, out_file=None):
+def _gen_reference(fixed_image, moving_image, out_file=None, cache_dir=None):
+    """
+    Resamples ``fixed_image`` (the template) to the zooms of ``moving_image``.
+    The resampled grids are kept in ``cache_dir`` (if given), indexed by the
+    contents of the template and the zooms, and reused by later runs.
+    """
     import os.path as op
     import numpy
     from nilearn.image import resample_img, load_img
+    from fmriprep.utils.cache import FileCache, cache_key
+    from fmriprep.utils.nifti import save_nii, work_file
 
     if out_file is None:
         fname, ext = op.splitext(op.basename(fixed_image))
         if ext == '.gz':
             fname, ext2 = op.splitext(fname)
             ext = ext2 + ext
-        out_file = op.abspath('%s_wm%s' % (fname, ext))
+        out_file = op.abspath(work_file('%s_wm%s' % (fname, ext)))
 
     new_zooms = load_img(moving_image).header.get_zooms()
 
+    cache, key, suffix = None, None, '.nii.gz' if out_file.endswith('.gz') else '.nii'
+    if cache_dir is not None:
+        cache = FileCache(cache_dir)
+        key = cache_key([fixed_image], 'nearest', [float(zoom) for zoom in new_zooms])
+        if cache.get(key, out_file, suffix=suffix):
+            return out_file
+
     new_ref_im = resample_img(fixed_image, target_affine=numpy.diag(new_zooms),
                               interpolation='nearest')
-
-    new_ref_im.to_filename(out_file)
-
+    save_nii(new_ref_im, out_file)
+    if cache is not None:
+        cache.put(key, out_file, suffix=suffix)
     return out_file
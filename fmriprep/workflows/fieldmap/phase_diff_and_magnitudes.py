@@ -189,6 +189,7 @@ def phdiff2fmap(in_file, delta_te, out_file=None):
     import nibabel as nb
     import os.path as op
     import math
+    from fmriprep.utils.nifti import save_nii, work_file
 
     #  GYROMAG_RATIO_H_PROTON_MHZ = 42.576
 
@@ -196,13 +197,12 @@ def phdiff2fmap(in_file, delta_te, out_file=None):
         fname, fext = op.splitext(op.basename(in_file))
         if fext == '.gz':
             fname, _ = op.splitext(fname)
-        out_file = op.abspath('./%s_fmap.nii.gz' % fname)
+        out_file = op.abspath(work_file('./%s_fmap.nii.gz' % fname))
 
     image = nb.load(in_file)
     data = (image.get_data().astype(np.float32) / (2. * math.pi * delta_te))
 
-    nb.Nifti1Image(data, image.affine, image.header).to_filename(out_file)
-    return out_file
+    return save_nii(nb.Nifti1Image(data, image.affine, image.header), out_file)
 
 
 def _delta_te(in_values, te1=None, te2=None):
@@ -11,7 +11,7 @@ from nipype.pipeline import engine as pe
 from niworkflows.interfaces.masks import BETRPT
 
 from fmriprep.utils.misc import _first, gen_list
-from fmriprep.interfaces import ReadSidecarJSON
+from fmriprep.interfaces import ReadSidecarJSON, SplitSeries
 from fmriprep.viz import stripped_brain_overlay
 from fmriprep.workflows.fieldmap.utils import create_encoding_file
 
@@ -51,7 +51,9 @@ def se_fmap_workflow(name=WORKFLOW_NAME, settings=None):
     # Head motion correction
     fslmerge = pe.Node(fsl.Merge(dimension='t'), name='SE_merge')
     hmc_se = pe.Node(fsl.MCFLIRT(cost='normcorr', mean_vol=True), name='SE_head_motion_corr')
-    fslsplit = pe.Node(fsl.Split(dimension='t'), name='SE_split')
+    fslsplit = pe.Node(SplitSeries(), name='SE_split')
+    if settings.get('cache_dir'):
+        fslsplit.inputs.index_dir = settings['cache_dir']
 
     # Run topup to estimate field distortions, do not estimate movement
     # since it is done in hmc_se
@@ -17,12 +17,13 @@ from niworkflows.interfaces.masks import BETRPT
 
 from fmriprep.utils.misc import gen_list
 from fmriprep.interfaces.bids import ReadSidecarJSON
+from fmriprep.interfaces.images import SplitSeries
 from fmriprep.workflows.fieldmap.utils import create_encoding_file
 
 SDC_UNWARP_NAME = 'SDC_unwarp'
 
 
-def sdc_unwarp(name=SDC_UNWARP_NAME, ref_vol=None, method='jac'):
+def sdc_unwarp(name=SDC_UNWARP_NAME, ref_vol=None, method='jac', settings=None):
     """
     This workflow takes an estimated fieldmap and a target image and applies TOPUP,
     an :abbr:`SDC (susceptibility-derived distortion correction)` method in FSL to
@@ -68,7 +69,9 @@ def sdc_unwarp(name=SDC_UNWARP_NAME, ref_vol=None, method='jac'):
         input_names=['input_images', 'in_dict'], output_names=['parameters_file'],
         function=create_encoding_file), name='TopUp_encfile', updatehash=True)
 
-    fslsplit = pe.Node(fsl.Split(dimension='t'), name='ImageHMCSplit')
+    fslsplit = pe.Node(SplitSeries(), name='ImageHMCSplit')
+    if settings and settings.get('cache_dir'):
+        fslsplit.inputs.index_dir = settings['cache_dir']
 
     # Register the reference of the fieldmap to the reference
     # of the target image (the one that shall be corrected)
@@ -179,6 +182,7 @@ def _gen_coeff(in_file, in_ref, in_movpar):
     import numpy as np
     import nibabel as nb
     from nipype.interfaces import fsl
+    from fmriprep.utils.nifti import save_nii, work_file
 
     def _get_fname(in_file):
         import os.path as op
@@ -196,8 +200,8 @@ def _gen_coeff(in_file, in_ref, in_movpar):
     spacings = im0.get_header().get_zooms()[:3]
     im1 = nb.Nifti1Image(data, im0.get_affine(), im0.get_header())
     im4d = nb.concat_images([im0, im1, im1])
-    im4d_fname = '{}_{}'.format(out_topup, 'field4D.nii.gz')
-    im4d.to_filename(im4d_fname)
+    im4d_fname = work_file('{}_{}'.format(out_topup, 'field4D.nii.gz'))
+    save_nii(im4d, im4d_fname)
 
     # 2. Warputils to compute bspline coefficients
     to_coeff = fsl.WarpUtils(out_format='spline', knot_space=(2, 2, 2))
@@ -225,8 +229,8 @@ def _gen_coeff(in_file, in_ref, in_movpar):
     out_movpar = '{}_movpar.txt'.format(out_topup)
     copy(in_movpar, out_movpar)
 
-    out_fieldcoef = '{}_fieldcoef.nii.gz'.format(out_topup)
-    nb.Nifti1Image(img.get_data(), None, hdr).to_filename(out_fieldcoef)
+    out_fieldcoef = work_file('{}_fieldcoef.nii.gz'.format(out_topup))
+    save_nii(nb.Nifti1Image(img.get_data(), None, hdr), out_fieldcoef)
 
     return out_fieldcoef, out_movpar
 
@@ -22,6 +22,7 @@ from niworkflows.interfaces.registration import FLIRTRPT
 
 from fmriprep.utils.misc import _first, gen_list
 from fmriprep.interfaces.utils import reorient
+from fmriprep.interfaces.transforms import ConvertFSLMatrix
 from fmriprep.interfaces import (ReadSidecarJSON, IntraModalMerge,
                                  DerivativesDataSink)
 from fmriprep.workflows.fieldmap import sdc_unwarp
@@ -41,7 +42,7 @@ def sbref_preprocess(name='SBrefPreprocessing', settings=None):
     outputnode = pe.Node(niu.IdentityInterface(fields=['sbref_unwarped', 'sbref_unwarped_mask']),
                          name='outputnode')
     # Unwarping
-    unwarp = sdc_unwarp()
+    unwarp = sdc_unwarp(settings=settings)
     unwarp.inputs.inputnode.hmc_movpar = ''
 
     mean = pe.Node(fsl.MeanImage(dimension='T'), name='SBRefMean')
@@ -86,15 +87,15 @@ def _extract_wm(in_file):
     import os.path as op
     import nibabel as nb
     import numpy as np
+    from fmriprep.utils.nifti import save_nii, work_file
 
     image = nb.load(in_file)
     data = image.get_data().astype(np.uint8)
     data[data != 3] = 0
     data[data > 0] = 1
 
-    out_file = op.abspath('wm_mask.nii.gz')
-    nb.Nifti1Image(data, image.get_affine(), image.get_header()).to_filename(out_file)
-    return out_file
+    out_file = op.abspath(work_file('wm_mask.nii.gz'))
+    return save_nii(nb.Nifti1Image(data, image.get_affine(), image.get_header()), out_file)
 
 ###################################
 # Deprecated code
@@ -151,7 +152,7 @@ def sbref_workflow_deprecated(name='SBrefPreprocessing', settings=None):
                               name="WMSeg_2_SBRef_Brain_Affine_Transform")
 
     invert_wmseg_sbref = pe.Node(
-        fsl.ConvertXFM(invert_xfm=True), name="invert_wmseg_sbref"
+        ConvertFSLMatrix(invert_xfm=True), name="invert_wmseg_sbref"
     )
 
     #  Run the commands from epi_reg_dof
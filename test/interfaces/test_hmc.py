@@ -0,0 +1,207 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+''' Testing module for fmriprep.interfaces.hmc '''
+import os
+import shutil
+import tempfile
+import unittest
+import mock
+
+import nibabel as nb
+import numpy as np
+from nipype.interfaces import fsl
+from nipype.interfaces.base import Bunch
+
+from fmriprep.interfaces.hmc import (
+    CachedMCFLIRT, EstimateReference, ParallelMCFLIRT, screen_volumes)
+
+
+def fake_mcflirt(interface, runtime):
+    ''' Writes the outputs MCFLIRT would, from the input series '''
+    outputs = interface._list_outputs()
+    in_nii = nb.load(interface.inputs.in_file)
+    in_nii.to_filename(outputs['out_file'])
+    nb.Nifti1Image(in_nii.get_fdata().mean(axis=3), in_nii.affine).to_filename(
+        outputs['mean_img'])
+    os.makedirs(os.path.dirname(outputs['mat_file'][0]))
+    for mat_file in outputs['mat_file']:
+        np.savetxt(mat_file, np.eye(4))
+    np.savetxt(outputs['par_file'], np.zeros((len(outputs['mat_file']), 6)))
+    runtime.returncode = 0
+    return runtime
+
+
+def fake_chunk_mcflirt(interface, in_file, **inputs):
+    ''' MCFLIRT on a chunk, whose parameters and matrices hold the volume values '''
+    base = os.path.abspath(os.path.basename(in_file).split('.')[0] + '_mcf')
+    nii = nb.load(in_file)
+    values = nii.get_fdata()[0, 0, 0]
+    nii.to_filename(base + '.nii.gz')
+    nb.Nifti1Image(nii.get_fdata().mean(axis=3), nii.affine).to_filename(base + '_mean.nii.gz')
+    os.makedirs(base + '.mat')
+    mat_files = []
+    for i, value in enumerate(values):
+        matrix = np.eye(4)
+        matrix[0, 3] = value
+        mat_files.append(os.path.join(base + '.mat', 'MAT_%04d' % i))
+        np.savetxt(mat_files[-1], matrix)
+    np.savetxt(base + '.par', np.column_stack([values] * 6))
+    interface.calls.append((in_file, inputs))
+    return Bunch(out_file=base + '.nii.gz', mat_file=mat_files, par_file=base + '.par',
+                 mean_img=base + '_mean.nii.gz')
+
+
+class TestCachedMCFLIRT(unittest.TestCase):
+    ''' Testing class for fmriprep.interfaces.hmc.CachedMCFLIRT '''
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        self.in_file = os.path.join(self.tmpdir, 'bold.nii.gz')
+        nb.Nifti1Image(np.random.rand(4, 4, 4, 3).astype(np.float32),
+                       np.eye(4)).to_filename(self.in_file)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+
+    def _run(self, workdir, **inputs):
+        workdir = os.path.join(self.tmpdir, workdir)
+        os.makedirs(workdir)
+        os.chdir(workdir)
+        hmc = CachedMCFLIRT(in_file=self.in_file, save_mats=True, save_plots=True,
+                            mean_vol=True, cache_dir=os.path.join(self.tmpdir, 'cache'),
+                            **inputs)
+        return hmc.run().outputs
+
+    @mock.patch.object(fsl.Info, 'version', return_value='5.0.9')
+    @mock.patch.object(fsl.MCFLIRT, '_run_interface', autospec=True,
+                       side_effect=fake_mcflirt)
+    def test_cached_mcflirt(self, mock_run, mock_version):
+        first = self._run('work1')
+        self.assertEqual(mock_run.call_count, 1)
+
+        # a fresh working directory retrieves all the results
+        second = self._run('work2')
+        self.assertEqual(mock_run.call_count, 1)
+        self.assertEqual(len(second.mat_file), 3)
+        for name in ('out_file', 'mean_img', 'par_file'):
+            self.assertTrue(os.path.isfile(getattr(second, name)))
+            self.assertNotEqual(getattr(first, name), getattr(second, name))
+        np.testing.assert_array_equal(np.loadtxt(second.mat_file[2]), np.eye(4))
+
+        # other parameters run MCFLIRT again
+        self._run('work3', cost='normcorr')
+        self.assertEqual(mock_run.call_count, 2)
+
+
+class TestParallelMCFLIRT(unittest.TestCase):
+    ''' Testing class for fmriprep.interfaces.hmc.ParallelMCFLIRT '''
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.tmpdir)
+        # volume i holds the value i
+        self.in_file = os.path.join(self.tmpdir, 'bold.nii.gz')
+        nb.Nifti1Image(np.tile(np.arange(11, dtype=np.float32), (3, 3, 3, 1)),
+                       np.eye(4)).to_filename(self.in_file)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+
+    @mock.patch.object(ParallelMCFLIRT, '_mcflirt', autospec=True,
+                       side_effect=fake_chunk_mcflirt)
+    def test_parallel_mcflirt(self, mock_mcflirt):
+        hmc = ParallelMCFLIRT(in_file=self.in_file, num_threads=3)
+        hmc.calls = []
+        self.assertEqual(hmc._chunks(11), [(0, 4), (4, 8), (8, 11)])
+        outputs = hmc.run().outputs
+
+        # all the chunks are registered to the estimated reference
+        self.assertEqual(len(hmc.calls), 3)
+        for _, inputs in hmc.calls:
+            self.assertEqual(inputs['ref_file'], os.path.abspath('reference.nii'))
+        self.assertEqual(nb.load('reference.nii').shape, (3, 3, 3))
+
+        # stitched outputs
+        np.testing.assert_array_equal(nb.load(outputs.out_file).get_fdata()[0, 0, 0],
+                                      np.arange(11))
+        np.testing.assert_array_equal(np.loadtxt(outputs.par_file)[:, 0], np.arange(11))
+        chunk_lines = []
+        for i in range(3):
+            with open('chunk%03d_mcf.par' % i) as chunk_par:
+                chunk_lines += chunk_par.readlines()
+        with open(outputs.par_file) as par_file:
+            self.assertEqual(par_file.readlines(), chunk_lines)
+        self.assertEqual(len(outputs.mat_file), 11)
+        self.assertEqual(np.loadtxt(outputs.mat_file[9])[0, 3], 9)
+        np.testing.assert_allclose(nb.load(outputs.mean_img).get_fdata(), 5.)
+
+    @mock.patch.object(fsl.Info, 'version', return_value='5.0.9')
+    @mock.patch.object(ParallelMCFLIRT, '_mcflirt', autospec=True,
+                       side_effect=fake_chunk_mcflirt)
+    def test_cache(self, mock_mcflirt, mock_version):
+        cache_dir = os.path.join(self.tmpdir, 'cache')
+        for i, num_threads in enumerate((3, 2)):
+            os.makedirs('work%d' % i)
+            os.chdir('work%d' % i)
+            hmc = ParallelMCFLIRT(in_file=self.in_file, num_threads=num_threads,
+                                  cache_dir=cache_dir)
+            hmc.calls = []
+            outputs = hmc.run().outputs
+            os.chdir(self.tmpdir)
+
+        # the number of threads does not invalidate the cache
+        self.assertEqual(mock_mcflirt.call_count, 3)
+        self.assertEqual(len(outputs.mat_file), 11)
+
+    def test_not_a_series(self):
+        in_file = os.path.join(self.tmpdir, 'volume.nii.gz')
+        nb.Nifti1Image(np.zeros((3, 3, 3), dtype=np.float32), np.eye(4)).to_filename(in_file)
+        with self.assertRaises(ValueError):
+            ParallelMCFLIRT(in_file=in_file).run()
+
+    def test_chunks(self):
+        # the last chunk is never a single volume
+        hmc = ParallelMCFLIRT(in_file=self.in_file, chunk_size=5)
+        self.assertEqual(hmc._chunks(11), [(0, 5), (5, 11)])
+        hmc = ParallelMCFLIRT(in_file=self.in_file, num_threads=8)
+        self.assertEqual(hmc._chunks(5), [(0, 2), (2, 5)])
+
+
+class TestEstimateReference(unittest.TestCase):
+    ''' Testing class for fmriprep.interfaces.hmc.EstimateReference '''
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.tmpdir)
+
+        rng = np.random.RandomState(0)
+        pattern = rng.rand(16, 16, 16).astype(np.float32) * 100 + 500
+        series = np.stack([pattern + rng.rand(16, 16, 16) for _ in range(20)], axis=3)
+        series[..., 0] *= 1.5  # before the steady state
+        series[..., 3] = np.roll(pattern, 2, axis=0)  # moved
+        self.in_file = os.path.join(self.tmpdir, 'bold.nii.gz')
+        nb.Nifti1Image(series.astype(np.float32), np.eye(4)).to_filename(self.in_file)
+        self.series = series
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+
+    def test_screen_volumes(self):
+        self.assertEqual(screen_volumes(self.in_file, 18),
+                         [i for i in range(20) if i not in (0, 3)])
+        # only volumes 0, 5, 10, 14 and 19 are screened
+        self.assertEqual(screen_volumes(self.in_file, 4, candidates=5), [5, 10, 14, 19])
+
+    def test_estimate_reference(self):
+        outputs = EstimateReference(in_file=self.in_file, nvols=5).run().outputs
+        self.assertEqual(len(outputs.volumes), 5)
+        self.assertFalse(set(outputs.volumes) & set([0, 3]))
+        np.testing.assert_allclose(nb.load(outputs.ref_file).get_fdata(),
+                                   self.series[..., outputs.volumes].mean(axis=3),
+                                   rtol=1e-5)
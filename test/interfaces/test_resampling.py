@@ -0,0 +1,158 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+''' Testing module for fmriprep.interfaces.resampling '''
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+import nibabel as nb
+import numpy as np
+
+from fmriprep.interfaces.resampling import (
+    ComposeTransforms, ResampleToSpaces, plan_tiles)
+
+ITK_TRANSLATION = '''#Insight Transform File V1.0
+#Transform 0
+Transform: MatrixOffsetTransformBase_double_3_3
+Parameters: 1 0 0 0 1 0 0 0 1 {} {} {}
+FixedParameters: 0 0 0
+'''
+
+
+def _resample(in_file, reference_image, transforms, out_file='resampled.nii.gz', **inputs):
+    ''' Resamples onto a single space, returns the output file '''
+    return ResampleToSpaces(in_file=in_file, reference_images=[reference_image],
+                            transforms=[transforms], out_files=[out_file],
+                            **inputs).run().outputs.out_files[0]
+
+
+class TestResampleToSpaces(unittest.TestCase):
+    ''' Testing class for fmriprep.interfaces.resampling.ResampleToSpaces '''
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.tmpdir)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+
+    @staticmethod
+    def _write_translation(fname, translation):
+        with open(fname, 'w') as tfm_file:
+            tfm_file.write(ITK_TRANSLATION.format(*translation))
+        return os.path.abspath(fname)
+
+    def test_resample_series(self):
+        affine = np.diag([2., 2., 2., 1.])
+        data = np.random.RandomState(0).rand(10, 12, 8, 4).astype(np.float32)
+        nb.Nifti1Image(data, affine).to_filename('epi.nii.gz')
+        nb.Nifti1Image(data[..., 0], affine).to_filename('ref.nii.gz')
+
+        # One voxel along R for all volumes (-2mm along L), one voxel per
+        # volume along S
+        shared = self._write_translation('shared.txt', (-2, 0, 0))
+        hmc = [self._write_translation('hmc%d.txt' % vol, (0, 0, 2 * vol))
+               for vol in range(4)]
+
+        resampled = nb.load(_resample('epi.nii.gz', 'ref.nii.gz', [shared],
+                                      volume_transforms=hmc, num_threads=2)).get_data()
+
+        self.assertEqual(resampled.shape, data.shape)
+        for vol in range(4):
+            np.testing.assert_allclose(resampled[:-1, :, :8 - vol, vol],
+                                       data[1:, :, vol:, vol])
+            self.assertFalse(resampled[-1, :, :, vol].any())
+
+    def test_resample_to_spaces(self):
+        affine = np.diag([2., 2., 2., 1.])
+        data = np.random.RandomState(0).rand(10, 12, 8, 3).astype(np.float32)
+        nb.Nifti1Image(data, affine).to_filename('epi.nii.gz')
+        nb.Nifti1Image(data[..., 0], affine).to_filename('ref.nii.gz')
+        # a coarser grid for the second space
+        nb.Nifti1Image(data[:5, :6, :4, 0], np.diag([4., 4., 4., 1.])).to_filename(
+            'coarse.nii.gz')
+        shared = self._write_translation('shared.txt', (-2, 0, 0))
+        hmc = [self._write_translation('hmc%d.txt' % vol, (0, 0, 2 * vol))
+               for vol in range(3)]
+
+        result = ResampleToSpaces(
+            in_file='epi.nii.gz', reference_images=['ref.nii.gz', 'coarse.nii.gz'],
+            transforms=[[], shared], volume_transforms=hmc,
+            out_files=['native.nii.gz', 'coarse.nii.gz'], num_threads=2).run()
+        self.assertEqual([os.path.basename(fname) for fname in result.outputs.out_files],
+                         ['native.nii.gz', 'coarse.nii.gz'])
+
+        # the native space only undoes the volume transforms
+        native = nb.load(result.outputs.out_files[0]).get_data()
+        for vol in range(3):
+            np.testing.assert_allclose(native[:, :, :8 - vol, vol], data[:, :, vol:, vol])
+
+        # the other space matches its own resampling
+        expected = _resample('epi.nii.gz', 'coarse.nii.gz', [shared], volume_transforms=hmc,
+                             out_file='expected.nii.gz')
+        coarse = nb.load(result.outputs.out_files[1])
+        np.testing.assert_allclose(coarse.get_data(), nb.load(expected).get_data())
+        np.testing.assert_allclose(coarse.affine, np.diag([4., 4., 4., 1.]))
+
+    def test_tiled_resampling(self):
+        affine = np.diag([2., 2., 2., 1.])
+        data = np.random.RandomState(0).rand(10, 12, 8, 5).astype(np.float32)
+        nb.Nifti1Image(data, affine).to_filename('epi.nii.gz')
+        nb.Nifti1Image(data[..., 0], affine).to_filename('ref.nii.gz')
+        shared = self._write_translation('shared.txt', (-1, 0.5, 1))
+        hmc = [self._write_translation('hmc%d.txt' % vol, (0, 0, vol))
+               for vol in range(5)]
+
+        expected = _resample('epi.nii.gz', 'ref.nii.gz', [shared], volume_transforms=hmc,
+                             out_file='whole.nii.gz')
+        # a tiny budget resamples one slice and num_threads volumes at a time
+        tiled = _resample('epi.nii.gz', 'ref.nii.gz', [shared], volume_transforms=hmc,
+                          num_threads=2, memory_gb=0.01, out_file='tiled.nii.gz')
+        np.testing.assert_allclose(nb.load(tiled).get_data(), nb.load(expected).get_data())
+
+    def test_plan_tiles(self):
+        # whole grids without a budget
+        self.assertEqual(plan_tiles([(10, 10, 10)], 4000, 100, num_threads=4),
+                         (4, [10], True))
+        # whole grids, points kept, with a large budget
+        chunk, slabs, keep_points = plan_tiles([(100, 100, 100)], 4e5, 100,
+                                               num_threads=4, memory_gb=4)
+        self.assertEqual((chunk, slabs, keep_points), (100, [100], True))
+        # slabs under a smaller budget
+        chunk, slabs, keep_points = plan_tiles([(200, 200, 200)], 4e6, 200,
+                                               num_threads=4, memory_gb=1)
+        self.assertFalse(keep_points)
+        self.assertTrue(4 <= chunk < 200)
+        self.assertTrue(1 <= slabs[0] < 200)
+
+    def test_compose_transforms(self):
+        affine = np.diag([2., 2., 2., 1.])
+        data = np.random.RandomState(0).rand(10, 12, 8, 2).astype(np.float32)
+        nb.Nifti1Image(data, affine).to_filename('epi.nii.gz')
+        nb.Nifti1Image(data[..., 0], affine).to_filename('ref.nii.gz')
+        transforms = [self._write_translation('first.txt', (-2, 0, 0)),
+                      self._write_translation('second.txt', (0, 2, 2))]
+
+        composed = ComposeTransforms(transforms=transforms, reference_image='ref.nii.gz',
+                                     cache_dir=os.path.abspath('cache')).run()
+        field = nb.load(composed.outputs.out_file)
+        self.assertEqual(field.shape, (10, 12, 8, 1, 3))
+        np.testing.assert_allclose(field.get_data()[2, 3, 4, 0], [-2, 2, 2])
+
+        # resampling with the composed field matches the chain of transforms
+        expected = _resample('epi.nii.gz', 'ref.nii.gz', transforms, out_file='chain.nii.gz')
+        result = _resample('epi.nii.gz', 'ref.nii.gz', [composed.outputs.out_file])
+        np.testing.assert_allclose(nb.load(result).get_data(), nb.load(expected).get_data(),
+                                   atol=1e-5)
+
+        # the field is reused from the cache
+        os.remove(composed.outputs.out_file)
+        with mock.patch('fmriprep.interfaces.resampling.compose_field') as mock_compose:
+            cached = ComposeTransforms(transforms=transforms, reference_image='ref.nii.gz',
+                                       cache_dir=os.path.abspath('cache')).run()
+        self.assertFalse(mock_compose.called)
+        self.assertTrue(os.path.isfile(cached.outputs.out_file))
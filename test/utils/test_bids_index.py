@@ -0,0 +1,114 @@
+''' Testing module for fmriprep.utils.bids_index '''
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from collections import namedtuple
+
+import mock
+
+from fmriprep.utils import bids_index
+
+BIDSFile = namedtuple('BIDSFile', ['filename', 'subject', 'session', 'run', 'task'])
+
+
+def _fake_get(**query):
+    ''' mimics BIDSLayout.get() on a two-subject dataset '''
+    files = {
+        'T1w': [BIDSFile('/ds/sub-01/anat/sub-01_T1w.nii.gz', '01', None, None, None),
+                BIDSFile('/ds/sub-02/anat/sub-02_T1w.nii.gz', '02', None, None, None)],
+        'bold': [BIDSFile('/ds/sub-01/func/sub-01_task-a_run-2_bold.nii.gz',
+                          '01', None, '2', 'a'),
+                 BIDSFile('/ds/sub-01/func/sub-01_task-a_run-1_bold.nii.gz',
+                          '01', None, '1', 'a'),
+                 BIDSFile('/ds/sub-01/func/sub-01_task-b_bold.nii.gz',
+                          '01', None, None, 'b')],
+    }
+    return files.get(query.get('type'), [])
+
+
+class TestBIDSIndex(unittest.TestCase):
+    ''' Testing class for fmriprep.utils.bids_index '''
+
+    def setUp(self):
+        self.dataset = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.dataset, 'sub-01', 'func'))
+        self.index_file = os.path.join(tempfile.mkdtemp(), 'index.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.dataset)
+        shutil.rmtree(os.path.dirname(self.index_file))
+
+    @mock.patch.object(bids_index, 'BIDSLayout')
+    def test_queries(self, mock_layout):
+        mock_layout.return_value.get.side_effect = _fake_get
+
+        index = bids_index.BIDSIndex(self.dataset)
+
+        self.assertEqual(index.subjects(), ['01', '02'])
+        self.assertEqual(index.get('t1w', 'sub-02'),
+                         ['/ds/sub-02/anat/sub-02_T1w.nii.gz'])
+        self.assertEqual(index.get('epi', '01', task='a'),
+                         ['/ds/sub-01/func/sub-01_task-a_run-1_bold.nii.gz',
+                          '/ds/sub-01/func/sub-01_task-a_run-2_bold.nii.gz'])
+        self.assertEqual(index.get('sbref', '01'), [])
+
+    @mock.patch.object(bids_index, 'BIDSLayout')
+    def test_persistence(self, mock_layout):
+        mock_layout.return_value.get.side_effect = _fake_get
+
+        first = bids_index.BIDSIndex(self.dataset, index_file=self.index_file)
+        second = bids_index.BIDSIndex(self.dataset, index_file=self.index_file)
+
+        # the layout is only walked once, the second index is read from disk
+        self.assertEqual(mock_layout.call_count, 1)
+        self.assertEqual(first.get('epi', '01'), second.get('epi', '01'))
+
+    @mock.patch.object(bids_index, 'BIDSLayout')
+    def test_mode(self, mock_layout):
+        mock_layout.return_value.get.side_effect = _fake_get
+        mask = os.umask(0o022)
+        try:
+            bids_index.BIDSIndex(self.dataset, index_file=self.index_file)
+        finally:
+            os.umask(mask)
+
+        # the index is readable by the users sharing the working directory
+        self.assertEqual(os.stat(self.index_file).st_mode & 0o777, 0o644)
+
+    @mock.patch.object(bids_index.BIDSIndex, '_build', return_value=[{'query': 't1w'}])
+    def test_failed_write(self, mock_build):
+        # records missing their filename and entities cannot be written
+        with self.assertRaises(KeyError):
+            bids_index.BIDSIndex(self.dataset, index_file=self.index_file)
+
+        # no index, nor temporary file, is left behind
+        self.assertEqual(os.listdir(os.path.dirname(self.index_file)), [])
+
+    @mock.patch.object(bids_index, 'BIDSLayout')
+    def test_invalidation(self, mock_layout):
+        mock_layout.return_value.get.side_effect = _fake_get
+
+        bids_index.BIDSIndex(self.dataset, index_file=self.index_file)
+
+        # adding a file changes the mtime of its directory
+        time.sleep(0.01)
+        open(os.path.join(self.dataset, 'sub-01', 'func', 'new_bold.nii.gz'), 'w').close()
+        bids_index.BIDSIndex(self.dataset, index_file=self.index_file)
+
+        self.assertEqual(mock_layout.call_count, 2)
+
+    @mock.patch.object(bids_index, 'BIDSLayout')
+    def test_run_filters(self, mock_layout):
+        mock_layout.return_value.get.side_effect = _fake_get
+
+        index = bids_index.BIDSIndex(self.dataset)
+
+        # labels may be given with their prefix and zero-padding
+        self.assertEqual(index.get('epi', '01', run='run-02'),
+                         ['/ds/sub-01/func/sub-01_task-a_run-2_bold.nii.gz'])
+        self.assertEqual(index.get('epi', '01', task='task-b'),
+                         ['/ds/sub-01/func/sub-01_task-b_bold.nii.gz'])
+        # files without the entity do not match
+        self.assertEqual(index.get('epi', '01', session='1'), [])
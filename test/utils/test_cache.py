@@ -0,0 +1,41 @@
+''' Testing module for fmriprep.utils.cache '''
+import os
+import shutil
+import tempfile
+import unittest
+
+from fmriprep.utils.cache import FileCache, cache_key
+
+
+class TestFileCache(unittest.TestCase):
+    ''' Testing class for fmriprep.utils.cache.FileCache '''
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.in_file = os.path.join(self.tmpdir, 'input.txt')
+        with open(self.in_file, 'w') as fobj:
+            fobj.write('some contents')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_cache_key(self):
+        key = cache_key([self.in_file], 'param')
+        self.assertEqual(key, cache_key([self.in_file], 'param'))
+        self.assertNotEqual(key, cache_key([self.in_file], 'other'))
+
+        # keys depend on the contents of the files, not their names
+        copied = os.path.join(self.tmpdir, 'copy.txt')
+        shutil.copy(self.in_file, copied)
+        self.assertEqual(key, cache_key([copied], 'param'))
+
+    def test_get_put(self):
+        cache = FileCache(os.path.join(self.tmpdir, 'cache'))
+        out_file = os.path.join(self.tmpdir, 'output.txt')
+        key = cache_key([self.in_file])
+
+        self.assertFalse(cache.get(key, out_file))
+        cache.put(key, self.in_file)
+        self.assertTrue(cache.get(key, out_file))
+        with open(out_file) as fobj:
+            self.assertEqual(fobj.read(), 'some contents')
@@ -0,0 +1,47 @@
+''' Testing module for fmriprep.utils.cleanup '''
+import os
+import shutil
+import tempfile
+import unittest
+
+from fmriprep.utils.cleanup import CollectedOutputs, image_files, output_files
+
+
+class TestCleanup(unittest.TestCase):
+    ''' Testing class for fmriprep.utils.cleanup '''
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.node_dir = os.path.join(self.tmpdir, 'wf', 'node')
+        os.makedirs(os.path.join(self.node_dir, 'mapflow', '_node0'))
+        self.files = {}
+        for fname in ['bold.nii.gz', 'xfm.h5', 'result_node.pklz', 'report.json',
+                      os.path.join('mapflow', '_node0', 'vol0000.nii')]:
+            self.files[fname] = os.path.join(self.node_dir, fname)
+            open(self.files[fname], 'w').close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_image_files(self):
+        self.assertEqual(
+            sorted(image_files(self.node_dir)),
+            sorted([self.files['bold.nii.gz'], self.files['xfm.h5'],
+                    self.files[os.path.join('mapflow', '_node0', 'vol0000.nii')]]))
+
+    def test_output_files(self):
+        outputs = {'out_file': self.files['bold.nii.gz'],
+                   'out_list': [[self.files['xfm.h5']], 'not a file'],
+                   'out_value': 3, 'out_undefined': None}
+        self.assertEqual(sorted(output_files(outputs)),
+                         sorted([self.files['bold.nii.gz'], self.files['xfm.h5']]))
+
+    def test_ledger(self):
+        ledger_file = os.path.join(self.tmpdir, 'collected.sqlite')
+        collected = CollectedOutputs(ledger_file)
+        self.assertNotIn(self.node_dir, collected)
+
+        collected.add(self.node_dir)
+        self.assertIn(self.node_dir, collected)
+        # the ledger persists across runs
+        self.assertIn(self.node_dir, CollectedOutputs(ledger_file))
@@ -0,0 +1,45 @@
+''' Testing module for fmriprep.utils.multiproc '''
+import unittest
+
+import numpy as np
+from nipype.interfaces.base import Bunch
+
+from fmriprep.utils.multiproc import MultiProcPlugin, min_threads
+
+
+class TestAllotThreads(unittest.TestCase):
+    ''' Testing class for fmriprep.utils.multiproc.MultiProcPlugin._allot_threads '''
+
+    def _plugin(self, processors, max_threads, priority):
+        # the plugin is not started, only its queue is filled in
+        plugin = MultiProcPlugin.__new__(MultiProcPlugin)
+        plugin.processors = processors
+        plugin.procs = [Bunch(_interface=Bunch(num_threads=threads))
+                        for threads in max_threads]
+        plugin.proc_pending = np.zeros(len(max_threads), dtype=bool)
+        plugin.depidx = np.zeros((len(max_threads), len(max_threads)))
+        plugin._priority = priority
+        plugin._max_threads = dict(enumerate(max_threads))
+        plugin._min_threads = dict(
+            (jobid, min_threads(proc._interface, threads))
+            for jobid, (proc, threads) in enumerate(zip(plugin.procs, max_threads)))
+        return plugin
+
+    def test_min_threads(self):
+        self.assertEqual(min_threads(Bunch(), 1), 1)
+        self.assertEqual(min_threads(Bunch(), 7), 4)
+        self.assertEqual(min_threads(Bunch(min_threads=6), 8), 6)
+        self.assertEqual(min_threads(Bunch(min_threads=16), 8), 8)
+
+    def test_allot_threads(self):
+        # two ANTs jobs and six single-threaded jobs on 8 processors: the
+        # ANTs jobs are not left with a single thread
+        plugin = self._plugin(8, [8, 8, 1, 1, 1, 1, 1, 1],
+                              [3600., 100., 10., 10., 10., 10., 10., 10.])
+        plugin._allot_threads(list(range(8)))
+        self.assertEqual([proc._interface.num_threads for proc in plugin.procs[:2]], [4, 4])
+
+        # the spare processors go to the job on the longest path first
+        plugin = self._plugin(16, [8, 8, 1, 1], [100., 3600., 10., 10.])
+        plugin._allot_threads(list(range(4)))
+        self.assertEqual([proc._interface.num_threads for proc in plugin.procs[:2]], [6, 8])
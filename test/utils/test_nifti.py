@@ -0,0 +1,141 @@
+''' Testing module for fmriprep.utils.nifti '''
+import gzip
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import mock
+
+import nibabel as nb
+import numpy as np
+
+from fmriprep.utils.nifti import (
+    UNCOMPRESSED_VARIABLE, VolumeReader, concat_volumes, gzip_file, save_nii, work_file)
+
+
+class TestConcatVolumes(unittest.TestCase):
+    ''' Testing class for fmriprep.utils.nifti.concat_volumes '''
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.affine = np.diag([2., 2., 2., 1.])
+        self.affine[:3, 3] = [-10, 4, 2]
+        rng = np.random.RandomState(0)
+        self.volumes = [rng.randint(0, 1000, (5, 6, 7)).astype(np.int16)
+                        for _ in range(3)]
+        self.in_files = []
+        for idx, volume in enumerate(self.volumes):
+            self.in_files.append(os.path.join(self.tmpdir, 'vol%d.nii.gz' % idx))
+            nb.Nifti1Image(volume, self.affine).to_filename(self.in_files[-1])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_concat_3d(self):
+        for ext in ['.nii', '.nii.gz']:
+            out_file = concat_volumes(self.in_files,
+                                      os.path.join(self.tmpdir, 'merged' + ext))
+            merged = nb.load(out_file)
+            self.assertEqual(merged.shape, (5, 6, 7, 3))
+            self.assertEqual(merged.get_data_dtype(), np.int16)
+            np.testing.assert_allclose(merged.affine, self.affine)
+            np.testing.assert_array_equal(np.asarray(merged.dataobj),
+                                          np.stack(self.volumes, axis=-1))
+
+    def test_concat_4d_scaled(self):
+        series = os.path.join(self.tmpdir, 'series.nii')
+        nb.Nifti1Image(np.stack(self.volumes[:2], axis=-1), self.affine).to_filename(series)
+        scaled = os.path.join(self.tmpdir, 'scaled.nii.gz')
+        scaled_data = np.random.RandomState(1).rand(5, 6, 7).astype(np.float32)
+        scaled_nii = nb.Nifti1Image(scaled_data, self.affine)
+        scaled_nii.set_data_dtype(np.int16)
+        scaled_nii.to_filename(scaled)
+
+        merged = nb.load(concat_volumes([series, scaled],
+                                        os.path.join(self.tmpdir, 'merged.nii.gz')))
+        self.assertEqual(merged.shape, (5, 6, 7, 3))
+        self.assertEqual(merged.get_data_dtype(), np.float32)
+        data = np.asarray(merged.dataobj)
+        np.testing.assert_array_equal(data[..., :2], np.stack(self.volumes[:2], axis=-1))
+        np.testing.assert_allclose(data[..., 2], scaled_data, atol=1e-3)
+
+
+class TestGzipFile(unittest.TestCase):
+    ''' Testing class for fmriprep.utils.nifti.gzip_file '''
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_gzip_file(self):
+        in_file = os.path.join(self.tmpdir, 'data.bin')
+        out_file = os.path.join(self.tmpdir, 'data.bin.gz')
+        for nbytes in [0, 10, 4096, 4096 * 5 + 1]:
+            data = np.random.RandomState(0).randint(0, 4, nbytes).astype(np.uint8).tobytes()
+            with open(in_file, 'wb') as fobj:
+                fobj.write(data)
+            gzip_file(in_file, out_file, compresslevel=1, num_threads=3, blocksize=4096)
+            # Readable by the standard gzip reader
+            with gzip.open(out_file, 'rb') as fobj:
+                self.assertEqual(fobj.read(), data)
+
+    def test_save_nii(self):
+        nii = nb.Nifti1Image(np.random.RandomState(0).rand(5, 6, 7).astype(np.float32),
+                             np.eye(4))
+        out_file = save_nii(nii, os.path.join(self.tmpdir, 'image.nii.gz'), num_threads=2)
+        np.testing.assert_array_equal(nb.load(out_file).get_fdata(), nii.get_fdata())
+        self.assertEqual(os.listdir(self.tmpdir), ['image.nii.gz'])
+
+
+class TestWorkFile(unittest.TestCase):
+    ''' Testing class for fmriprep.utils.nifti.work_file '''
+
+    def test_compressed(self):
+        with mock.patch.dict(os.environ, {UNCOMPRESSED_VARIABLE: '0'}):
+            self.assertEqual(work_file('merged.nii.gz'), 'merged.nii.gz')
+
+    def test_uncompressed(self):
+        with mock.patch.dict(os.environ, {UNCOMPRESSED_VARIABLE: '1'}):
+            self.assertEqual(work_file('merged.nii.gz'), 'merged.nii')
+            self.assertEqual(work_file('merged.nii'), 'merged.nii')
+            self.assertEqual(work_file('confounds.tsv'), 'confounds.tsv')
+
+
+class TestVolumeReader(unittest.TestCase):
+    ''' Testing class for fmriprep.utils.nifti.VolumeReader '''
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.data = np.random.RandomState(0).rand(4, 5, 6, 7).astype(np.float32)
+        self.in_file = os.path.join(self.tmpdir, 'series.nii.gz')
+        nb.Nifti1Image(self.data, np.eye(4)).to_filename(self.in_file)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _check_reader(self, index_dir=None):
+        with VolumeReader(self.in_file, index_dir=index_dir) as reader:
+            self.assertEqual(len(reader), 7)
+            for i in [5, 0, -1, 3]:
+                np.testing.assert_array_equal(reader[i], self.data[..., i])
+            self.assertRaises(IndexError, reader.__getitem__, 7)
+
+    def test_sequential_fallback(self):
+        with mock.patch.dict(sys.modules, {'indexed_gzip': None}):
+            self._check_reader()
+
+    def test_index(self):
+        try:
+            import indexed_gzip  # pylint: disable=unused-variable
+        except ImportError:
+            raise unittest.SkipTest('indexed_gzip is not installed')
+        index_dir = os.path.join(self.tmpdir, 'cache')
+        self._check_reader(index_dir)
+        self.assertEqual(len([fname for _, _, fnames in os.walk(index_dir)
+                              for fname in fnames if fname.endswith('.gzidx')]), 1)
+        # The stored index is reused
+        self._check_reader(index_dir)
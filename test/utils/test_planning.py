@@ -0,0 +1,55 @@
+''' Testing module for fmriprep.utils.planning '''
+import unittest
+
+from fmriprep.utils.planning import WORK_DISK_MODEL, _disk_gb, simulate_schedule
+
+
+def _job(duration, threads=1, mem_gb=1.):
+    return {'duration': duration, 'threads': threads, 'mem_gb': mem_gb}
+
+
+class TestSimulateSchedule(unittest.TestCase):
+    ''' Testing class for fmriprep.utils.planning.simulate_schedule '''
+
+    def test_critical_path_first(self):
+        # job 0 -> job 1 is the critical path, jobs 2 and 3 are short
+        jobs = [_job(10.), _job(10.), _job(5.), _job(5.)]
+        children = [[1], [], [], []]
+
+        makespan, peak_mem = simulate_schedule(jobs, children, n_procs=1, memory_gb=4.)
+        self.assertEqual(makespan, 30.)
+        self.assertEqual(peak_mem, 1.)
+
+        makespan, peak_mem = simulate_schedule(jobs, children, n_procs=2, memory_gb=4.)
+        self.assertEqual(makespan, 20.)
+        self.assertEqual(peak_mem, 2.)
+
+    def test_memory_bound(self):
+        jobs = [_job(10., mem_gb=3.), _job(10., mem_gb=3.)]
+
+        makespan, peak_mem = simulate_schedule(jobs, [[], []], n_procs=2, memory_gb=4.)
+        self.assertEqual(makespan, 20.)
+        self.assertEqual(peak_mem, 3.)
+
+    def test_oversized_jobs_are_capped(self):
+        jobs = [_job(10., threads=8, mem_gb=16.)]
+
+        makespan, peak_mem = simulate_schedule(jobs, [[]], n_procs=2, memory_gb=4.)
+        self.assertEqual(makespan, 10.)
+        self.assertEqual(peak_mem, 4.)
+
+
+class TestDiskModel(unittest.TestCase):
+    ''' Testing class for fmriprep.utils.planning._disk_gb '''
+
+    def test_disk_gb(self):
+        bold = {'shape': (64, 64, 32), 'nvols': 256, 'zooms': (3., 3., 3.)}
+        context = {'bold': bold, 'mni_grid': dict(bold, nvols=1)}
+
+        self.assertAlmostEqual(_disk_gb(WORK_DISK_MODEL['EPI_hmc'], context), 0.0625)
+        self.assertAlmostEqual(_disk_gb(WORK_DISK_MODEL['EPI_hmc'], context,
+                                        compressed=False), 0.125)
+        # the displacement field has three components, but a single volume
+        self.assertAlmostEqual(_disk_gb(WORK_DISK_MODEL['ComposeTransforms'], context),
+                               0.0625 * 3 / 256)
+        self.assertEqual(_disk_gb(WORK_DISK_MODEL['Segmentation'], {'t1': None}), 0.0)
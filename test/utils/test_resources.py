@@ -0,0 +1,61 @@
+''' Testing module for fmriprep.utils.resources '''
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from fmriprep.utils.resources import ResourceProfiles, estimate_duration, NODE_DURATIONS
+
+
+class TestResourceProfiles(unittest.TestCase):
+    ''' Testing class for fmriprep.utils.resources.ResourceProfiles '''
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.profiles = ResourceProfiles(os.path.join(self.tmpdir, 'profiles.sqlite'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _record(self, node_dir, geometry, mem_gb, cpu_time, wall_time):
+        self.profiles.record({'node_dir': node_dir, 'interface': 'MCFLIRT',
+                              'node': 'EPI_hmc', 'geometry': geometry,
+                              'mem_gb': mem_gb, 'cpu_time': cpu_time,
+                              'wall_time': wall_time})
+
+    def test_predict(self):
+        self.assertEqual(self.profiles.predict('MCFLIRT', 'EPI_hmc'), (None, None))
+
+        self._record('/work/run-1/EPI_hmc', '64x64x32x200', 1.0, 30., 10.)
+        self._record('/work/run-2/EPI_hmc', '96x96x60x400', 4.0, 100., 100.)
+
+        # profiles of the same geometry are preferred
+        mem_gb, threads = self.profiles.predict('MCFLIRT', 'EPI_hmc', ['64x64x32x200'])
+        self.assertAlmostEqual(mem_gb, 1.0 * ResourceProfiles.memory_margin)
+        self.assertEqual(threads, 3)
+
+        # otherwise, the largest memory among all the profiles of the node
+        mem_gb, _ = self.profiles.predict('MCFLIRT', 'EPI_hmc', ['10x10x10x10'])
+        self.assertAlmostEqual(mem_gb, 4.0 * ResourceProfiles.memory_margin)
+
+    def test_rerun_replaces_profile(self):
+        self._record('/work/run-1/EPI_hmc', '64x64x32x200', 1.0, 30., 10.)
+        self._record('/work/run-1/EPI_hmc', '64x64x32x200', 2.0, 10., 10.)
+
+        self.assertEqual(self.profiles.predict('MCFLIRT', 'EPI_hmc'),
+                         (2.0 * ResourceProfiles.memory_margin, 1))
+
+    def test_durations(self):
+        self._record('/work/run-1/EPI_hmc', '64x64x32x200', 1.0, 30., 10.)
+        self._record('/work/run-2/EPI_hmc', '64x64x32x200', 1.0, 30., 20.)
+
+        durations = self.profiles.durations()
+        self.assertEqual(durations, {('MCFLIRT', 'EPI_hmc'): 15.})
+
+        node = mock.Mock()
+        node.name = 'EPI_hmc'
+        node.interface.__class__.__name__ = 'MCFLIRT'
+        self.assertEqual(estimate_duration(node, durations), 15.)
+        self.assertEqual(estimate_duration(node), NODE_DURATIONS['EPI_hmc'])
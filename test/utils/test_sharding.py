@@ -0,0 +1,65 @@
+''' Testing module for fmriprep.utils.sharding '''
+import shutil
+import tempfile
+import multiprocessing
+import unittest
+
+from fmriprep.utils import sharding
+
+
+def _lock_subjects(lock_dir, subject_list):
+    ''' locks subjects from another process, without releasing them '''
+    sharding.SubjectLocks(lock_dir).acquire(subject_list)
+
+
+class TestSharding(unittest.TestCase):
+    ''' Testing class for fmriprep.utils.sharding '''
+
+    def test_assign_shards(self):
+        costs = {'01': 10, '02': 7, '03': 6, '04': 5, '05': 4, '06': 1}
+        shards = sharding.assign_shards(costs, 3)
+
+        self.assertEqual(shards, [['01', '06'], ['02', '05'], ['03', '04']])
+        # every subject is in exactly one shard
+        self.assertEqual(sorted(sum(shards, [])), sorted(costs))
+        # the assignment does not depend on the order of the subjects
+        self.assertEqual(sharding.assign_shards(dict(reversed(list(costs.items()))), 3),
+                         shards)
+
+    def test_more_shards_than_subjects(self):
+        self.assertEqual(sharding.assign_shards({'01': 1, '02': 1}, 3),
+                         [['01'], ['02'], []])
+
+    def test_shard_from_environ(self):
+        self.assertEqual(sharding.shard_from_environ({}), (None, None))
+        self.assertEqual(sharding.shard_from_environ(
+            {'FMRIPREP_SHARD_INDEX': '2', 'FMRIPREP_SHARD_COUNT': '4'}), (2, 4))
+        self.assertEqual(sharding.shard_from_environ(
+            {'SLURM_ARRAY_TASK_ID': '11', 'SLURM_ARRAY_TASK_MIN': '10',
+             'SLURM_ARRAY_TASK_COUNT': '5'}), (1, 5))
+        # --array=10-18:2
+        self.assertEqual(sharding.shard_from_environ(
+            {'SLURM_ARRAY_TASK_ID': '14', 'SLURM_ARRAY_TASK_MIN': '10',
+             'SLURM_ARRAY_TASK_MAX': '18', 'SLURM_ARRAY_TASK_STEP': '2',
+             'SLURM_ARRAY_TASK_COUNT': '5'}), (2, 5))
+        self.assertEqual(sharding.shard_from_environ(
+            {'SGE_TASK_ID': '3', 'SGE_TASK_FIRST': '1', 'SGE_TASK_LAST': '8',
+             'SGE_TASK_STEPSIZE': '1'}), (2, 8))
+        self.assertEqual(sharding.shard_from_environ({'SGE_TASK_ID': 'undefined'}),
+                         (None, None))
+
+    def test_subject_locks(self):
+        lock_dir = tempfile.mkdtemp()
+        try:
+            # another process holds the lock of subject 02
+            proc = multiprocessing.Process(target=_lock_subjects, args=(lock_dir, ['02']))
+            proc.start()
+            proc.join()
+
+            with sharding.SubjectLocks(lock_dir) as locks:
+                self.assertEqual(locks.acquire(['01', '02', '03']), ['01', '03'])
+            # locks are released on exit
+            with sharding.SubjectLocks(lock_dir) as locks:
+                self.assertEqual(locks.acquire(['01']), ['01'])
+        finally:
+            shutil.rmtree(lock_dir)
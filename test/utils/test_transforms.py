@@ -0,0 +1,188 @@
+''' Testing module for fmriprep.utils.transforms '''
+import os
+import shutil
+import tempfile
+import unittest
+
+import nibabel as nb
+import numpy as np
+from scipy.io import savemat
+
+from fmriprep.utils.transforms import (
+    DisplacementField, compose_affines, compose_points, decompose_fsl_affines,
+    fsl_to_itk, itk_affine, itk_to_fsl, read_itk_transforms, read_volume_transforms,
+    write_itk_affines)
+
+ITK_AFFINE = '''#Insight Transform File V1.0
+#Transform 0
+Transform: MatrixOffsetTransformBase_double_3_3
+Parameters: {}
+FixedParameters: 0 0 0
+'''
+
+
+def fsl_rigid(angles, translations, centre):
+    ''' A rigid FSL matrix, as built by construct_rotmat_euler of FSL '''
+    cos, sin = np.cos(angles), np.sin(angles)
+    rot_x = np.array([[1, 0, 0], [0, cos[0], sin[0]], [0, -sin[0], cos[0]]])
+    rot_y = np.array([[cos[1], 0, -sin[1]], [0, 1, 0], [sin[1], 0, cos[1]]])
+    rot_z = np.array([[cos[2], sin[2], 0], [-sin[2], cos[2], 0], [0, 0, 1]])
+    matrix = np.eye(4)
+    matrix[:3, :3] = rot_x.dot(rot_y).dot(rot_z)
+    matrix[:3, 3] = centre - matrix[:3, :3].dot(centre) + translations
+    return matrix
+
+
+class TestTransforms(unittest.TestCase):
+    ''' Testing class for fmriprep.utils.transforms '''
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _write_affine(self, fname, parameters):
+        fname = os.path.join(self.tmpdir, fname)
+        with open(fname, 'w') as tfm_file:
+            tfm_file.write(ITK_AFFINE.format(' '.join('%g' % val for val in parameters)))
+        return fname
+
+    def test_itk_affine(self):
+        # a translation of +1mm along L (LPS) is -1mm along R (RAS)
+        affine = itk_affine([1, 0, 0, 0, 1, 0, 0, 0, 1, 1, 2, 3], [0, 0, 0])
+        np.testing.assert_allclose(affine[:3, 3], [-1, -2, 3])
+
+        # rotations about a center leave the center in place
+        center = [10, 20, 30]
+        affine = itk_affine([0, -1, 0, 1, 0, 0, 0, 0, 1, 0, 0, 0], center)
+        np.testing.assert_allclose(affine.dot([-10, -20, 30, 1])[:3], [-10, -20, 30])
+
+    def test_itk_binary_mat(self):
+        # antsRegistration writes its affines as MATLAB v4 files of doubles
+        parameters = [0, -1, 0, 1, 0, 0, 0, 0, 1, 1, 2, 3]
+        fname = os.path.join(self.tmpdir, '0GenericAffine.mat')
+        savemat(fname, {
+            'AffineTransform_double_3_3': np.array(parameters, dtype=np.float64)[:, None],
+            'fixed': np.array([10., 20., 30.])[:, None]}, format='4')
+
+        transforms = read_itk_transforms(fname)
+        self.assertEqual(len(transforms), 1)
+        np.testing.assert_allclose(transforms[0], itk_affine(parameters, [10, 20, 30]))
+        np.testing.assert_allclose(compose_affines([fname]), transforms[0])
+
+    def test_no_transform(self):
+        fname = os.path.join(self.tmpdir, 'empty.txt')
+        with open(fname, 'w') as tfm_file:
+            tfm_file.write('#Insight Transform File V1.0\n')
+        with self.assertRaises(ValueError):
+            read_itk_transforms(fname)
+
+    def test_compose(self):
+        shift = self._write_affine('shift.txt', [1, 0, 0, 0, 1, 0, 0, 0, 1, 0, 0, 5])
+        scale = self._write_affine('scale.txt', [2, 0, 0, 0, 2, 0, 0, 0, 2, 0, 0, 0])
+
+        # points go through the first transform first
+        points = compose_points([shift, scale], np.array([[1., 1., 1.]]))
+        np.testing.assert_allclose(points, [[2., 2., 12.]])
+        np.testing.assert_allclose(compose_affines([shift, scale])[:3, 3], [0, 0, 10])
+
+    def test_displacement_field(self):
+        # A 4x4x4 grid of 2mm voxels, all displaced 1mm along P (LPS)
+        size, origin, spacing = [4, 4, 4], [0, 0, 0], [2, 2, 2]
+        parameters = np.tile([0., 1., 0.], 64)
+        field = DisplacementField.from_itk(
+            parameters, size + origin + spacing + [1, 0, 0, 0, 1, 0, 0, 0, 1])
+
+        points = np.array([[-2., -2., 2.], [100., 100., 100.]])
+        np.testing.assert_allclose(field.map_points(points),
+                                   [[-2., -3., 2.], [100., 100., 100.]])
+
+    def test_decompose_fsl_affines(self):
+        centre = np.array([47., 47., 34.5])
+        angles = np.array([[0., 0., 0.], [0.01, -0.02, 0.03],
+                           [-0.3, 0.2, 0.1], [0.4, np.pi / 2, 0.]])
+        translations = np.array([[0., 0., 0.], [0.5, -1., 2.],
+                                 [-3., 0.1, 0.], [1., 1., 1.]])
+        matrices = [fsl_rigid(*params, centre=centre)
+                    for params in zip(angles, translations)]
+
+        rot_angles, transl, scales, skews = decompose_fsl_affines(matrices, centre)
+        np.testing.assert_allclose(rot_angles, angles, atol=1e-6)
+        np.testing.assert_allclose(transl, translations, atol=1e-6)
+        np.testing.assert_allclose(scales, 1., atol=1e-6)
+        np.testing.assert_allclose(skews, 0., atol=1e-6)
+
+        # scales and skews are factored out before the angles
+        scaled = matrices[2].copy()
+        scaled[:3, :3] = scaled[:3, :3].dot(np.diag([1.1, 0.9, 1.]))
+        rot_angles, _, scales, _ = decompose_fsl_affines([scaled], centre)
+        np.testing.assert_allclose(rot_angles, angles[2:3], atol=1e-6)
+        np.testing.assert_allclose(scales, [[1.1, 0.9, 1.]], atol=1e-6)
+
+    def test_decompose_fsl_affines_mcflirt(self):
+        # Two MCFLIRT matrices of a real run, about the centre of a 64x64x34
+        # grid of 3x3x3.3mm voxels. With R = Rx.Ry.Rz and FSL's
+        # construct_rotmat_euler, R[0, 1] = sin(z) cos(y), R[0, 2] = -sin(y)
+        # and R[1, 2] = sin(x) cos(y) (for small angles), so positive entries
+        # above the diagonal are negative angles
+        matrices = [
+            [[0.999999, -0.000272, 0.001561, -0.071358],
+             [0.000272, 1.000000, -0.000210, 0.053746],
+             [-0.001561, 0.000210, 0.999999, 0.153994],
+             [0., 0., 0., 1.]],
+            [[0.999999, -0.000320, 0.001330, -0.045489],
+             [0.000320, 1.000000, -0.000390, 0.064510],
+             [-0.001329, 0.000390, 0.999999, 0.111615],
+             [0., 0., 0., 1.]],
+        ]
+        centre = np.array([94.5, 94.5, 54.45])
+
+        rot_angles, transl, scales, skews = decompose_fsl_affines(matrices, centre)
+        np.testing.assert_allclose(rot_angles, [[-0.000210, -0.001561, -0.000272],
+                                                [-0.000390, -0.001329, -0.000320]],
+                                   atol=2e-6)
+        np.testing.assert_allclose(transl, [[-0.012160, 0.068016, 0.026270],
+                                            [-0.003405, 0.073515, 0.022825]],
+                                   atol=2e-6)
+        np.testing.assert_allclose(scales, 1., atol=1e-6)
+        np.testing.assert_allclose(skews, 0., atol=1e-6)
+
+        # the rotations are not about the origin: the same matrices about
+        # (0, 0, 0) keep their angles, but translate by their last column
+        rot_origin, transl_origin, _, _ = decompose_fsl_affines(matrices)
+        np.testing.assert_allclose(rot_origin, rot_angles)
+        np.testing.assert_allclose(transl_origin, np.array(matrices)[:, :3, 3])
+
+    def test_fsl_to_itk(self):
+        # RAS (positive determinant) grids, where FSL flips the first axis
+        in_nii = nb.Nifti1Image(np.zeros((10, 10, 10), dtype=np.uint8),
+                                np.diag([2., 2., 2., 1.]))
+        ref_nii = nb.Nifti1Image(np.zeros((20, 20, 20), dtype=np.uint8),
+                                 np.diag([1., 1., 1., 1.]))
+        np.testing.assert_allclose(fsl_to_itk(np.eye(4), in_nii, in_nii), np.eye(4),
+                                   atol=1e-12)
+
+        # moving the image +2mm along FSL's x axis (L) maps the points of the
+        # reference 2mm further along R in the image
+        matrix = np.eye(4)
+        matrix[0, 3] = 2.
+        affine = fsl_to_itk(matrix, in_nii, in_nii)
+        np.testing.assert_allclose(affine[:3, 3], [2., 0., 0.], atol=1e-12)
+
+        matrix = fsl_rigid([0.1, -0.2, 0.3], [1., 2., 3.], centre=[10., 10., 10.])
+        np.testing.assert_allclose(
+            itk_to_fsl(fsl_to_itk(matrix, in_nii, ref_nii), in_nii, ref_nii), matrix,
+            atol=1e-10)
+
+    def test_volume_transforms(self):
+        affines = [np.eye(4), itk_affine([0, -1, 0, 1, 0, 0, 0, 0, 1, 1, 2, 3], [5, 6, 7])]
+        series = write_itk_affines(affines, os.path.join(self.tmpdir, 'series.txt'))
+        np.testing.assert_allclose(read_volume_transforms([series], 2), affines, atol=1e-10)
+
+        # or one file per volume
+        single = write_itk_affines(affines[1:], os.path.join(self.tmpdir, 'single.txt'))
+        np.testing.assert_allclose(read_volume_transforms([single, single], 2)[1],
+                                   affines[1], atol=1e-10)
+        with self.assertRaises(ValueError):
+            read_volume_transforms([series], 3)
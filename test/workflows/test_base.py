@@ -11,7 +11,7 @@ class TestBase(TestWorkflow):
         # set up
         mock_subject_data = {'t1w': ['um'], 'sbref': ['um'], 'func': 'um'}
         mock_settings = {'output_dir': '.', 'work_dir': '.',
-                         'ants_nthreads': 1, 'biggest_epi_file_size_gb': 1,
+                         'ants_nthreads': 1, 'bold_geometry': [],
                          'skip_native': False}
 
         # run
@@ -40,7 +40,7 @@ class TestBase(TestWorkflow):
         # set up
         mock_subject_data = {'func': ''}
         mock_settings = {'output_dir': '.', 'ants_nthreads': 1,
-                         'biggest_epi_file_size_gb': 1,
+                         'bold_geometry': [],
                          'skip_native': False}
 
         # run